@@ -1,27 +1,86 @@
 # html链接解析器
 
 from html.parser import HTMLParser
+from html import unescape
 from urllib.request import urljoin
+from urllib.parse import urlsplit
 import chardet
+import codecs
 import re
+import threading as _t
 
-__all__ = ('AnchorParser', 'get_charset')
-_re = re.compile(b'''<meta.+['"]?.*;?\s*charset=['"]?(\S+)['"]''')
+__all__ = ('AnchorParser', 'get_charset', 'extract_links', 'parsers')
+_re = re.compile(rb'''<meta\b[^>]*?charset\s*=\s*['"]?\s*([\w.:-]+)''', re.I)
 
-def get_charset(data):
-    rst = _re.findall(data)
+_boms = (
+    (codecs.BOM_UTF32_LE, 'utf-32-le'), (codecs.BOM_UTF32_BE, 'utf-32-be'), # utf-32须先于utf-16检查
+    (codecs.BOM_UTF8, 'utf-8'), (codecs.BOM_UTF16_LE, 'utf-16-le'), (codecs.BOM_UTF16_BE, 'utf-16-be'),
+)
+_supersets = {'gb2312': 'gbk'} # 声明为gb2312的页面常含gbk字符
+META_SCAN = 4096      # 查找<meta>声明的页面前缀字节数
+CHARDET_SCAN = 65536  # chardet检测的页面前缀字节数
+_host_charsets = {}   # 各主机最近一次由chardet检测出的编码
+# chardet第一次检测时才读入约23MB的模型，其缓存不是线程安全的，多个线程同时第一次检测时
+# 每个线程各读入一份（20个线程时峰值内存约400MB），第一次检测须加锁
+_detect_lock = _t.Lock()
+_detect_ready = False
+
+def _lookup(charset):
+    # 返回规范化的编码名，无法识别时返回None
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        return None
+    charset = charset.lower()
+    return _supersets.get(charset, charset)
+
+def _detect(data):
+    # chardet检测编码，返回chardet给出的编码名或None
+    global _detect_ready
+    if not _detect_ready:
+        with _detect_lock:
+            result = chardet.detect(data)
+            _detect_ready = True
+            return result['encoding']
+    return chardet.detect(data)['encoding']
+
+# 检测页面编码，依次检查：BOM、页面前缀中的<meta>声明、是否为合法utf-8、
+# 同一主机之前的检测结果、chardet检测页面前缀，无法检测时返回None
+# data bytes 页面内容
+# host str   页面所在主机，用于缓存chardet的检测结果，可选参数
+def get_charset(data, host=None):
+    for bom, charset in _boms:
+        if data.startswith(bom):
+            return charset
+    rst = _re.search(data, 0, META_SCAN)
     if rst:
-        charset = rst[0].decode('ascii')
-    else:
-        charset = chardet.detect(data)['encoding']
+        charset = _lookup(rst.group(1).decode('ascii'))
+        if charset:
+            return charset
+    try:
+        data.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    if host in _host_charsets:
+        return _host_charsets[host]
+    charset = _detect(data[:CHARDET_SCAN])
+    charset = charset and _lookup(charset)
+    if host and charset:
+        if len(_host_charsets) > 10000:
+            _host_charsets.clear()
+        _host_charsets[host] = charset
     return charset
 
 class AnchorParser(HTMLParser):
 
     # 初始化
-    # html str/bytes 要解析的html
-    # url  str       html页面url，用于合并链接，可选参数
-    def __init__(self, html, url=None, charset=None, static_res=False):
+    # html    str/bytes 要解析的html
+    # url     str       html页面url，用于合并链接，可选参数
+    # charset str       页面编码，可选参数，默认为utf-8
+    # detect  bool      按charset解码失败时是否重新检测编码，charset已由get_charset检测
+    #                   得出时应设为False，避免重复检测，可选参数
+    def __init__(self, html, url=None, charset=None, static_res=False, detect=True):
         super().__init__()
         self.static_res = static_res
         self.data = []
@@ -32,7 +91,8 @@ class AnchorParser(HTMLParser):
             try:
                 html = html.decode(charset)
             except:
-                charset = get_charset(html)
+                if detect:
+                    charset = get_charset(html, url and urlsplit(url).hostname)
                 if charset:
                     try:
                         html = html.decode(charset, 'ignore')
@@ -67,8 +127,116 @@ class AnchorParser(HTMLParser):
                         link = link[:-1]
                     self.data.append(link)
 
+# 字节级链接提取：注释、script/style内容与标签一起匹配，只处理标签中的href/src属性，
+# 不解码整个页面，也不为每个标签调用Python回调
+_attrs = rb'''(?:"[^"]*"|'[^']*'|[^'">])*'''
+_skip = rb'<!--.*?(?:-->|$)|<(?:script|style)\b(?P<raw>' + _attrs + rb')>.*?(?:</(?:script|style)\s*>|$)|'
+_re_anchor = re.compile(_skip + rb'<a(?=[\s/>])(?P<attrs>' + _attrs + rb')>', re.I | re.S)
+_re_tag = re.compile(_skip + rb'<[a-z][^\s/>]*(?P<attrs>' + _attrs + rb')>', re.I | re.S)
+# 属性按“名称[=值]”依次匹配，带引号的值整体消耗，值中的href=/src=不会被当作属性（与HTMLParser一致）
+_re_attr = re.compile(rb'''([^\s/>][^\s/=>]*)(?:\s*=+\s*(?:"([^"]*)"|'([^']*)'|(?!['"])([^>\s]*)))?''')
+_link_attrs = (b'href', b'src')
+_wide = ('utf-16', 'utf-32', 'utf_16', 'utf_32')
+
+def extract_links(html, url=None, charset=None, static_res=False, detect=True):
+    '''快速提取页面链接，结果与AnchorParser一致
+    参数说明：
+    html       bytes/str    要解析的html
+    url        str          html页面url，用于合并链接，可选参数
+    charset    str          页面编码，可选参数，默认为utf-8
+    static_res bool         是否提取所有标签的href/src属性（下载静态资源），可选参数
+    detect     bool         回退到AnchorParser时是否允许重新检测编码，可选参数
+    '''
+    if type(html) != bytes:
+        html = html.encode('utf-8')
+        charset = 'utf-8'
+    charset = charset or 'utf-8'
+    if charset.lower().startswith(_wide): # 多字节编码中的ascii字符不是单字节，退回HTMLParser
+        return AnchorParser(html, url, charset, static_res, detect)()
+    data = []
+    for m in (_re_tag if static_res else _re_anchor).finditer(html):
+        attrs = m.group('attrs')
+        if attrs is None: # 注释或script/style，其内容不是标签
+            attrs = m.group('raw') if static_res else None
+            if attrs is None:
+                continue
+        for attr in _re_attr.finditer(attrs):
+            if attr.group(1).lower() not in _link_attrs:
+                continue
+            value = attr.group(2)
+            if value is None:
+                value = attr.group(3) if attr.group(3) is not None else attr.group(4)
+                if value is None: # 没有值的属性
+                    continue
+            try:
+                link = value.decode(charset)
+            except (UnicodeDecodeError, LookupError):
+                link = value.decode('utf-8', 'ignore')
+            if '&' in link:
+                link = unescape(link)
+            if link.startswith('mailto:') or link.startswith('javascript:'):
+                break # 跳过mailto和javascript链接
+            link = link.split('#', 1)[0] # 去掉锚链接
+            if link: # 过滤空链接
+                if url:
+                    link = urljoin(url, link) # 合并到html页面url
+                while link.endswith('/'):
+                    link = link[:-1]
+                data.append(link)
+    return data
+
+# 链接解析方式：html为HTMLParser，fast为字节级正则提取
+parsers = {
+    'html': lambda html, url=None, charset=None, static_res=False, detect=True:
+        AnchorParser(html, url, charset, static_res, detect)(),
+    'fast': extract_links,
+}
+
+# 一致性测试用例：(html, static_res)，两种解析方式的结果须完全相同
+_CASES = (
+    (b'<a href="/a">x</a><a href=\'b/\'>y</a><a href=c>z</a>', False),
+    (b'<A HREF="/upper">x</A><a  href = "/spaced" >y</a>', False),
+    (b'<a title="x>y" href="/gt">x</a>', False),
+    (b'<a href="/frag#top">x</a><a href="#only">y</a><a href="">z</a>', False),
+    (b'<a href="mailto:a@b.c">m</a><a href="javascript:void(0)">j</a><a href="/ok">ok</a>', False),
+    (b'<a href="/q?a=1&amp;b=2">x</a><a href="/e&#47;x">y</a>', False),
+    (b'<!-- <a href="/comment">x</a> --><a href="/real">y</a>', False),
+    (b'<script>var s = "<a href=\'/script\'>";</script><a href="/after">x</a>', False),
+    (b'<style>a[href="/style"]{}</style><a href="/styled">x</a>', False),
+    (b'<img src="/i.png"><link href="/s.css" rel="stylesheet"><script src="/j.js"></script><a href="/p">p</a>', True),
+    (b'<img src="/i.png"><a href="/p">p</a>', False),
+    (b'<abbr href="/abbr">x</abbr><a href="/a">a</a>', False),
+    (b'<a href="http://other.example.com/x/">x</a><a href="//cdn.example.com/y">y</a>', False),
+    ('<a href="/\u4e2d\u6587">x</a>'.encode('utf-8'), False),
+    ('<a href="/\u4e2d\u6587">x</a>'.encode('gbk'), False),
+    (b'<a href="/one" href="/two">x</a>', False),
+    (b'<a\nhref="/newline"\n>x</a><a\thref=/tab>y</a>', False),
+    (b'<a title="a href=/z" href="/ok">x</a>', False),
+    (b"<a alt='href=/y'>x</a><img alt=\"src=/i.png\" src=/real.png>", True),
+    (b'<a data-href="/data" xhref=/x href="/ok">x</a>', False),
+)
+
+def _conformance(cases=_CASES, url='http://www.example.com/dir/page.html'):
+    # 返回两种解析方式结果不一致的用例列表
+    failed = []
+    for html, static_res in cases:
+        charset = 'gbk' if b'\xd6\xd0' in html else 'utf-8'
+        expected = parsers['html'](html, url, charset, static_res)
+        result = parsers['fast'](html, url, charset, static_res)
+        if result != expected:
+            failed.append((html, static_res, expected, result))
+    return failed
+
 if __name__ == '__main__':
-    url = 'http://www.baidu.com'
-    from urllib.request import urlopen as uo
-    parser = AnchorParser(uo(url).read(), url, static_res=True)
-    print(parser())
\ No newline at end of file
+    import sys
+    if len(sys.argv) > 1:
+        url = sys.argv[1]
+        from urllib.request import urlopen as uo
+        parser = AnchorParser(uo(url).read(), url, static_res=True)
+        print(parser())
+    else:
+        failed = _conformance()
+        for html, static_res, expected, result in failed:
+            print('FAILED: %r static_res=%s\n  html: %r\n  fast: %r' % (html, static_res, expected, result))
+        print('%s/%s cases passed' % (len(_CASES) - len(failed), len(_CASES)))
+        exit(1 if failed else 0)
\ No newline at end of file
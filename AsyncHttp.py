@@ -0,0 +1,108 @@
+# 基于asyncio的简易HTTP/1.1客户端，供异步爬行引擎使用
+
+import asyncio
+import ssl
+from http.client import parse_headers
+from io import BytesIO
+from urllib.parse import urlsplit, urljoin
+from HttpPool import HTTPError
+
+__all__ = ('fetch', 'HTTPError')
+
+_ssl_context = None
+
+def _context():
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+def _check_size(size, max_size):
+    if max_size and size > max_size:
+        raise ValueError('response body exceeds %s bytes' % max_size)
+
+async def _read_body(reader, headers, max_size=0):
+    '''按Transfer-Encoding/Content-Length读取响应体，超过max_size字节时抛出ValueError'''
+    if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        chunks = []
+        total = 0
+        while True:
+            size = await reader.readline()
+            size = int(size.split(b';', 1)[0].strip() or b'0', 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass # 跳过trailer
+                break
+            total += size
+            _check_size(total, max_size)
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        return b''.join(chunks)
+    length = headers.get('Content-Length')
+    if length is not None:
+        _check_size(int(length), max_size)
+        return await reader.readexactly(int(length))
+    chunks = []
+    total = 0
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            return b''.join(chunks)
+        total += len(chunk)
+        _check_size(total, max_size)
+        chunks.append(chunk)
+
+async def _request(url, headers, max_size=0):
+    parsed = urlsplit(url)
+    https = parsed.scheme == 'https'
+    host = parsed.hostname
+    port = parsed.port or (443 if https else 80)
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+    reader, writer = await asyncio.open_connection(host, port, ssl=_context() if https else None,
+                                                   limit=2**20)
+    try:
+        lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % parsed.netloc.split('@')[-1]]
+        for key, value in headers.items():
+            if key.lower() not in ('host', 'connection'):
+                lines.append('%s: %s' % (key, value))
+        lines.append('Connection: close')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        status_line = await reader.readline()
+        version, status, reason = (status_line.decode('latin-1').strip().split(' ', 2) + [''])[:3]
+        head = []
+        while True:
+            line = await reader.readline()
+            head.append(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        resp_headers = parse_headers(BytesIO(b''.join(head)))
+        status = int(status)
+        if status in (204, 304) or status < 200:
+            body = b''
+        else:
+            body = await _read_body(reader, resp_headers, max_size)
+        return status, reason, resp_headers, body
+    finally:
+        writer.close()
+
+async def fetch(url, headers={}, timeout=5, max_redirects=5, max_size=0):
+    '''获取url内容，跟随重定向，返回(status, headers, body)，状态码不小于400时抛出HTTPError
+    参数说明：
+    url           str      链接
+    headers       dict     请求头，可选
+    timeout       float    超时秒数，可选，默认为5
+    max_redirects int      最大重定向次数，可选，默认为5
+    max_size      int      响应体的最大字节数，超过时抛出ValueError，可选，默认为0（不限制）
+    '''
+    for i in range(max_redirects + 1):
+        status, reason, resp_headers, body = await asyncio.wait_for(_request(url, headers, max_size), timeout)
+        location = resp_headers.get('Location')
+        if status in (301, 302, 303, 307, 308) and location:
+            url = urljoin(url, location)
+            continue
+        if status >= 400:
+            raise HTTPError(url, status, reason, resp_headers)
+        return status, resp_headers, body
+    raise HTTPError(url, status, 'too many redirects', resp_headers)
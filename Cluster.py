@@ -0,0 +1,410 @@
+# 分布式爬行：按主机一致性哈希把链接分配给各节点，节点之间通过协调器交换链接，各节点写入
+# 自己的数据库分片，爬行结束后用merge合并分片。协调器有两种实现，接口相同（owner/send/receive/idle）：
+# Coordinator  共享的SQLite文件（WAL模式，不能放在网络文件系统上），用于同一台机器上的多个进程
+# RemoteCoordinator  连接CoordinatorServer（TCP，每行一个JSON请求），各节点可以在不同的机器上
+
+import sys
+import time
+import json
+import socket
+import sqlite3
+import hashlib
+import socketserver
+import threading as _t
+from bisect import bisect
+from collections import deque
+from contextlib import contextmanager
+
+__all__ = ('HashRing', 'Coordinator', 'CoordinatorServer', 'RemoteCoordinator', 'connect', 'shard_name',
+           'merge', 'reset')
+
+class HashRing(object):
+    '''一致性哈希环，增减节点时只有少量主机改变归属
+    对象属性说明：
+    nodes    int    节点数
+    replicas int    每个节点的虚拟节点数
+    '''
+
+    def __init__(self, nodes, replicas=64):
+        '''参数说明：
+        nodes    int    节点数
+        replicas int    每个节点的虚拟节点数，可选，默认为64
+        '''
+        self.nodes = nodes
+        self.replicas = replicas
+        ring = sorted((self._hash('%s#%s' % (node, i)), node) for node in range(nodes) for i in range(replicas))
+        self._keys = [i[0] for i in ring]
+        self._nodes = [i[1] for i in ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def node(self, host):
+        '''返回主机所属的节点序号'''
+        if self.nodes == 1:
+            return 0
+        i = bisect(self._keys, self._hash(host.lower()))
+        return self._nodes[i % len(self._nodes)]
+
+class Coordinator(object):
+    '''基于共享SQLite文件（WAL模式）的协调器，用于同一台机器上的多个爬虫进程
+    links表保存节点之间发送的链接，(run, url)为主键，同一次爬行中同一链接只会被分配一次；
+    nodes表保存各节点是否空闲，同一次爬行的所有节点都空闲且没有未取走的链接时爬行结束；
+    两个表都按爬行标识run区分，其他爬行（包括以前的爬行）留下的记录不影响本次爬行
+    对象属性说明：
+    node  int     本节点序号
+    nodes int     节点总数
+    run   str     爬行标识，同一次爬行的各节点须相同
+    ring  HashRing
+    '''
+
+    def __init__(self, path, node, nodes, run='', rejoin=False, timeout=60):
+        '''参数说明：
+        path    str      协调数据库文件名
+        node    int      本节点序号（0到nodes-1）
+        nodes   int      节点总数
+        run     str      爬行标识，可选，默认为空串
+        rejoin  bool     本节点已加入过该次爬行时是否允许重新加入（断点续爬），可选，默认为False，
+                         此时抛出ValueError，须换用新的爬行标识或用reset清除以前的记录
+        timeout float    数据库锁等待秒数，可选，默认为60
+        '''
+        if not 0 <= node < nodes:
+            raise ValueError('node must be in range 0-%s' % (nodes - 1))
+        self.node = node
+        self.nodes = nodes
+        self.run = run
+        self.ring = HashRing(nodes)
+        self.lock = _t.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self.conn.execute('pragma journal_mode=wal')
+        with self._transaction() as c:
+            _create(c)
+            # 同一爬行标识下已有本节点或节点总数不同的记录时，是以前的爬行留下的，拒绝加入
+            if c.execute('select 1 from nodes where run=? and total!=?', (run, nodes)).fetchone():
+                raise ValueError('crawl %r in %s was started with a different number of nodes, use a new run id '
+                                 'or "Cluster.py reset" first' % (run, path))
+            if c.execute('select 1 from nodes where run=? and node=?', (run, node)).fetchone() and not rejoin:
+                raise ValueError('node %s has already joined crawl %r in %s, use a new run id or '
+                                 '"Cluster.py reset" first' % (node, run, path))
+            c.execute('insert or replace into nodes (run, node, total, idle) values (?, ?, ?, 0)', (run, node, nodes))
+
+    @contextmanager
+    def _transaction(self):
+        # 立即获取写锁的事务，各进程对协调数据库的读写互斥
+        with self.lock:
+            self.conn.execute('begin immediate')
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute('rollback')
+                raise
+            self.conn.execute('commit')
+
+    def owner(self, host):
+        '''返回主机所属的节点序号'''
+        return self.ring.node(host)
+
+    def send(self, items):
+        '''把属于其他节点的链接发送出去，已发送过的链接忽略
+        参数说明：
+        items iterable    [(node, url, ext, deep, hit)]
+        '''
+        items = [(self.run, url, node, ext, deep, int(hit)) for node, url, ext, deep, hit in items]
+        if items:
+            with self._transaction() as c:
+                c.executemany('insert or ignore into links (run, url, node, ext, deep, hit) values (?,?,?,?,?,?)',
+                              items)
+
+    def receive(self, limit=1000):
+        '''取走发给本节点的链接，返回[(url, ext, deep, hit)]，取到链接时本节点标记为忙碌'''
+        with self._transaction() as c:
+            rows = c.execute('select url, ext, deep, hit from links where run=? and node=? and taken=0 limit ?',
+                             (self.run, self.node, limit)).fetchall()
+            if rows:
+                c.executemany('update links set taken=1 where run=? and url=?', [(self.run, i[0]) for i in rows])
+                c.execute('update nodes set idle=0 where run=? and node=?', (self.run, self.node))
+        return rows
+
+    def idle(self):
+        '''本节点已无待处理链接时调用，标记为空闲，返回整个集群是否已爬行结束'''
+        with self._transaction() as c:
+            c.execute('update nodes set idle=1 where run=? and node=?', (self.run, self.node))
+            nodes, idle = c.execute('select count(*), sum(idle) from nodes where run=?', (self.run,)).fetchone()
+            pending = c.execute('select count(*) from links where run=? and taken=0', (self.run,)).fetchone()[0]
+        return nodes == self.nodes and idle == nodes and not pending
+
+    def close(self):
+        self.conn.close()
+
+class _Handler(socketserver.StreamRequestHandler):
+    # 一个节点的连接：每行一个JSON请求{"op": 操作, ...}，返回一行{"result": 结果}或{"error": 说明}
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    response = {'result': server.call(request)}
+                except (ValueError, KeyError, TypeError) as e: # 请求格式错误或被拒绝
+                    response = {'error': str(e) if isinstance(e, ValueError) else 'bad request: %r' % e}
+                self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        except OSError: # 节点断开连接
+            pass
+        finally:
+            server.disconnected()
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    '''网络协调器，在内存中保存一次爬行的链接分配与节点状态，各节点用RemoteCoordinator连接；
+    没有认证，只应在可信网络中使用。爬行结束且所有节点断开后serve_forever返回
+    对象属性说明：
+    nodes    int     节点总数
+    run      str     爬行标识，节点的标识不同时拒绝加入
+    finished bool    爬行是否已结束
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, nodes, run=''):
+        '''参数说明：
+        address tuple    监听地址(host, port)，port为0时自动选择，实际地址见server_address
+        nodes   int      节点总数
+        run     str      爬行标识，可选，默认为空串
+        '''
+        super().__init__(address, _Handler)
+        self.nodes = nodes
+        self.run = run
+        self.finished = False
+        self.connections = 0
+        self.lock = _t.Lock()
+        self._links = set()                                # 已分配的链接，同一链接只分配一次
+        self._queues = [deque() for i in range(nodes)]     # 各节点未取走的链接
+        self._joined = set()
+        self._idle = set()
+
+    def call(self, request):
+        # 执行一个请求，参数错误时抛出ValueError
+        op = request.get('op')
+        with self.lock:
+            if op == 'join':
+                return self._join(request['node'], request['nodes'], request['run'], request['rejoin'])
+            node = request.get('node')
+            if node not in self._joined:
+                raise ValueError('node %r has not joined' % node)
+            if op == 'send':
+                for target, url, ext, deep, hit in request['items']:
+                    if url not in self._links and 0 <= target < self.nodes:
+                        self._links.add(url)
+                        self._queues[target].append((url, ext, deep, int(hit)))
+                return None
+            if op == 'receive':
+                queue = self._queues[node]
+                rows = [queue.popleft() for i in range(min(request['limit'], len(queue)))]
+                if rows:
+                    self._idle.discard(node)
+                return rows
+            if op == 'idle':
+                self._idle.add(node)
+                if len(self._idle) == self.nodes and not any(self._queues):
+                    self.finished = True
+                return self.finished
+        raise ValueError('unknown operation %r' % op)
+
+    def _join(self, node, nodes, run, rejoin):
+        if nodes != self.nodes or run != self.run:
+            raise ValueError('coordinator serves crawl %r with %s nodes, not %r with %s nodes' % (
+                self.run, self.nodes, run, nodes))
+        if not 0 <= node < nodes:
+            raise ValueError('node must be in range 0-%s' % (nodes - 1))
+        if self.finished or node in self._joined and not rejoin:
+            raise ValueError('node %s has already joined crawl %r, restart the coordinator server' % (node, run))
+        self._joined.add(node)
+        self._idle.discard(node)
+        return None
+
+    def disconnected(self):
+        with self.lock:
+            self.connections -= 1
+            done = self.finished and not self.connections
+        if done:
+            _t.Thread(target=self.shutdown, daemon=True).start()
+
+class RemoteCoordinator(object):
+    '''CoordinatorServer的客户端，接口与Coordinator相同，线程安全
+    对象属性说明：
+    node  int     本节点序号
+    nodes int     节点总数
+    run   str     爬行标识
+    ring  HashRing
+    '''
+
+    def __init__(self, address, node, nodes, run='', rejoin=False, timeout=60):
+        '''参数说明：
+        address tuple    协调服务器地址(host, port)
+        node    int      本节点序号（0到nodes-1）
+        nodes   int      节点总数
+        run     str      爬行标识，须与服务器相同，可选，默认为空串
+        rejoin  bool     本节点已加入过时是否允许重新加入（断点续爬），可选，默认为False
+        timeout float    网络超时秒数，可选，默认为60
+        '''
+        if not 0 <= node < nodes:
+            raise ValueError('node must be in range 0-%s' % (nodes - 1))
+        self.node = node
+        self.nodes = nodes
+        self.run = run
+        self.ring = HashRing(nodes)
+        self.lock = _t.Lock()
+        self.sock = socket.create_connection(address, timeout)
+        self._file = self.sock.makefile('rwb')
+        try:
+            self._call('join', nodes=nodes, run=run, rejoin=rejoin)
+        except (ValueError, OSError):
+            self.close()
+            raise
+
+    def _call(self, op, **args):
+        args['op'] = op
+        args['node'] = self.node
+        with self.lock:
+            self._file.write(json.dumps(args).encode('utf-8') + b'\n')
+            self._file.flush()
+            line = self._file.readline()
+        if not line:
+            raise ConnectionError('coordinator server closed the connection')
+        response = json.loads(line)
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response['result']
+
+    def owner(self, host):
+        '''返回主机所属的节点序号'''
+        return self.ring.node(host)
+
+    def send(self, items):
+        '''把属于其他节点的链接发送出去，已发送过的链接忽略
+        参数说明：
+        items iterable    [(node, url, ext, deep, hit)]
+        '''
+        items = [(node, url, ext, deep, int(hit)) for node, url, ext, deep, hit in items]
+        if items:
+            self._call('send', items=items)
+
+    def receive(self, limit=1000):
+        '''取走发给本节点的链接，返回[(url, ext, deep, hit)]，取到链接时本节点标记为忙碌'''
+        return [tuple(i) for i in self._call('receive', limit=limit)]
+
+    def idle(self):
+        '''本节点已无待处理链接时调用，标记为空闲，返回整个集群是否已爬行结束'''
+        return self._call('idle')
+
+    def close(self):
+        self._file.close()
+        self.sock.close()
+
+def _address(spec):
+    # 'tcp://host:port'或'host:port' -> (host, port)
+    host, sep, port = spec.split('://', 1)[-1].rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError('bad coordinator address: %s' % spec)
+    return host.strip('[]') or '0.0.0.0', int(port)
+
+def connect(spec, node, nodes, run='', rejoin=False):
+    '''按协调器描述创建协调器：tcp://host:port连接CoordinatorServer，其他视为SQLite文件名'''
+    if spec.startswith('tcp://'):
+        return RemoteCoordinator(_address(spec), node, nodes, run, rejoin)
+    return Coordinator(spec, node, nodes, run, rejoin)
+
+def _create(conn):
+    # 建表；以前版本的协调数据库没有run列，其中的记录只属于已结束的爬行，直接删除
+    columns = [i[1] for i in conn.execute("pragma table_info('links')")]
+    if columns and 'run' not in columns:
+        conn.execute('drop table links')
+        conn.execute('drop table if exists nodes')
+    conn.execute('create table if not exists links (run text, url text, node integer, ext text, '
+                 'deep integer, hit integer, taken integer default 0, primary key (run, url))')
+    conn.execute('create index if not exists links_node on links (run, node, taken)')
+    conn.execute('create table if not exists nodes (run text, node integer, total integer, idle integer, '
+                 'primary key (run, node))')
+
+def reset(path, run=None):
+    '''清除协调数据库中某次爬行（run为None时为全部爬行）的链接与节点记录，须在各节点启动前执行，
+    返回清除的链接数
+    '''
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        conn.execute('begin immediate')
+        _create(conn)
+        where, args = ('where run=?', (run,)) if run is not None else ('', ())
+        count = conn.execute('delete from links ' + where, args).rowcount
+        conn.execute('delete from nodes ' + where, args)
+        conn.execute('commit')
+    finally:
+        conn.close()
+    return count
+
+def shard_name(dbname, node):
+    '''返回节点的数据库分片文件名，例：data.db -> data.node0.db'''
+    base, dot, ext = dbname.rpartition('.')
+    return '%s.node%s.%s' % (base, node, ext) if dot else '%s.node%s' % (dbname, node)
+
+def merge(output, shards):
+    '''合并各节点的数据库分片，返回{表名: 合并后的记录数}
+    同名表按列名合并，自增id重新编号，主键或唯一索引冲突的记录只保留第一条；
+    虚拟表（全文索引）及其附属表不合并，搜索时由FullText按合并后的页面重建
+    参数说明：
+    output str         合并后的数据库文件名
+    shards iterable    分片文件名
+    '''
+    conn = sqlite3.connect(output)
+    tables = set()
+    for shard in shards:
+        conn.execute('attach database ? as shard', (shard,))
+        schema = conn.execute("select type, name, tbl_name, sql from shard.sqlite_master "
+                              "where sql is not null and name not like 'sqlite_%' order by type desc").fetchall()
+        virtual = [name for kind, name, table, sql in schema if sql.lower().startswith('create virtual table')]
+        schema = [i for i in schema if not any(i[2].startswith(name) for name in virtual)]
+        with conn:
+            for kind, name, table, sql in schema: # 先建表（type为table排在index之前）再建索引
+                if not conn.execute('select 1 from main.sqlite_master where name=?', (name,)).fetchone():
+                    conn.execute(sql)
+            for kind, name, table, sql in schema:
+                if kind != 'table':
+                    continue
+                tables.add(name)
+                columns = [c[1] for c in conn.execute("pragma shard.table_info('%s')" % name)
+                           if not (c[1] == 'id' and c[5])] # 不复制自增主键
+                columns = ','.join('"%s"' % c for c in columns)
+                conn.execute("insert or ignore into main.'%s' (%s) select %s from shard.'%s' order by rowid" % (
+                    name, columns, columns, name))
+        conn.execute('detach database shard')
+    counts = {name: conn.execute("select count(*) from '%s'" % name).fetchone()[0] for name in sorted(tables)}
+    conn.close()
+    return counts
+
+if __name__ == '__main__':
+    if len(sys.argv) in (3, 4) and sys.argv[1] == 'reset':
+        print('removed %s links' % reset(sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else None))
+        exit()
+    if len(sys.argv) in (4, 5) and sys.argv[1] == 'serve' and sys.argv[3].isdigit():
+        server = CoordinatorServer(_address(sys.argv[2]), int(sys.argv[3]), sys.argv[4] if len(sys.argv) == 5 else '')
+        print('coordinator for %s nodes listening on %s:%s' % ((server.nodes,) + server.server_address[:2]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        print('crawl finished' if server.finished else 'stopped')
+        exit()
+    if len(sys.argv) < 4 or sys.argv[1] != 'merge':
+        print('Usage: Cluster.py merge <output.db> <shard.db> [shard.db ...]')
+        print('       Cluster.py reset <cluster.db> [run]')
+        print('       Cluster.py serve <host:port> <nodes> [run]')
+        exit(1)
+    start = time.time()
+    for table, count in merge(sys.argv[2], sys.argv[3:]).items():
+        print('%-40s %s rows' % (table, count))
+    print('merged %s shards in %.2f seconds' % (len(sys.argv) - 3, time.time() - start))
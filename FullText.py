@@ -0,0 +1,227 @@
+# 全文索引：把已保存的页面解码、去掉标签后写入SQLite FTS5表，按相关度搜索；
+# 索引按页面表的id增量进行，可在爬行时由后台线程执行，也可以爬行结束后对已有数据库补建
+
+import re
+import sys
+import time
+import zlib
+import lzma
+import sqlite3
+import threading as _t
+from html import unescape
+from AnchorParser import get_charset
+
+__all__ = ('html_text', 'FullTextIndex', 'Indexer', 'page_tables', 'search')
+
+_skip = re.compile(r'<(script|style|noscript|template)\b.*?</\1\s*>|<!--.*?-->', re.I | re.S)
+_tag = re.compile(r'<[^>]*>')
+_title = re.compile(r'<title\b[^>]*>(.*?)</title\s*>', re.I | re.S)
+_space = re.compile(r'\s+')
+# 中日韩文字没有空格分词，逐字加空格后按单字索引，查询时连续的字作为短语匹配
+_CJK = '\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef' # 含全角标点
+_cjk = re.compile('([%s])' % _CJK)
+_cjk_gap = re.compile('(?<=[%s]) | (?=[%s])' % (_CJK, _CJK))
+_term = re.compile(r'"[^"]*"|\S+')
+
+def html_text(data, charset=None):
+    '''返回页面的(标题, 正文文本)，去掉脚本、样式、注释与标签，合并空白
+    参数说明：
+    data    bytes    页面内容
+    charset str      页面编码，可选，为None时检测
+    '''
+    text = data.decode(charset or get_charset(data) or 'utf-8', 'replace')
+    text = _skip.sub(' ', text)
+    m = _title.search(text)
+    title = _space.sub(' ', unescape(_tag.sub(' ', m.group(1)))).strip() if m else ''
+    body = _space.sub(' ', unescape(_tag.sub(' ', text))).strip()
+    return title, body
+
+def _split(text):
+    return _cjk.sub(r' \1 ', text)
+
+def _join(text):
+    # 去掉索引时加在中日韩文字两侧的空格，用于显示标题与摘要
+    return _cjk_gap.sub('', _space.sub(' ', text)).strip()
+
+def _match(query):
+    # 把用户输入转为FTS5查询：每个词作为短语（中日韩文字逐字匹配），保留AND/OR/NOT、带引号的短语与前缀*
+    terms = []
+    for term in _term.findall(query):
+        if term in ('AND', 'OR', 'NOT'):
+            terms.append(term)
+        elif len(term) > 1 and term[0] == term[-1] == '"':
+            terms.append('"%s"' % _split(term[1:-1]).replace('"', '""'))
+        elif term.endswith('*') and term[:-1].isalnum() and not _cjk.search(term):
+            terms.append(term) # 前缀查询
+        else:
+            terms.append('"%s"' % _split(term).replace('"', '""'))
+    return ' '.join(terms)
+
+def page_tables(conn):
+    '''返回数据库中的页面表名（有对应_state表的表）'''
+    names = {i[0] for i in conn.execute("select name from sqlite_master where type='table'")}
+    return sorted(i for i in names if i + '_state' in names)
+
+class FullTextIndex(object):
+    '''一个页面表的全文索引，FTS5表的rowid为页面表记录的id，非线程安全，每个线程使用各自的对象
+    对象属性说明：
+    table str    页面表名
+    fts   str    FTS5表名（页面表名_fts）
+    docs  str    链接与已处理记录id的对应表，页面重新保存（id改变）时删除旧的索引；不索引的记录
+                 （非html资源等）也登记，下次从其中最大的id之后继续
+    '''
+
+    batch = 200 # 每个事务索引的页面数
+
+    def __init__(self, dbname, table, timeout=30):
+        '''参数说明：
+        dbname  str      数据库文件名
+        table   str      页面表名，如_www.example.com
+        timeout float    数据库锁等待秒数，可选，默认为30
+        '''
+        self.table = table
+        self.fts = table + '_fts'
+        self.docs = table + '_fts_docs'
+        self.conn = sqlite3.connect(dbname, timeout=timeout)
+        self.conn.execute('pragma journal_mode=wal')
+        columns = [i[1] for i in self.conn.execute("pragma table_info('%s')" % table)]
+        # 旧版本数据库没有charset、ctype列
+        self._charset = 'charset' if 'charset' in columns else 'NULL'
+        self._ctype = 'ctype' if 'ctype' in columns else 'NULL'
+        with self.conn:
+            self.conn.execute("create virtual table if not exists '%s' using fts5(url unindexed, title, body, "
+                              "tokenize='unicode61 remove_diacritics 2')" % self.fts)
+            self.conn.execute("create table if not exists '%s' (url text primary key, id integer)" % self.docs)
+
+    def _html(self, html, digest):
+        # 返回页面内容，压缩保存的页面从blobs表中读取并解压
+        if html is not None:
+            return bytes(html)
+        row = self.conn.execute("select codec,data from '%s_blobs' where hash=?" % self.table,
+                                (digest,)).fetchone()
+        if not row:
+            return None # 下载模式下直接写入文件的资源
+        codec, data = row
+        if codec == 'zlib':
+            return zlib.decompress(data)
+        if codec == 'lzma':
+            return lzma.decompress(data)
+        return bytes(data)
+
+    def _add(self, id, url, html, charset):
+        # 登记记录并删除该链接旧的索引，html为None（不索引的记录）时到此为止
+        old = self.conn.execute("select id from '%s' where url=?" % self.docs, (url,)).fetchone()
+        if old:
+            self.conn.execute("delete from '%s' where rowid=?" % self.fts, old)
+        self.conn.execute("insert or replace into '%s' (url,id) values (?,?)" % self.docs, (url, id))
+        if not html or b'\0' in html[:1024]: # 没有Content-Type的旧记录中的二进制资源
+            return False
+        title, body = html_text(html, charset)
+        self.conn.execute("insert into '%s' (rowid,url,title,body) values (?,?,?,?)" % self.fts,
+                          (id, url, _split(title), _split(body)))
+        return True
+
+    def update(self):
+        '''索引上次索引之后新保存的页面，返回新索引的页面数'''
+        count = 0
+        last = self.conn.execute("select max(id) from '%s'" % self.docs).fetchone()[0] or 0
+        while True:
+            rows = self.conn.execute("select id,url,html,hash,%s,%s from '%s' where id>? order by id limit ?" % (
+                self._charset, self._ctype, self.table), (last, self.batch)).fetchall()
+            if not rows:
+                return count
+            with self.conn:
+                for id, url, html, digest, charset, ctype in rows:
+                    # 只索引html页面，其他类型的资源不读取内容
+                    html = self._html(html, digest) if not ctype or ctype.startswith('text/html') else None
+                    if self._add(id, url, html, charset):
+                        count += 1
+            last = rows[-1][0]
+
+    def search(self, query, limit=10):
+        '''按相关度（bm25）搜索，返回[(url, 标题, 摘要, 得分)]，得分越小越相关
+        参数说明：
+        query str    查询词，空格分隔的词须同时出现，支持OR、NOT、"短语"与前缀*
+        limit int    最多返回的结果数，可选，默认为10
+        '''
+        # FTS5的表名须作为标识符（双引号）引用，单引号字符串不能用于match与辅助函数
+        sql = ("select url, title, snippet(\"{0}\", 2, '[', ']', '...', 16), bm25(\"{0}\", 0, 10, 1) as score "
+               "from \"{0}\" where \"{0}\" match ? order by score limit ?").format(self.fts)
+        return [(url, _join(title), _join(snippet), score)
+                for url, title, snippet, score in self.conn.execute(sql, (_match(query), limit))]
+
+    def close(self):
+        self.conn.close()
+
+class Indexer(_t.Thread):
+    '''后台索引线程：每隔interval秒索引新保存的页面，stop时做最后一次索引
+    对象属性说明：
+    count int    已索引的页面数
+    '''
+
+    def __init__(self, dbname, table, interval=2.0):
+        '''参数说明：
+        dbname   str      数据库文件名
+        table    str      页面表名
+        interval float    索引间隔秒数，可选，默认为2
+        '''
+        super().__init__(daemon=True)
+        self.dbname = dbname
+        self.table = table
+        self.interval = interval
+        self.count = 0
+        self.error = None
+        self._stopping = _t.Event()
+        FullTextIndex(dbname, table).close() # 在启动前建表，页面表须已存在
+
+    def run(self):
+        index = FullTextIndex(self.dbname, self.table)
+        try:
+            while True:
+                stopping = self._stopping.wait(self.interval)
+                self.count += index.update()
+                if stopping:
+                    return
+        except Exception as e:
+            self.error = e
+        finally:
+            index.close()
+
+    def stop(self):
+        '''做最后一次索引并等待线程结束，返回已索引的页面数，索引出错时抛出异常'''
+        self._stopping.set()
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.count
+
+def search(dbname, query, limit=10, table=None):
+    '''先补建索引再搜索，返回[(表名, url, 标题, 摘要, 得分)]，按得分排序
+    参数说明：
+    dbname str    数据库文件名
+    query  str    查询词
+    limit  int    最多返回的结果数，可选，默认为10
+    table  str    页面表名，可选，默认搜索全部页面表
+    '''
+    conn = sqlite3.connect(dbname)
+    tables = [table] if table else page_tables(conn)
+    conn.close()
+    results = []
+    for name in tables:
+        index = FullTextIndex(dbname, name)
+        try:
+            index.update()
+            results.extend((name,) + row for row in index.search(query, limit))
+        finally:
+            index.close()
+    results.sort(key=lambda i:i[4])
+    return results[:limit]
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('Usage: FullText.py <dbfile> <query> [limit]')
+        exit(1)
+    start = time.perf_counter()
+    for table, url, title, snippet, score in search(sys.argv[1], sys.argv[2], int(sys.argv[3]) if sys.argv[3:] else 10):
+        print('%8.3f  %s  %s\n          %s' % (score, url, title, snippet))
+    print('%.1f ms' % ((time.perf_counter() - start) * 1000))
@@ -0,0 +1,260 @@
+# 按主机调度请求：限制每个主机的并发数与请求间隔（令牌桶），遵守429/503与Retry-After，
+# 可选地根据响应延迟与错误率自适应调整每个主机的并发数
+
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+__all__ = ('HostScheduler', 'parse_retry_after')
+
+def parse_retry_after(value, now=None):
+    '''解析Retry-After响应头（秒数或HTTP日期），返回需等待的秒数，无法解析时返回None
+    参数说明：
+    value str      响应头的值
+    now   float    当前时间戳（time.time），可选
+    '''
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+    return max(when - (time.time() if now is None else now), 0.0)
+
+class _Host(object):
+    '''单个主机的调度状态
+    对象属性说明：
+    limit     int      当前并发上限
+    running   int      正在请求的数量
+    tokens    float    令牌桶中的令牌数
+    blocked   float    在该时间（time.monotonic）之前暂停请求
+    waiting   deque    等待该主机空闲的链接
+    latency   float    响应延迟的指数移动平均
+    base      float    基准延迟（缓慢上浮的最低延迟）
+    '''
+
+    def __init__(self, limit, burst, now):
+        self.limit = limit
+        self.running = 0
+        self.tokens = float(burst)
+        self.stamp = now # 上次补充令牌的时间
+        self.blocked = 0.0
+        self.waiting = deque()
+        self.latency = None
+        self.base = None
+        self.successes = 0 # 自上次调整并发数以来的正常响应数
+        self.hold = 0      # 降低并发数时仍在进行的请求数
+        self.backoff = 0   # 连续被限流的轮数
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+
+class HostScheduler(object):
+    '''主机调度器，位于待爬队列与线程池之间，非线程安全，调用方须加锁
+    对象属性说明：
+    max_conns   int      每个主机的最大并发数
+    delay       float    同一主机两次请求之间的最小间隔秒数（令牌桶的补充速度）
+    burst       int      令牌桶容量，即间隔限制下允许的突发请求数
+    adaptive    bool     是否根据延迟与错误率自适应调整每个主机的并发数（加性增、乘性减）
+    max_backoff float    被限流且无Retry-After时的最长暂停秒数
+    pending     int      暂存在调度器中等待主机空闲的链接数
+    '''
+
+    retry_statuses = (429, 503)
+    slowdown = 2.0 # 平均延迟超过基准延迟的该倍数时视为服务器过载
+
+    def __init__(self, max_conns=10, delay=0.0, burst=1, adaptive=False, max_backoff=300):
+        '''参数说明：
+        max_conns   int      每个主机的最大并发数，可选，默认为10
+        delay       float    同一主机两次请求之间的最小间隔秒数，可选，默认为0
+        burst       int      令牌桶容量，可选，默认为1
+        adaptive    bool     是否自适应调整并发数（从1开始逐步增加），可选，默认为False
+        max_backoff float    被限流时的最长暂停秒数，可选，默认为300
+        '''
+        self.max_conns = max(max_conns, 1)
+        self.delay = max(delay, 0.0)
+        self.burst = max(burst, 1)
+        self.adaptive = adaptive
+        self.max_backoff = max_backoff
+        self.pending = 0
+        self._hosts = {}
+        self._waiting = {} # 有链接等待的主机，按加入顺序轮流出队
+
+    def _host(self, host, now):
+        h = self._hosts.get(host)
+        if h is None:
+            h = self._hosts[host] = _Host(1 if self.adaptive else self.max_conns, self.burst, now)
+        return h
+
+    def _refill(self, h, now):
+        if self.delay:
+            h.tokens = min(self.burst, h.tokens + (now - h.stamp) / self.delay)
+        h.stamp = now
+
+    def _wait(self, h, now):
+        # 返回主机还需等待的秒数，0为可立即请求，None为须等待正在进行的请求完成
+        if h.running >= h.limit:
+            return None
+        wait = h.blocked - now
+        if self.delay:
+            self._refill(h, now)
+            if h.tokens < 1:
+                wait = max(wait, (1 - h.tokens) * self.delay)
+        return max(wait, 0.0)
+
+    def _take(self, h, now):
+        h.running += 1
+        if self.delay:
+            h.tokens -= 1
+
+    def acquire(self, host, now=None):
+        '''主机可立即请求时占用一个名额并返回True，否则返回False
+        参数说明：
+        host str      主机名
+        now  float    当前时间（time.monotonic），可选
+        '''
+        now = time.monotonic() if now is None else now
+        h = self._host(host, now)
+        if h.waiting or self._wait(h, now) != 0: # 已有链接在等待时新链接排在其后
+            return False
+        self._take(h, now)
+        return True
+
+    def park(self, host, item, front=False):
+        '''暂存主机未就绪的链接，主机空闲后由pop_ready取出
+        参数说明：
+        host  str      主机名
+        item  *        链接
+        front bool     是否排在最前（重试的链接），可选，默认为False
+        '''
+        h = self._host(host, time.monotonic())
+        if front:
+            h.waiting.appendleft(item)
+        else:
+            h.waiting.append(item)
+        self._waiting[host] = h
+        self.pending += 1
+
+    def parked(self, host):
+        '''返回主机暂存的链接数'''
+        h = self._hosts.get(host)
+        return len(h.waiting) if h else 0
+
+    def pop_ready(self, now=None):
+        '''返回一个主机已就绪的暂存链接并占用该主机的名额，没有时返回None
+        参数说明：
+        now float    当前时间（time.monotonic），可选
+        '''
+        now = time.monotonic() if now is None else now
+        for host, h in self._waiting.items():
+            if self._wait(h, now) == 0:
+                item = h.waiting.popleft()
+                self.pending -= 1
+                del self._waiting[host]
+                if h.waiting: # 移到末尾，各主机轮流出队
+                    self._waiting[host] = h
+                self._take(h, now)
+                return item
+        return None
+
+    def next_ready(self, now=None):
+        '''返回最早有暂存链接可以请求的等待秒数，只能等待正在进行的请求完成或没有暂存链接时返回None'''
+        now = time.monotonic() if now is None else now
+        waits = [w for w in (self._wait(h, now) for h in self._waiting.values()) if w is not None]
+        return min(waits) if waits else None
+
+    def cancel(self, host):
+        '''归还名额与令牌（链接被过滤，未实际请求）'''
+        h = self._hosts[host]
+        h.running -= 1
+        if self.delay:
+            h.tokens = min(self.burst, h.tokens + 1)
+
+    def release(self, host, latency=None, status=None, error=False, retry_after=None, now=None):
+        '''请求结束后归还名额，返回是否被限流（应稍后重试该链接）
+        参数说明：
+        host        str      主机名
+        latency     float    响应延迟秒数，可选
+        status      int      HTTP状态码，可选
+        error       bool     是否为连接错误、超时或5xx错误，可选
+        retry_after str      Retry-After响应头，可选
+        now         float    当前时间（time.monotonic），可选
+        '''
+        now = time.monotonic() if now is None else now
+        h = self._hosts[host]
+        h.running -= 1
+        h.requests += 1
+        stale = h.hold > 0 # 降低并发数之前发出的请求，其结果不再触发降低
+        if stale:
+            h.hold -= 1
+        if status in self.retry_statuses:
+            h.throttled += 1
+            if now >= h.blocked: # 同时发出的请求被限流只算一次
+                h.backoff += 1
+            pause = parse_retry_after(retry_after)
+            if pause is None:
+                pause = max(self.delay, 1.0) * 2 ** (h.backoff - 1)
+            h.blocked = max(h.blocked, now + min(pause, self.max_backoff))
+            if not stale:
+                self._decrease(h)
+            return True
+        h.backoff = 0
+        if error:
+            h.errors += 1
+            if not stale:
+                self._decrease(h)
+            return False
+        if latency is None:
+            return False
+        h.latency = latency if h.latency is None else 0.8 * h.latency + 0.2 * latency
+        h.base = latency if h.base is None else min(latency, h.base * 1.05)
+        if not self.adaptive or stale:
+            return False
+        if h.latency > self.slowdown * h.base:
+            self._decrease(h)
+        else:
+            h.successes += 1
+            if h.successes >= h.limit and h.limit < self.max_conns: # 每轮并发请求全部正常时加1
+                h.limit += 1
+                h.successes = 0
+        return False
+
+    def _decrease(self, h):
+        if not self.adaptive:
+            return
+        h.limit = max(1, h.limit // 2)
+        h.successes = 0
+        h.hold = h.running
+        h.latency = h.base
+
+    def clear(self):
+        '''丢弃全部暂存链接'''
+        for h in self._waiting.values():
+            h.waiting.clear()
+        self._waiting.clear()
+        self.pending = 0
+
+    def stats(self):
+        '''返回各主机的统计 {host: (请求数, 错误数, 被限流次数, 当前并发上限)}'''
+        return {host: (h.requests, h.errors, h.throttled, h.limit) for host, h in self._hosts.items()}
+
+if __name__ == '__main__':
+    # 模拟一个并发超过4时延迟翻倍、超过6时返回429的服务器
+    sched = HostScheduler(max_conns=16, adaptive=True)
+    now, done = 0.0, []
+    for step in range(400):
+        while sched.acquire('example.com', now):
+            pass
+        running = sched._hosts['example.com'].running
+        latency = 0.1 if running <= 4 else 0.25
+        for i in range(running):
+            sched.release('example.com', latency, 429 if running > 6 else 200, now=now)
+        now += latency
+        done.append(running)
+    print('concurrency over time:', done[:12], '...', done[-12:])
+    print('stats:', sched.stats())
+    print('Retry-After: 120 ->', parse_retry_after('120'))
+    print('Retry-After: HTTP date ->', parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT', 1445412400))
@@ -0,0 +1,239 @@
+# HTTP长连接池，按(scheme, host, port)复用http.client连接，线程安全
+
+import ssl
+import time
+import threading as _t
+import http.client
+from collections import deque
+from urllib.parse import urlsplit, urljoin
+
+__all__ = ('HttpPool', 'Response', 'HTTPError')
+
+class HTTPError(Exception):
+    '''HTTP状态码错误'''
+
+    def __init__(self, url, status, reason, headers):
+        super().__init__('HTTP Error %s: %s' % (status, reason))
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+class _Host(object):
+    '''单个主机的连接列表
+    对象属性说明：
+    idle      deque    空闲连接(conn, 归还时间)
+    total     int      已建立的连接数（含使用中的连接）
+    requests  int      请求数
+    created   int      新建连接数
+    '''
+
+    def __init__(self, lock):
+        self.cond = _t.Condition(lock)
+        self.idle = deque()
+        self.total = 0
+        self.requests = 0
+        self.created = 0
+
+class Response(object):
+    '''分块读取的响应，响应体读取完毕或关闭后归还连接，未读完即关闭的连接不再复用
+    对象属性说明：
+    url     str                        链接（跟随重定向后的最终链接）
+    status  int                        状态码
+    reason  str                        状态说明
+    headers http.client.HTTPMessage    响应头
+    '''
+
+    def __init__(self, pool, url, key, conn, resp):
+        self.url = url
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.headers
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+
+    def read(self, size=-1):
+        '''读取最多size字节，size为负数时读取全部剩余内容，读完后返回b''
+        参数说明：
+        size int    最大字节数，可选，默认读取全部
+        '''
+        if self._conn is None:
+            return b''
+        try:
+            data = self._resp.read() if size < 0 else self._resp.read(size)
+        except BaseException:
+            self.close()
+            raise
+        if self._resp.isclosed():
+            self.close()
+        return data
+
+    def iter_chunks(self, size=65536):
+        '''逐块返回响应体
+        参数说明：
+        size int    每块最大字节数，可选，默认为65536
+        '''
+        while True:
+            chunk = self.read(size)
+            if not chunk:
+                return
+            yield chunk
+
+    def drain(self):
+        # 丢弃剩余响应体以便复用连接（用于重定向与错误响应）
+        while self.read(65536):
+            pass
+
+    def close(self):
+        '''归还连接'''
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        self._pool._release(self._key, conn, self._resp.isclosed() and not self._resp.will_close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class HttpPool(object):
+    '''HTTP长连接池
+    对象属性说明：
+    maxsize      int      每个主机的最大连接数
+    idle_timeout float    空闲连接超过该秒数后关闭
+    timeout      float    连接与读取超时秒数
+    '''
+
+    _stale = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+              ConnectionResetError, ConnectionAbortedError, BrokenPipeError)
+
+    def __init__(self, maxsize=10, idle_timeout=30, timeout=5):
+        '''参数说明：
+        maxsize      int      每个主机的最大连接数，可选，默认为10
+        idle_timeout float    空闲连接超时秒数，可选，默认为30
+        timeout      float    连接与读取超时秒数，可选，默认为5
+        '''
+        self.maxsize = max(maxsize, 1)
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._lock = _t.Lock()
+        self._hosts = {}
+        self._ssl_context = ssl.create_default_context()
+
+    def _host(self, key):
+        with self._lock:
+            host = self._hosts.get(key)
+            if host is None:
+                host = self._hosts[key] = _Host(self._lock)
+            return host
+
+    def _acquire(self, key):
+        '''取得一个连接，返回(conn, 是否为复用连接)，连接数已满时阻塞等待'''
+        host = self._host(key)
+        with host.cond:
+            while True:
+                now = time.monotonic()
+                while host.idle:
+                    conn, since = host.idle.pop()
+                    if now - since < self.idle_timeout:
+                        host.requests += 1
+                        return conn, True
+                    conn.close() # 丢弃超时的空闲连接
+                    host.total -= 1
+                if host.total < self.maxsize:
+                    host.total += 1
+                    host.requests += 1
+                    host.created += 1
+                    break
+                host.cond.wait()
+        scheme, hostname, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(hostname, port, timeout=self.timeout,
+                                               context=self._ssl_context)
+        else:
+            conn = http.client.HTTPConnection(hostname, port, timeout=self.timeout)
+        return conn, False
+
+    def _release(self, key, conn, reuse):
+        '''归还连接，reuse为False时关闭连接'''
+        host = self._host(key)
+        if not reuse:
+            conn.close()
+        with host.cond:
+            if reuse:
+                host.idle.append((conn, time.monotonic()))
+            else:
+                host.total -= 1
+            host.cond.notify()
+
+    def _request(self, url, headers):
+        # 发送请求并读取响应头，返回(key, conn, resp)，响应体由Response读取
+        parsed = urlsplit(url)
+        scheme = parsed.scheme or 'http'
+        port = parsed.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parsed.hostname, port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        headers = dict(headers)
+        headers['Host'] = parsed.netloc.split('@')[-1]
+        while True:
+            conn, reused = self._acquire(key)
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+            except self._stale:
+                self._release(key, conn, False)
+                if reused: # 服务器已关闭的空闲连接，换新连接重试
+                    continue
+                raise
+            except BaseException:
+                self._release(key, conn, False)
+                raise
+            return key, conn, resp
+
+    def open(self, url, headers={}, max_redirects=5):
+        '''GET请求，跟随重定向，返回可分块读取响应体的Response，状态码不小于400时抛出HTTPError
+        参数说明：
+        url           str     链接
+        headers       dict    请求头，可选
+        max_redirects int     最大重定向次数，可选，默认为5
+        '''
+        for i in range(max_redirects + 1):
+            r = Response(self, url, *self._request(url, headers))
+            location = r.headers.get('Location')
+            if r.status in (301, 302, 303, 307, 308) and location:
+                r.drain()
+                url = urljoin(url, location)
+                continue
+            if r.status >= 400:
+                r.drain()
+                raise HTTPError(url, r.status, r.reason, r.headers)
+            return r
+        raise HTTPError(url, r.status, 'too many redirects', r.headers)
+
+    def get(self, url, headers={}, max_redirects=5):
+        '''GET请求，跟随重定向，返回(status, headers, body)，状态码不小于400时抛出HTTPError
+        参数说明：
+        url           str     链接
+        headers       dict    请求头，可选
+        max_redirects int     最大重定向次数，可选，默认为5
+        '''
+        with self.open(url, headers, max_redirects) as r:
+            return r.status, r.headers, r.read()
+
+    def stats(self):
+        '''返回各主机的连接复用统计 {(scheme, host, port): (请求数, 新建连接数)}'''
+        with self._lock:
+            return {key: (host.requests, host.created) for key, host in self._hosts.items()}
+
+    def close(self):
+        '''关闭所有空闲连接'''
+        with self._lock:
+            for host in self._hosts.values():
+                while host.idle:
+                    host.idle.pop()[0].close()
+                    host.total -= 1
@@ -0,0 +1,231 @@
+# 多关键词匹配：把全部关键词编译为一个Aho-Corasick自动机，一次扫描页面字节即可找出所有出现的
+# 关键词；页面编码不同时关键词的字节不同，每种编码只编译一次并缓存。关键词较少时逐个用bytes的
+# 查找（C实现）比纯Python的逐字节扫描更快，此时改用Finder
+
+import codecs
+import threading as _t
+from collections import deque
+
+__all__ = ('Automaton', 'Finder', 'Keywords', 'load_keywords')
+
+FIND_LIMIT = 80 # 关键词数不超过此值时用Finder，超过时用Automaton（合成页面上两者在80到100个之间速度相当）
+
+class Automaton(object):
+    '''按字节匹配的Aho-Corasick自动机，转移表为完全展开的DFA（每个状态256项），
+    扫描时每个字节只查一次表；自动机本身只读，扫描状态由调用方保存，可多线程共用
+    对象属性说明：
+    patterns list    关键词字节串
+    states   int     状态数
+    '''
+
+    def __init__(self, patterns):
+        '''参数说明：
+        patterns iterable    关键词字节串，空串忽略
+        '''
+        self.patterns = [bytes(i) for i in patterns]
+        # 字典树：goto[状态] = {字节: 子状态}，out[状态] = 在该状态结束的关键词序号
+        goto = [{}]
+        out = [[]]
+        for i, pattern in enumerate(self.patterns):
+            if not pattern:
+                continue
+            state = 0
+            for b in pattern:
+                child = goto[state].get(b)
+                if child is None:
+                    child = len(goto)
+                    goto[state][b] = child
+                    goto.append({})
+                    out.append([])
+                state = child
+            out[state].append(i)
+        # 按广度优先顺序计算失败链接，状态的输出合并其失败状态的输出
+        fail = [0] * len(goto)
+        order = []
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            order.append(state)
+            for b, child in goto[state].items():
+                f = fail[state]
+                while f and b not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(b, 0) if state else 0
+                out[child] = out[child] + out[fail[child]]
+                queue.append(child)
+        # 重新编号：没有输出的状态在前，有输出的在后，扫描时用一次比较判断是否命中；
+        # 状态号预先乘以256，转移表为一维列表，下一状态为table[state + byte]
+        states = [0] + order
+        states.sort(key=lambda s:bool(out[s]))
+        number = {s: i * 256 for i, s in enumerate(states)}
+        self.states = len(states)
+        self._limit = sum(1 for s in states if not out[s]) * 256 # 不小于此值的状态有输出
+        self._out = [tuple(out[s]) for s in states if out[s]]
+        table = [0] * (self.states * 256)
+        for s in [0] + order: # 失败状态总是先于当前状态展开
+            row = number[s]
+            base = number[fail[s]] if s else None
+            children = goto[s]
+            for b in range(256):
+                child = children.get(b)
+                if child is not None:
+                    table[row + b] = number[child]
+                elif s:
+                    table[row + b] = table[base + b]
+        self._table = table
+
+    start = 0 # 初始状态
+
+    def scan(self, data, state=0, found=None, total=None):
+        '''扫描字节串，把出现的关键词序号加入found，返回扫描结束时的状态，
+        分块扫描时把返回的状态传给下一块，跨越块边界的关键词也能找到
+        参数说明：
+        data  bytes    页面内容或其中一块
+        state int      上一块扫描结束时的状态，可选，默认为初始状态
+        found set      已找到的关键词序号，可选
+        total int      found达到该数量时提前结束，可选，默认为全部关键词数
+        '''
+        if found is None:
+            found = set()
+        if total is None:
+            total = len(self.patterns)
+        if len(found) >= total:
+            return state
+        table = self._table
+        limit = self._limit
+        out = self._out
+        for b in data:
+            state = table[state + b]
+            if state >= limit:
+                found.update(out[(state - limit) >> 8])
+                if len(found) >= total:
+                    break
+        return state
+
+    def findall(self, data):
+        '''返回data中出现的关键词序号集合'''
+        found = set()
+        self.scan(data, self.start, found)
+        return found
+
+class Finder(object):
+    '''逐个查找关键词，接口与Automaton相同，扫描状态为上一块末尾的字节（最长关键词长度-1），
+    跨越块边界的关键词也能找到
+    对象属性说明：
+    patterns list    关键词字节串
+    '''
+
+    start = b''
+
+    def __init__(self, patterns):
+        self.patterns = [bytes(i) for i in patterns]
+        self._keep = max(map(len, self.patterns), default=1) - 1
+
+    def scan(self, data, state=b'', found=None, total=None):
+        if found is None:
+            found = set()
+        if total is None:
+            total = len(self.patterns)
+        if len(found) >= total:
+            return state
+        edge = state + data[:self._keep] # 跨越块边界的部分
+        for i, pattern in enumerate(self.patterns):
+            if i not in found and pattern and (pattern in data or pattern in edge):
+                found.add(i)
+        if not self._keep:
+            return b''
+        return data[-self._keep:] if len(data) >= self._keep else (state + data)[-self._keep:]
+
+    def findall(self, data):
+        found = set()
+        self.scan(data, self.start, found)
+        return found
+
+def _codec(charset):
+    # 返回编码的规范名称，未知编码按utf-8处理
+    try:
+        return codecs.lookup(charset or 'utf-8').name
+    except LookupError:
+        return 'utf-8'
+
+class Keywords(object):
+    '''一组关键词，按页面编码编译自动机并缓存，线程安全
+    对象属性说明：
+    terms tuple    关键词（去重，保持原顺序）
+    '''
+
+    def __init__(self, terms):
+        '''参数说明：
+        terms iterable    关键词字符串，空串忽略
+        '''
+        self.terms = tuple(dict.fromkeys(i for i in terms if i))
+        self._automata = {} # {编码名: (自动机, 各关键词字节串对应的关键词序号)}
+        self._lock = _t.Lock()
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __repr__(self):
+        return 'Keywords(%r)' % (self.terms,)
+
+    def compile(self, charset=None):
+        '''返回(匹配器, 关键词序号列表)，匹配器中第i个模式对应第index[i]个关键词，关键词不超过
+        FIND_LIMIT个时匹配器为Finder，否则为Automaton；该编码无法表示的关键词不会出现在页面中，
+        不编入匹配器
+        '''
+        name = _codec(charset)
+        compiled = self._automata.get(name)
+        if compiled is None:
+            with self._lock:
+                compiled = self._automata.get(name)
+                if compiled is None:
+                    patterns, index = [], []
+                    for i, term in enumerate(self.terms):
+                        try:
+                            patterns.append(term.encode(name))
+                        except UnicodeError:
+                            continue
+                        index.append(i)
+                    cls = Finder if len(patterns) <= FIND_LIMIT else Automaton
+                    compiled = self._automata[name] = (cls(patterns), index)
+        return compiled
+
+    def matched(self, found, index):
+        '''把自动机找到的模式序号转为关键词，按关键词原顺序返回'''
+        return [self.terms[i] for i in sorted(index[j] for j in found)]
+
+def load_keywords(path):
+    '''从文件读取关键词，每行一个（UTF-8），忽略空行与#开头的注释行'''
+    with open(path, encoding='utf-8-sig') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import random
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    random.seed(0)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    terms = [''.join(random.choice(letters) for j in range(random.randint(4, 10))) for i in range(n)]
+    terms += ['he', 'she', 'his', 'hers', '关键词']
+    keywords = Keywords(terms)
+    start = time.perf_counter()
+    matcher, index = keywords.compile('utf-8')
+    print('%s keywords, %s, compiled in %.1f ms' % (
+        len(keywords), type(matcher).__name__, (time.perf_counter() - start) * 1000))
+    assert keywords.matched(matcher.findall(b'ushers'), index) == ['he', 'she', 'hers']
+    state, found = matcher.start, set()
+    for chunk in (b'...\xe5\x85\xb3\xe9\x94', b'\xae\xe8\xaf\x8d...'): # 关键词跨越两块
+        state = matcher.scan(chunk, state, found)
+    assert keywords.matched(found, index) == ['关键词']
+    gbk, gbk_index = keywords.compile('GB2312')
+    assert keywords.matched(gbk.findall('关键词'.encode('gbk')), gbk_index) == ['关键词']
+    data = ' '.join(random.choice(letters) * random.randint(1, 8) for i in range(200000)).encode()
+    data += terms[0].encode()
+    for name, func in ((type(matcher).__name__, lambda:matcher.findall(data)),
+                       ('%s x find' % len(terms), lambda:{i for i, t in enumerate(terms) if t.encode() in data})):
+        start = time.perf_counter()
+        found = func()
+        elapsed = time.perf_counter() - start
+        print('%-12s %s matched in %.1f ms (%.1f MB/s)' % (name, len(found), elapsed * 1000,
+                                                         len(data) / 2**20 / elapsed))
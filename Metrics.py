@@ -0,0 +1,288 @@
+# 爬行指标：计数器、仪表与直方图，可按标签分组，以Prometheus文本格式输出，线程安全
+
+import time
+import threading as _t
+from bisect import bisect_left
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+__all__ = ('Counter', 'Gauge', 'Histogram', 'Registry', 'serve')
+
+# 默认的直方图桶上限（秒），覆盖毫秒级的解析到数十秒的慢响应
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 0.75,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in pairs)
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric(object):
+    '''指标基类
+    对象属性说明：
+    name   str      指标名
+    help   str      说明
+    labels tuple    标签名
+    '''
+
+    type = None
+
+    def __init__(self, name, help='', labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = _t.Lock()
+        self._values = {} # {标签值: 数值}
+
+    def _key(self, values):
+        if len(values) != len(self.labels):
+            raise ValueError('%s expects labels %s' % (self.name, self.labels))
+        return tuple(str(i) for i in values)
+
+    def items(self):
+        '''返回[(标签值, 数值)]'''
+        with self._lock:
+            return sorted(self._values.items())
+
+    def _samples(self):
+        # 返回[(指标名后缀, 标签文本, 数值)]
+        return [('', _labels(self.labels, k), v) for k, v in self.items()]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        lines.extend('%s%s%s %s' % (self.name, suffix, labels, _number(value))
+                     for suffix, labels, value in self._samples())
+        return '\n'.join(lines)
+
+class Counter(_Metric):
+    '''只增不减的计数器'''
+
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        '''增加计数
+        参数说明：
+        labels *      标签值，个数与标签名相同
+        amount number 增量，可选，默认为1
+        '''
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def total(self):
+        '''返回各标签的计数之和'''
+        with self._lock:
+            return sum(self._values.values())
+
+class Gauge(_Metric):
+    '''可增可减的仪表，提供func时数值在输出时由func()计算（只支持无标签的仪表）'''
+
+    type = 'gauge'
+
+    def __init__(self, name, help='', labels=(), func=None):
+        super().__init__(name, help, labels)
+        self.func = func
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def value(self, *labels):
+        if self.func:
+            return self.func()
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def items(self):
+        if self.func:
+            return [((), self.func())]
+        return super().items()
+
+class _Buckets(object):
+    # 一组标签值对应的直方图数据
+
+    def __init__(self, n):
+        self.counts = [0] * (n + 1) # 最后一个为+Inf桶
+        self.sum = 0.0
+        self.count = 0
+
+class Histogram(_Metric):
+    '''直方图，按桶上限统计观测值的分布，可估算分位数
+    对象属性说明：
+    buckets tuple    桶上限（升序）
+    '''
+
+    type = 'histogram'
+
+    def __init__(self, name, help='', labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        '''记录一个观测值
+        参数说明：
+        value  number 观测值
+        labels *      标签值，个数与标签名相同
+        '''
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = _Buckets(len(self.buckets))
+            data.counts[i] += 1
+            data.sum += value
+            data.count += 1
+
+    def time(self, *labels):
+        '''返回计时上下文，退出时记录经过的秒数'''
+        return _Timer(self, labels)
+
+    def _merged(self):
+        # 合并全部标签的数据
+        total = _Buckets(len(self.buckets))
+        with self._lock:
+            for data in self._values.values():
+                total.counts = [a + b for a, b in zip(total.counts, data.counts)]
+                total.sum += data.sum
+                total.count += data.count
+        return total
+
+    def count(self):
+        return self._merged().count
+
+    def sum(self):
+        return self._merged().sum
+
+    def quantile(self, q):
+        '''估算全部观测值的q分位数（桶内线性插值），没有观测值时返回None
+        参数说明：
+        q float    0到1之间的分位
+        '''
+        data = self._merged()
+        if not data.count:
+            return None
+        rank = q * data.count
+        seen = 0
+        for i, n in enumerate(data.counts):
+            if n and seen + n >= rank:
+                if i == len(self.buckets): # 落在+Inf桶中，只能返回最大的有限上限
+                    return self.buckets[-1]
+                low = self.buckets[i - 1] if i else 0.0
+                return low + (self.buckets[i] - low) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            values = sorted((k, list(v.counts), v.sum, v.count) for k, v in self._values.items())
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                samples.append(('_bucket', _labels(self.labels, key, (('le', _number(bound)),)), cumulative))
+            samples.append(('_sum', _labels(self.labels, key), total))
+            samples.append(('_count', _labels(self.labels, key), count))
+        return samples
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+class Registry(object):
+    '''指标集合，按注册顺序输出'''
+
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help='', labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help='', labels=(), func=None):
+        return self._add(Gauge(name, help, labels, func))
+
+    def histogram(self, name, help='', labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        '''返回Prometheus文本格式的全部指标'''
+        return ''.join(metric.render() + '\n' for metric in self._metrics)
+
+class _Handler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve(registry, port, host='127.0.0.1'):
+    '''在后台线程中启动/metrics接口，返回HTTP服务器对象（调用shutdown停止）
+    参数说明：
+    registry Registry    指标集合
+    port     int         端口，0为自动选择（由server_address得到实际端口）
+    host     str         监听地址，可选，默认只监听本机
+    '''
+    handler = type('MetricsHandler', (_Handler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    _t.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    import random
+    from urllib.request import urlopen
+    registry = Registry()
+    requests = registry.counter('demo_requests_total', 'Requests by status.', ('status',))
+    latency = registry.histogram('demo_latency_seconds', 'Request latency.')
+    registry.gauge('demo_queue_depth', 'Links waiting.', func=lambda:42)
+    for i in range(1000):
+        requests.inc(random.choice(('200', '200', '200', '404')))
+        latency.observe(random.expovariate(20))
+    server = serve(registry, 0)
+    print(urlopen('http://127.0.0.1:%d/metrics' % server.server_address[1]).read().decode())
+    print('p50 %.4f p99 %.4f' % (latency.quantile(0.5), latency.quantile(0.99)))
+    server.shutdown()
@@ -0,0 +1,213 @@
+# 站点镜像写入器：下载的页面经有界队列交给后台线程写入本地文件，目录创建结果缓存，
+# 所有文件记录在一个清单文件中，可选地把内容相同的文件硬链接到同一份数据
+
+import os
+import json
+import queue
+import hashlib
+import logging
+import itertools
+import threading as _t
+from urllib.parse import urlsplit
+
+__all__ = ('Mirror',)
+
+class Mirror(object):
+    '''站点镜像写入器，线程安全
+    对象属性说明：
+    root     str     镜像根目录（绝对路径），各主机的文件保存在其下以主机名命名的目录中
+    manifest str     清单文件名，每行一条JSON记录{url, path, keyword, hash, size}，path相对于root
+    hardlink bool    内容相同的文件是否硬链接到第一次写入的文件
+    files    int     已写入的文件数
+    linked   int     其中硬链接的文件数
+    errors   int     写入失败的文件数（失败只记录日志，不中断爬行）
+    '''
+
+    def __init__(self, root='.', manifest='manifest.jsonl', hardlink=False, threads=2, maxsize=256):
+        '''参数说明：
+        root     str     镜像根目录，可选，默认为当前目录
+        manifest str     清单文件名（相对于root），可选，默认为manifest.jsonl
+        hardlink bool    是否硬链接内容相同的文件，可选，默认为False
+        threads  int     写入线程数，可选，默认为2
+        maxsize  int     写入队列长度，队列满时提交方阻塞，可选，默认为256
+        '''
+        self.root = os.path.realpath(root)
+        self.manifest = os.path.join(self.root, manifest)
+        self.hardlink = hardlink
+        self.files = 0
+        self.linked = 0
+        self.errors = 0
+        self._dirs = {}      # {目录: 实际使用的目录}，已确认存在的目录，目录名被文件占用时为“目录名_”
+        self._seq = itertools.count() # 临时文件序号
+        self._digests = {}   # {内容摘要: 第一次写入的文件路径}，写入完成后才登记
+        self._paths = {}     # {文件路径: 登记的内容摘要}，文件被新内容覆盖时取消旧摘要的登记
+        self._lock = _t.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self._manifest = open(self.manifest, 'a', encoding='utf-8')
+        self._queue = queue.Queue(max(maxsize, 1))
+        self._threads = [_t.Thread(target=self._run, daemon=True) for i in range(max(threads, 1))]
+        for thread in self._threads:
+            thread.start()
+
+    def path(self, url):
+        '''返回链接对应的本地文件路径：<root>/<主机>/<路径>，没有扩展名的路径保存为其下的
+        index.html，查询参数以_连接在文件名后
+        '''
+        parsed = urlsplit(url)
+        host = parsed.netloc.split('@')[-1].split(':')[0] or '_'
+        parts = [i for i in parsed.path.split('/') if i not in ('', '.', '..')]
+        query = '_' + parsed.query.replace('/', '_') if parsed.query else ''
+        name = parts.pop() if parts else ''
+        base, ext = os.path.splitext(name)
+        if ext:
+            parts.append('%s%s%s' % (base, query, ext))
+        else:
+            if name:
+                parts.append(name)
+            parts.append('index%s.html' % query)
+        return os.path.join(self.root, host, *parts)
+
+    def _makedirs(self, path):
+        # 创建文件所在目录，结果缓存；路径中某一级的名字已被文件占用时该级改用“名字_”，返回最终的文件路径
+        dirname, name = os.path.split(path)
+        real = self._dirs.get(dirname)
+        if real is None:
+            real = dirname
+            try:
+                os.makedirs(dirname, exist_ok=True)
+            except (FileExistsError, NotADirectoryError):
+                real = self.root
+                for part in os.path.relpath(dirname, self.root).split(os.sep):
+                    real = os.path.join(real, part)
+                    if os.path.lexists(real) and not os.path.isdir(real):
+                        real += '_'
+                os.makedirs(real, exist_ok=True)
+            self._dirs[dirname] = real
+        return os.path.join(real, name)
+
+    def _temp(self, path, suffix):
+        # 目标文件旁的临时文件名，每次不同：不同链接可能映射到同一路径（如/a、/a/与/a/index.html），
+        # 多个写入线程同时写时固定的临时文件名会互相覆盖或被先完成的线程改名移走
+        return '%s.%d.%s' % (path, next(self._seq), suffix)
+
+    def put(self, url, keyword, data, digest=None):
+        '''提交一个文件，由后台线程写入，队列满时阻塞
+        参数说明：
+        url     str      链接
+        keyword str      关键词
+        data    bytes    文件内容
+        digest  str      内容的sha1摘要，可选
+        '''
+        self._queue.put((url, keyword, data, digest or hashlib.sha1(data).hexdigest(), None))
+
+    def open_part(self, url):
+        '''为分块写入的大文件在目标目录中创建临时文件（.part结尾），返回(临时文件路径, 文件对象)，
+        写完后调用commit，放弃时调用discard
+        '''
+        part = self._temp(self._makedirs(self.path(url)), 'part')
+        return part, open(part, 'xb')
+
+    def commit(self, url, keyword, part, digest):
+        '''提交分块写入完毕的临时文件，由后台线程改名为目标文件并记录清单'''
+        self._queue.put((url, keyword, None, digest, part))
+
+    def discard(self, part):
+        os.remove(part)
+
+    def _link(self, digest, path):
+        # 内容相同的文件已写入时硬链接到path，返回是否成功
+        with self._lock:
+            source = self._digests.get(digest)
+        if source is None or source == path: # 同一链接重新下载，直接覆盖
+            return False
+        temp = self._temp(path, 'link')
+        try:
+            os.link(source, temp)
+            os.replace(temp, path)
+        except OSError: # 跨文件系统、不支持硬链接或原文件已删除
+            return False
+        finally:
+            if os.path.lexists(temp): # path已是source的硬链接时改名什么也不做，临时链接仍在
+                os.remove(temp)
+        return True
+
+    def _register(self, digest, path):
+        # 文件写入完成后登记其摘要，供之后内容相同的文件硬链接
+        with self._lock:
+            old = self._paths.get(path)
+            if old == digest:
+                return
+            if old is not None and self._digests.get(old) == path:
+                del self._digests[old]
+            self._paths[path] = digest
+            self._digests.setdefault(digest, path)
+
+    def _write(self, url, keyword, data, digest, part):
+        path = self._makedirs(self.path(url))
+        size = len(data) if part is None else os.path.getsize(part)
+        linked = self.hardlink and self._link(digest, path)
+        if linked:
+            if part is not None:
+                os.remove(part)
+        else:
+            # 先写临时文件再改名替换：目标文件可能是硬链接，原地写入会改变共用同一数据的其他文件
+            if part is None:
+                part = self._temp(path, 'tmp')
+                with open(part, 'xb') as f:
+                    f.write(data)
+            os.replace(part, path)
+        if self.hardlink:
+            self._register(digest, path)
+        entry = {'url': url, 'path': os.path.relpath(path, self.root), 'keyword': keyword,
+                 'hash': digest, 'size': size}
+        with self._lock:
+            self._manifest.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.files += 1
+            self.linked += linked
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                logging.warning('*** ERROR: failed to save "%s" to the mirror: %s', item[0], e)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        '''阻塞直到已提交的文件全部写入'''
+        self._queue.join()
+        with self._lock:
+            self._manifest.flush()
+
+    def close(self):
+        '''写完剩余文件并关闭清单'''
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._manifest.close()
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import tempfile
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with tempfile.TemporaryDirectory() as tmp:
+        mirror = Mirror(tmp, hardlink=True)
+        start = time.perf_counter()
+        for i in range(n):
+            body = ('<html>page %d</html>' % (i % (n // 2))).encode() # 一半的页面内容重复
+            mirror.put('http://example.com/d%d/s%d/p%d.html' % (i % 10, i % 100, i), '', body)
+        mirror.close()
+        elapsed = time.perf_counter() - start
+        with open(mirror.manifest, encoding='utf-8') as f:
+            entries = sum(1 for line in f)
+        print('%s files (%s hard links, %s errors) in %.2f seconds, %s manifest entries' % (
+            mirror.files, mirror.linked, mirror.errors, elapsed, entries))
+        print(mirror.path('http://example.com/a/b?x=1'), mirror.path('http://127.0.0.1:8080'))
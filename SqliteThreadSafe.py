@@ -1,14 +1,17 @@
-# 封装了sqlite数据库增删改查等常用操作，线程安全
+# 封装了sqlite数据库增删改查等常用操作，使用绑定参数，线程安全
 
 import sqlite3
 import threading  as _t
+import queue
+import time
 
-__all__ = ('DbHandler',)
+__all__ = ('DbHandler', 'BatchWriter')
 
 class DbHandler(object):
     __lock = _t.Lock()
     _instance = None    # 唯一实例
     _dbname = 'data.db' # 数据库文件名
+    cached_statements = 256 # 每个连接缓存的预编译语句数
 
     # ***单例模式
     def __new__(cls, *args, **kwargs):
@@ -20,9 +23,12 @@ class DbHandler(object):
 
     def __init__(self, dbname=None):
         if dbname: type(self)._dbname = dbname
-        self.conn = sqlite3.connect(self._dbname, check_same_thread=False)
+        self.conn = self._connect()
         self.lock = _t.Lock()
 
+    def _connect(self):
+        return sqlite3.connect(self._dbname, check_same_thread=False, cached_statements=self.cached_statements)
+
     # 关闭数据库链接，初始化类
     def close(self):
         self.conn.close()
@@ -39,44 +45,37 @@ class DbHandler(object):
             cls._dbname = dbname
             cls._instance = super().__new__(cls, *(), **{})
 
-    # 递归转义sql语句
-    # data str/list/tuple/* 要转义的数据，例："I'm Li Ming."，
-    # '"Hello!"'，['Nice"', "'to", ('\\meet', '"you')]
-    @classmethod
-    def _addslashes(cls, data):
-        t = type(data)
-        if t == str:
-            if data == 'NULL':
-                return '\\NULL'
-            handle_chars = ["'", "\"" , "\\"]
-            bfs = []
-            for i in data:
-                if i in handle_chars:
-                    bfs.append('\\')
-                bfs.append(i)
-            return ''.join(bfs)
-        if t == list or t == tuple:
-            return tuple(map(lambda x:cls._addslashes(x), data))
-        return data
-
-    # 向数据库中插入数据，返回影响行数
+    # 以下各方法中的值都通过绑定参数传给sqlite，不再拼接到sql语句中；相同形式的语句
+    # 生成相同的sql文本，由连接的语句缓存复用预编译结果
+
+    # 表名转为sql中的标识符
+    @staticmethod
+    def _table(table):
+        return "'%s'" % table.replace("'", "''")
+
+    # 列转为sql片段，例："name,age"，['name', 'age'] -> name,age
+    @staticmethod
+    def _columns(columns):
+        return columns if type(columns)==str else ','.join(columns)
+
+    # 条件转为(sql片段, 绑定参数)
+    # where  str/iterable 条件，例："age>?"，['name', 'Li Ming']
+    # params iterable     where为字符串时其中?对应的绑定参数
+    @staticmethod
+    def _where(where, params=()):
+        if type(where)==str:
+            return where, tuple(params)
+        return '%s=?' % where[0], (where[1],)
+
+    # 向数据库中插入数据，返回影响行数，多行数据使用executemany在一个事务中插入
     # table   str          要操作的表名
     # colimns str/iterable 要操作的列，例："name,age"，['name', 'age']
     # data    iterable     要插入的数据，例：[('Li Ming', 18), ('Wang Mei', 19)]
     def insert(self, table, columns, data):
-        table, columns, data = self._addslashes((table, columns, data))
-        sql = "insert into '%s' (%s) values %s" % (
-            table,
-            columns if type(columns)==str else ','.join(columns),
-            ','.join(["('%s')" % "','".join(i) for i in data])
-            )
-        with self.lock:
-            cursor = self.conn.cursor()
-            cursor.execute(sql)
-            rowcount = cursor.rowcount
-            self.conn.commit()
-            cursor.close()
-        return rowcount
+        columns = self._columns(columns)
+        sql = "insert into %s (%s) values (%s)" % (
+            self._table(table), columns, ','.join('?' * len(columns.split(','))))
+        return self.executemany(sql, data)
 
     # 向数据库中插入一行数据，返回影响行数
     # table   str          要操作的表名
@@ -85,92 +84,238 @@ class DbHandler(object):
     insert_line = lambda self, table, columns, data: self.insert(table, columns, (data,))
 
     # 从数据库中删除数据，返回影响行数
-    # table str          要操作的表名
-    # where str/iterable 条件，例："name='Li Ming'"，['name', 'Li Ming']
-    def delete(self, table, where='1=1'):
-        table, where = self._addslashes((table, where))
-        sql = "delete from '%s' where %s" % (
-            table,
-            where if type(where)==str else ("%s='%s'" % (where[0], where[1]))
-            )
-        with self.lock:
-            cursor = self.conn.cursor()
-            cursor.execute(sql)
-            rowcount = cursor.rowcount
-            self.conn.commit()
-            cursor.close()
-        return rowcount
+    # table  str          要操作的表名
+    # where  str/iterable 条件，例："name=?"，['name', 'Li Ming']
+    # params iterable     where为字符串时的绑定参数，可选参数
+    def delete(self, table, where='1=1', params=()):
+        where, params = self._where(where, params)
+        return self._rowcount("delete from %s where %s" % (self._table(table), where), params)
 
     # 从数据库中更新数据，返回影响行数
-    # table str          要操作的表名
-    # data  iterable     要更新的数据，例：[('name', 'Li Ming'), ('age', 18)]
-    # where str/iterable 条件，例："name='Li Ming'"，['name', 'Li Ming']
-    def update(self, table, data, where='1=1'):
-        table, data, where = self._addslashes((table, data, where))
-        sql = "update '%s' set %s where %s" % (
-            table,
-            ','.join([("%s='%s'" % column,value) for column,value in data]),
-            where if type(where)==str else ("%s='%s'" % (where[0], where[1]))
-            )
-        with self.lock:
-            cursor = self.conn.cursor()
-            cursor.execute(sql)
-            rowcount = cursor.rowcount
-            self.conn.commit()
-            cursor.close()
-        return rowcount
+    # table  str          要操作的表名
+    # data   iterable     要更新的数据，例：[('name', 'Li Ming'), ('age', 18)]
+    # where  str/iterable 条件，例："name=?"，['name', 'Li Ming']
+    # params iterable     where为字符串时的绑定参数，可选参数
+    def update(self, table, data, where='1=1', params=()):
+        where, params = self._where(where, params)
+        sql = "update %s set %s where %s" % (
+            self._table(table), ','.join('%s=?' % column for column, value in data), where)
+        return self._rowcount(sql, tuple(value for column, value in data) + params)
+
+    # 批量更新，使用executemany在一个事务中执行，返回影响行数
+    # table   str          要操作的表名
+    # columns str/iterable 要更新的列，例：['age']
+    # keys    str/iterable 定位记录的列，例：['name']
+    # data    iterable     每行为要更新的值加上定位列的值，例：[(18, 'Li Ming'), (19, 'Wang Mei')]
+    def update_many(self, table, columns, keys, data):
+        columns, keys = self._columns(columns), self._columns(keys)
+        sql = "update %s set %s where %s" % (
+            self._table(table), ','.join('%s=?' % i for i in columns.split(',')),
+            ' and '.join('%s=?' % i for i in keys.split(',')))
+        return self.executemany(sql, data)
 
     # 从数据库中查询数据，返回数据列表
     # table    str          要操作的表名
     # colimns  str/iterable 要操作的列，例："name,age"，['name', 'age']
-    # where    str/iterable 条件，例："name='Li Ming'"，['name', 'Li Ming']
+    # where    str/iterable 条件，例："name=?"，['name', 'Li Ming']
     # with_key bool         返回数据是否带有列名信息
-    def select(self, table, columns='*', where='1=1', with_key=False):
-        table, columns, where = self._addslashes((table, columns, where))
-        sql = "select %s from '%s' where %s" % (
-            columns if type(columns)==str else ','.join(columns),
-            table,
-            where if type(where)==str else ("%s='%s'" % (where[0], where[1]))
-            )
+    # params   iterable     where为字符串时的绑定参数，可选参数
+    def select(self, table, columns='*', where='1=1', with_key=False, params=()):
+        where, params = self._where(where, params)
+        sql = "select %s from %s where %s" % (self._columns(columns), self._table(table), where)
         with self.lock:
             cursor = self.conn.cursor()
             if with_key:
                 cursor.row_factory = sqlite3.Row
-            cursor.execute(sql)
+            cursor.execute(sql, params)
             result = cursor.fetchall()
             cursor.close()
         return result
 
-    # 从数据库中查询一行数据，返回数据列表
+    # 逐批读取查询结果，返回生成器，内存占用与结果行数无关；使用独立的只读连接，
+    # 遍历期间不占用共享连接，其他线程可以继续读写（WAL模式下读写互不阻塞）
     # table    str          要操作的表名
-    # colimns  str/iterable 要操作的列，例："name,age"，['name', 'age']
-    # where    str/iterable 条件，例："name='Li Ming'"，['name', 'Li Ming']
+    # colimns  str/iterable 要读取的列，只读取需要的列，例：['url', 'html']
+    # where    str/iterable 条件，例："id>?"，['keyword', 'python']
     # with_key bool         返回数据是否带有列名信息
-    def select_line(self, table, columns='*', where='1=1', with_key=False):
+    # params   iterable     where为字符串时的绑定参数，可选参数
+    # size     int          每批读取的行数，可选参数，默认为500
+    def select_iter(self, table, columns='*', where='1=1', with_key=False, params=(), size=500):
+        where, params = self._where(where, params)
+        sql = "select %s from %s where %s" % (self._columns(columns), self._table(table), where)
+        conn = self._connect()
         try:
-            return self.select(table, columns, where, with_key)[0]
-        except:
-            return None
+            if with_key:
+                conn.row_factory = sqlite3.Row
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    # 从数据库中查询一行数据，返回数据列表，没有数据或查询出错（如表不存在）时返回None
+    # table    str          要操作的表名
+    # colimns  str/iterable 要操作的列，例："name,age"，['name', 'age']
+    # where    str/iterable 条件，例："name=?"，['name', 'Li Ming']
+    # with_key bool         返回数据是否带有列名信息
+    # params   iterable     where为字符串时的绑定参数，可选参数
+    def select_line(self, table, columns='*', where='1=1', with_key=False, params=()):
+        where, params = self._where(where, params)
+        sql = "select %s from %s where %s limit 1" % (self._columns(columns), self._table(table), where)
+        with self.lock:
+            cursor = self.conn.cursor()
+            if with_key:
+                cursor.row_factory = sqlite3.Row
+            try:
+                cursor.execute(sql, params)
+                result = cursor.fetchone()
+            except sqlite3.Error:
+                result = None
+            cursor.close()
+        return result
 
     # 从数据库中查询单个数据，返回结果的第一行第一列数据
     # table    str          要操作的表名
     # colimns  str/iterable 要操作的列，例："name,age"，['name', 'age']
-    # where    str/iterable 条件，例："name='Li Ming'"，['name', 'Li Ming']
-    def select_one(self, table, columns='*', where='1=1'):
-        try:
-            return self.select(table, columns, where, False)[0][0]
-        except:
-            return None
+    # where    str/iterable 条件，例："name=?"，['name', 'Li Ming']
+    # params   iterable     where为字符串时的绑定参数，可选参数
+    def select_one(self, table, columns='*', where='1=1', params=()):
+        row = self.select_line(table, columns, where, False, params)
+        return row[0] if row else None
 
     # 执行sql语句
-    # sql  str      要执行的sql语句
-    # call function 执行sql语句后会执行此函数，并传入cursor，可选参数，如
+    # sql    str      要执行的sql语句
+    # call   function 执行sql语句后会执行此函数，并传入cursor，可选参数，如
     # 果提供此参数则本方法最后会返回传入函数的返回值，否则将返回None。
-    def execute(self, sql, call=None):
+    # params iterable sql语句的绑定参数，可选参数
+    def execute(self, sql, call=None, params=()):
         with self.lock:
             cursor = self.conn.cursor()
-            cursor.execute(sql)
+            cursor.execute(sql, params)
             retval = call(cursor) if call else None
             self.conn.commit()
             cursor.close()
-        return retval
\ No newline at end of file
+        return retval
+
+    # 对每组绑定参数执行同一条sql语句，在一个事务中提交，返回影响行数
+    # sql  str      要执行的sql语句，例："insert into 't' (a,b) values (?,?)"
+    # data iterable 绑定参数序列，例：[(1, 2), (3, 4)]
+    def executemany(self, sql, data):
+        with self.lock:
+            try:
+                cursor = self.conn.executemany(sql, data)
+                rowcount = cursor.rowcount
+                cursor.close()
+            except BaseException:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+        return rowcount
+
+    def _rowcount(self, sql, params):
+        return self.execute(sql, lambda c:c.rowcount, params)
+
+# 单写线程：各线程通过队列提交写操作，由本线程使用独立连接批量执行，
+# 每个事务最多包含batch_size条记录，未满一批时最多等待interval秒后提交
+class BatchWriter(_t.Thread):
+
+    _sync_modes = ('OFF', 'NORMAL', 'FULL')
+
+    # dbname     str   数据库文件名
+    # batch_size int   每个事务的最大记录数，可选参数，默认为500
+    # interval   float 未满一批时最长等待提交的秒数，可选参数，默认为1
+    # synchronous str  sqlite synchronous模式（OFF/NORMAL/FULL），可选参数，默认为NORMAL
+    # wal        bool  是否启用WAL日志模式，可选参数，默认为True
+    def __init__(self, dbname, batch_size=500, interval=1.0, synchronous='NORMAL', wal=True):
+        super().__init__(daemon=True)
+        synchronous = synchronous.upper()
+        if synchronous not in self._sync_modes:
+            raise ValueError('unknown synchronous mode: %s' % synchronous)
+        self.batch_size = max(batch_size, 1)
+        self.interval = interval
+        self.conn = sqlite3.connect(dbname, check_same_thread=False)
+        if wal:
+            self.conn.execute('pragma journal_mode=WAL')
+        self.conn.execute('pragma synchronous=%s' % synchronous)
+        self.queue = queue.Queue(self.batch_size * 10)
+        self.error = None # 写入失败时的异常，由flush/close抛出
+        self.written = 0  # 已提交的记录数
+        self.on_commit = None # 每批提交后在写线程中调用on_commit(记录数, 秒数)，用于统计
+        self.closed = False
+        self.start()
+
+    # 提交一条写操作，队列已满时阻塞
+    # sql    str   sql语句
+    # params tuple 绑定参数
+    def put(self, sql, params=()):
+        assert not self.closed, 'The writer must not be closed'
+        self.queue.put((sql, params))
+
+    # 阻塞直到此前提交的写操作全部写入数据库
+    def flush(self):
+        done = _t.Event()
+        self.queue.put((None, done))
+        done.wait()
+        self._raise()
+
+    # 写入剩余数据并关闭连接
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.join()
+        self.conn.close()
+        self._raise()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _commit(self, batch):
+        # 连续的相同语句合并为一次executemany，整批在一个事务中提交
+        start = time.perf_counter()
+        try:
+            with self.conn:
+                i = 0
+                while i < len(batch):
+                    sql = batch[i][0]
+                    j = i
+                    while j < len(batch) and batch[j][0] == sql:
+                        j += 1
+                    self.conn.executemany(sql, [params for sql, params in batch[i:j]])
+                    i = j
+            self.written += len(batch)
+        except Exception as e:
+            self.error = e
+            return
+        if self.on_commit:
+            self.on_commit(len(batch), time.perf_counter() - start)
+
+    def run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False # 超时，提交当前批次
+            if item and item[0] is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.interval
+                if len(batch) < self.batch_size:
+                    continue
+            if batch:
+                self._commit(batch)
+                batch = []
+            deadline = None
+            if item is None: # 关闭
+                return
+            if item and item[0] is None: # flush
+                item[1].set()
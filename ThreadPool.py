@@ -1,18 +1,20 @@
 # 线程池封装
 
 import threading as _t
-from time import sleep
+from collections import deque
 
-__all__ = ('Pool', '_Task', '_Worker', 'Lock')
+__all__ = ('Pool', '_Task', '_Worker', 'Lock', 'Condition')
 
 Lock = _t.Lock
+Condition = _t.Condition
 
 class _Task(object):
     '''任务执行类
     对象属性说明：
-    result  *           执行结果
-    func    function    任务包装函数
-    is_done bool        是否已执行
+    result    *           执行结果
+    exception Exception   执行时抛出的异常，无异常为None
+    func      function    任务包装函数
+    is_done   bool        是否已执行
     '''
 
     def __init__(self, func, args=(), kwargs={}):
@@ -23,29 +25,57 @@ class _Task(object):
         '''
         self.func = lambda:func(*args, **kwargs) # 任务包装函数
         self.result = None # 执行结果
-        self.is_done = False # 是否已执行
+        self.exception = None # 执行时抛出的异常
+        self._done = _t.Event() # 执行完毕事件
+
+    @property
+    def is_done(self):
+        '''是否已执行'''
+        return self._done.is_set()
 
     def __call__(self):
-        '''执行任务'''
-        self.result = self.func()
-        self.is_done = True
+        '''执行任务，异常不会中断监听线程，而是记录下来由get抛出'''
+        try:
+            self.result = self.func()
+        except Exception as e:
+            self.exception = e
+        finally:
+            self._done.set()
+
+    def wait(self, timeout=None):
+        '''阻塞直到任务执行完毕，返回是否已执行
+        参数说明：
+        timeout float    超时秒数，可选
+        '''
+        return self._done.wait(timeout)
+
+    def get(self, timeout=None):
+        '''阻塞直到任务执行完毕，返回执行结果，任务抛出异常时重新抛出
+        参数说明：
+        timeout float    超时秒数，可选
+        '''
+        if not self._done.wait(timeout):
+            raise TimeoutError('The task is not done')
+        if self.exception is not None:
+            raise self.exception
+        return self.result
 
 class _Worker(_t.Thread):
     '''任务监听线程类
     对象属性说明：
-    lock    threading.Lock()    锁
-    tasks   list                任务列表
-    running bool                监听线程是否正在执行任务
-    done    bool                监听线程是否执行完毕
+    cond    threading.Condition()    任务队列条件变量
+    tasks   deque                    任务队列
+    running bool                     监听线程是否正在执行任务
+    done    bool                     监听线程是否执行完毕
     '''
 
-    def __init__(self, lock, tasks, pool):
+    def __init__(self, cond, tasks, pool):
         '''参数说明：
-        lock  threading.Lock()    锁
-        tasks list                任务列表
-        pool  Pool                线程池
+        cond  threading.Condition()    任务队列条件变量
+        tasks deque                    任务队列
+        pool  Pool                     线程池
         '''
-        self.lock = lock
+        self.cond = cond
         self.tasks = tasks
         self.pool = pool
         self.running = False # 监听线程是否正在执行任务
@@ -54,36 +84,44 @@ class _Worker(_t.Thread):
         super().__init__()
 
     def kill(self):
-        self.killed = True
+        '''当前任务执行完毕后退出监听线程'''
+        with self.cond:
+            self.killed = True
+            self.cond.notify_all()
+
+    def _next(self):
+        '''阻塞获取下一个任务，需要退出时返回None'''
+        with self.cond:
+            while not self.tasks:
+                if self.killed or self.pool.closed: # 无任务时若线程池关闭则退出
+                    return None
+                self.cond.wait()
+            if self.killed:
+                return None
+            self.running = True
+            self.pool._running += 1
+            return self.tasks.popleft()
 
     def run(self):
-        sleep(0.1)
-        while True: # 循环监听任务列表
-            if self.killed:
-                self.done = True
-                return
-            if len(self.tasks) == 0:
-                if self.pool.closed: # 无任务时若线程池关闭则退出
-                    self.done = True
+        try:
+            while True: # 等待任务队列
+                task = self._next()
+                if task is None:
                     return
-                continue
-            with self.lock:
-                if len(self.tasks) > 0:
-                    #print('I am', self.name)
-                    func = self.tasks[0]
-                    del self.tasks[0]
-                else:
-                    func = None
-            if func:
-                self.running = True
-                func()
-                self.running = False
+                try:
+                    task()
+                finally:
+                    with self.cond:
+                        self.running = False
+                        self.pool._running -= 1
+        finally:
+            self.done = True
 
 class Pool(object):
     '''线程池类
     对象属性说明：
     num     int     线程数
-    tasks   list    任务对象列表
+    tasks   deque   任务对象队列
     results list    map执行结果
     closed  bool    线程池是否关闭
     workers list    任务监听线程对象列表
@@ -93,32 +131,42 @@ class Pool(object):
         '''参数说明：
         num int    线程数
         '''
-        self._lock = _t.Lock()
+        self._lock = _t.RLock()
+        self._cond = _t.Condition(self._lock)
         if num < 1: num = 1
         self.num = num
-        self.tasks = []
+        self.tasks = deque()
         self.results = None
         self.closed = False
-        self.workers = [_Worker(self._lock, self.tasks, self) for i in range(num)]
+        self._running = 0 # 正在执行任务的线程数
+        self.workers = [_Worker(self._cond, self.tasks, self) for i in range(num)]
         for i in self.workers: i.start()
 
     def running(self):
         '''返回同时执行任务的数量'''
-        return sum(map(lambda x:int(x.running), self.workers))
+        return self._running
 
     def close(self):
         '''关闭线程池，添加任务后必须关闭，否则程序将不会退出，
         建议使用with结构语句，线程池将自动关闭。
         线程池关闭后则不能添加新任务。
         '''
-        self.closed = True
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def terminate(self):
+        '''关闭线程池并丢弃未执行的任务，正在执行的任务执行完毕后线程退出'''
+        with self._cond:
+            self.closed = True
+            self.tasks.clear()
+            for i in self.workers: i.killed = True
+            self._cond.notify_all()
 
     def join(self):
         '''等待所有任务执行完毕'''
         assert self.closed, 'The pool must be closed'
-        while True:
-            if all(map(lambda x:x.done, self.workers)):
-                return
+        for i in self.workers: i.join()
 
     def add(self, func, args=(), kwargs={}):
         '''添加任务，返回任务对象
@@ -129,50 +177,46 @@ class Pool(object):
         '''
         assert not self.closed, 'The pool must not be closed'
         task = _Task(func, args, kwargs)
-        with self._lock:
+        with self._cond:
             self.tasks.append(task)
+            self._cond.notify()
         return task
 
-    def map(self, func, *iterables, async=False):
+    def map(self, func, *iterables, async_=False):
         '''多线程版map函数
         参数说明：
         func       function    要执行的函数
         *iterables iterable    要操作的列表
-        async      bool        是否异步执行，非异步执行则返回结果
+        async_     bool        是否异步执行，非异步执行则返回结果
         '''
         if not iterables:
             return ()
-        iterables = list(map(lambda x:x if type(x) in (list, tuple) else list(x), iterables))
-        with self._lock:
-            maps = []
-            for i in range(len(iterables[0])):
-                args = [iterables[key][i] for key in range(len(iterables))]
-                task = _Task(func, args)
-                maps.append(task)
-                self.tasks.append(task)
-        if async:
+        assert not self.closed, 'The pool must not be closed'
+        maps = [_Task(func, args) for args in zip(*iterables)]
+        with self._cond:
+            self.tasks.extend(maps)
+            self._cond.notify_all()
+        if async_:
             _t.Thread(target=self._map_fetch, args=(maps,), daemon=True).start()
         else:
             return self._map_fetch(maps)
-    
+
     def map_async(self, func, *iterables):
         '''多线程版map函数，异步执行
         参数说明：
         func       function    要执行的函数
         *iterables iterable    要操作的列表
         '''
-        self.map(func, *iterables, async=True)
+        self.map(func, *iterables, async_=True)
 
     def _map_fetch(self, maps):
-        '''获取map执行结果
+        '''获取map执行结果，有任务抛出异常时重新抛出
         参数说明：
         maps iterable    任务对象列表
         '''
-        while True:
-            if all(map(lambda x:x.is_done, maps)):
-                results = list(map(lambda x:x.result, maps))
-                self.results = results
-                return results
+        results = [task.get() for task in maps]
+        self.results = results
+        return results
 
     def __enter__(self):
         return self
@@ -187,4 +231,4 @@ if __name__ == '__main__':
         p.map_async(print, range(10))
     print('running:',p.running())
     p.join()
-    print('All done!')
\ No newline at end of file
+    print('All done!')
@@ -0,0 +1,122 @@
+# 链接规范化，将等价的链接转换为同一形式，减少重复下载
+
+import re
+from fnmatch import fnmatchcase
+from urllib.parse import urlsplit, urlunsplit
+
+__all__ = ('Canonicalizer', 'canonicalize', 'TRACKING_PARAMS')
+
+# 常见的跟踪参数，可传给Canonicalizer的strip参数
+TRACKING_PARAMS = ('utm_*', 'gclid', 'fbclid', 'msclkid', 'yclid', 'spm', '_ga', 'mc_cid', 'mc_eid')
+
+_default_ports = {'http': 80, 'https': 443}
+_pct = re.compile('%([0-9A-Fa-f]{2})')
+_unreserved = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+
+def _normalize_pct(text):
+    # 解码不需要转义的字符，其余转义序列统一为大写
+    def sub(m):
+        char = chr(int(m.group(1), 16))
+        return char if char in _unreserved else '%' + m.group(1).upper()
+    return _pct.sub(sub, text) if '%' in text else text
+
+def _remove_dot_segments(path):
+    # RFC 3986 5.2.4
+    if '.' not in path:
+        return path
+    output = []
+    for segment in path.split('/'):
+        if segment == '..':
+            if len(output) > 1:
+                output.pop()
+        elif segment != '.':
+            output.append(segment)
+    if path.endswith(('/.', '/..')):
+        output.append('')
+    return '/'.join(output)
+
+class Canonicalizer(object):
+    '''链接规范化：协议与主机名转小写，去掉默认端口、锚点与末尾的/，解析路径中的.和..，
+    统一百分号转义，可选地排序查询参数、去掉指定的查询参数
+    对象属性说明：
+    sort_query bool     是否按参数名排序查询参数
+    strip      tuple    要去掉的查询参数名，支持通配符，如utm_*
+    '''
+
+    def __init__(self, sort_query=False, strip=()):
+        '''参数说明：
+        sort_query bool        是否按参数名排序查询参数，可选，默认为False
+        strip      iterable    要去掉的查询参数名，支持通配符，可选
+        '''
+        self.sort_query = sort_query
+        self.strip = tuple(strip)
+
+    def _stripped(self, name):
+        return any(fnmatchcase(name.lower(), pattern.lower()) for pattern in self.strip)
+
+    def _query(self, query):
+        params = [_normalize_pct(i) for i in query.split('&') if i]
+        if self.strip:
+            params = [i for i in params if not self._stripped(i.split('=', 1)[0])]
+        if self.sort_query:
+            params.sort(key=lambda i:i.split('=', 1)[0]) # 稳定排序，同名参数保持原有顺序
+        return '&'.join(params)
+
+    def __call__(self, url):
+        '''返回规范化后的链接，非http/https链接只去掉锚点'''
+        try:
+            parsed = urlsplit(url)
+        except ValueError:
+            return url
+        scheme = parsed.scheme.lower()
+        if scheme not in _default_ports:
+            return url.split('#', 1)[0]
+        netloc = parsed.netloc
+        userinfo, at, hostport = netloc.rpartition('@')
+        host, colon, port = hostport.rpartition(':') if hostport.rfind(':') > hostport.rfind(']') \
+            else (hostport, '', '')
+        host = host.lower().rstrip('.')
+        if port and port.isdigit() and int(port) == _default_ports[scheme]:
+            colon = port = ''
+        netloc = userinfo + at + host + colon + port
+        path = _remove_dot_segments(_normalize_pct(parsed.path))
+        while path.endswith('/'):
+            path = path[:-1]
+        query = self._query(parsed.query)
+        return urlunsplit((scheme, netloc, path, query, ''))
+
+canonicalize = Canonicalizer()
+
+# 测试用例：(原链接, 规范化结果)，使用Canonicalizer(sort_query=True, strip=TRACKING_PARAMS)
+_CASES = (
+    ('HTTP://Host:80/a/./b?y=1&x=2', 'http://host/a/b?x=2&y=1'),
+    ('http://host/a/b?x=2&y=1', 'http://host/a/b?x=2&y=1'),
+    ('http://HOST.example.COM/', 'http://host.example.com'),
+    ('https://host:443/', 'https://host'),
+    ('https://host:8443/x', 'https://host:8443/x'),
+    ('http://host:8080/a/../b/', 'http://host:8080/b'),
+    ('http://host/a/b/../../c', 'http://host/c'),
+    ('http://host/../a', 'http://host/a'),
+    ('http://host/a/.', 'http://host/a'),
+    ('http://host/%7euser/%41b%2fc', 'http://host/~user/Ab%2Fc'),
+    ('http://host/a%2db?q=%e4%b8%ad', 'http://host/a-b?q=%E4%B8%AD'),
+    ('http://host/p?utm_source=x&id=3&UTM_medium=y', 'http://host/p?id=3'),
+    ('http://host/p?gclid=1', 'http://host/p'),
+    ('http://host/p?b=2&a=1&b=1', 'http://host/p?a=1&b=2&b=1'),
+    ('http://host/p#top', 'http://host/p'),
+    ('http://host./p', 'http://host/p'),
+    ('http://user:Pw@Host:80/p', 'http://user:Pw@host/p'),
+    ('http://[::1]:80/p', 'http://[::1]/p'),
+    ('mailto:a@b.c#x', 'mailto:a@b.c'),
+)
+
+if __name__ == '__main__':
+    canon = Canonicalizer(sort_query=True, strip=TRACKING_PARAMS)
+    failed = 0
+    for url, expected in _CASES:
+        result = canon(url)
+        if result != expected:
+            failed += 1
+            print('FAILED: %s -> %s, expected %s' % (url, result, expected))
+    print('%s/%s cases passed' % (len(_CASES) - failed, len(_CASES)))
+    exit(1 if failed else 0)
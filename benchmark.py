@@ -0,0 +1,763 @@
+#!/usr/bin/env python3
+#coding: utf-8
+# 爬虫性能基准测试
+
+import os
+import sys
+import time
+import getopt
+import tempfile
+import logging
+import re
+import posixpath
+import gzip
+import zlib
+import json
+import importlib.util
+from urllib.parse import unquote
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+_help = '''
+Usage: benchmark.py <name> [options] [--json filepath]
+       benchmark.py compare <old.json> <new.json>
+    --json filepath    同时把结果（含测试参数、Python版本、CPU数与时间）写入JSON文件，-为只输出
+                       JSON到标准输出；compare逐项比较两个JSON文件中的数值结果，用于新旧版本对比。
+Benchmarks:
+    pool               线程池空闲CPU占用及任务吞吐量。
+        --threads number   线程数，默认为20。
+        --tasks number     任务数，默认为100000。
+        --idle seconds     空闲测量时长，默认为1。
+        --module filepath  使用指定文件中的Pool实现（用于新旧版本对比），默认为ThreadPool.py。
+    engine             本地合成站点上threads与asyncio两种爬行引擎的每秒页面数。
+        --pages number     站点页面数，默认为2000。
+        --fanout number    每个页面的链接数，默认为10。
+        --latency seconds  服务器每个请求的延迟，默认为0.05。
+        --threads number   threads引擎的线程数，默认为20。
+        --concurrency n    asyncio引擎的并发连接数，默认为500。
+    db                 不同批量大小下BatchWriter每秒插入记录数，对比逐条提交。
+        --rows number      每组插入记录数，默认为5000。
+        --size bytes       每条记录的html大小，默认为20000。
+        --threads number   并发写入线程数，默认为10。
+        --sync mode        synchronous模式，默认为normal。
+    dbapi              DbHandler批量插入的速度，读取全部页面时select与select_iter的内存峰值。
+        --rows number      记录数，默认为5000。
+        --size bytes       每条记录的html大小，默认为10000。
+        --batch number     每次insert的行数，默认为500。
+        --module filepath  使用指定文件中的DbHandler（用于新旧版本对比），默认为SqliteThreadSafe.py。
+    seen               各种已发现链接集合的内存占用与吞吐量（每种方式在独立进程中测量）。
+        --urls numbers     链接数，逗号分隔，默认为1000000,10000000。
+        --fpr rate         布隆过滤器误判率上限，默认为0.001。
+    canon              链接形式多样的合成站点上，链接规范化前后的下载次数。
+        --pages number     站点页面数，默认为500。
+        --fanout number    每个页面链接的页面数，默认为5。
+    procs              不同解析进程数（--processes）下的每秒页面数，页面较大、解析为瓶颈。
+        --pages number     站点页面数，默认为1000。
+        --fanout number    每个页面的链接数，默认为10。
+        --size bytes       每个页面填充的html大小，默认为100000。
+        --threads number   下载线程数，默认为20。
+        --processes list   解析进程数，逗号分隔，默认为0,1,2,4,8（0为在下载线程中解析）。
+        --parser name      链接解析方式，默认为html。
+    cluster            多个爬虫进程通过--cluster爬行多主机合成站点，与单进程爬行比较页面数
+                       与速度，并检查合并分片后没有重复页面。
+        --pages number     站点页面数，默认为2000。
+        --fanout number    每个页面的链接数，默认为10。
+        --hosts number     站点主机数（127.0.<k*10>.1），默认为16。
+        --latency seconds  服务器每个请求的延迟，默认为0.02。
+        --threads number   每个进程的线程数，默认为10。
+        --nodes number     爬虫进程数，默认为4。
+        --transport name   协调方式，sqlite（共享的SQLite文件）或tcp（本机的CoordinatorServer），默认为sqlite。
+    log                各日志级别（-l）下的每秒页面数，日志写入文件并输出到控制台（丢弃）。
+        --pages number     站点页面数，默认为2000。
+        --fanout number    每个页面的链接数，默认为10。
+        --threads number   线程数，默认为20。
+        --levels list      日志级别，逗号分隔，默认为1,2,3,4,5。
+        --spider filepath  使用指定的spider.py（用于新旧版本对比），默认为当前版本。
+    parse              HTMLParser与字节级正则两种链接解析方式的速度及结果一致性。
+        --corpus dir       页面语料目录（递归读取其中的*.html），默认使用合成页面。
+        --files number     最多读取的页面数，默认为500。
+        --repeat number    重复次数，默认为3。
+    keywords           多关键词匹配：Keywords选用的匹配器（关键词多于80个时为Aho-Corasick自动机）
+                       与逐个关键词查找的速度及结果一致性。
+        --corpus dir       页面语料目录，默认使用合成页面。
+        --files number     最多读取的页面数，默认为500。
+        --terms list       关键词数，逗号分隔，默认为1,10,100,1000。
+    crawl              在本地合成站点上端到端爬行：每秒页面数、抓取延迟p50/p99、错误数、CPU时间
+                       与内存峰值（每个引擎在独立进程中运行）。
+        --pages number     站点页面数，默认为2000。
+        --fanout number    每个页面的链接数，默认为10。
+        --size bytes       每个页面填充的html大小，默认为10000。
+        --charsets list    页面编码，逗号分隔，多个时轮换声明方式（响应头/meta/须检测），
+                           默认为utf-8,gbk,latin-1。
+        --gzip 0|1         是否gzip压缩响应体，默认为1。
+        --latency seconds  服务器每个请求的延迟，默认为0.01。
+        --errors rate      返回500/404的页面比例，默认为0.01。
+        --threads number   threads引擎的线程数，默认为20。
+        --engines list     爬行引擎，逗号分隔，默认为threads,asyncio。
+        --concurrency n    asyncio引擎的并发连接数，默认为200。
+        --store mode       页面存储方式，默认为raw。
+    micro              各组件的微基准：AnchorParser两种解析方式、get_charset（有meta声明/须检测）、
+                       线程池空任务吞吐量、_db.Writer写入页面（raw/zlib）。
+        --files number     合成页面数，默认为500。
+        --repeat number    解析与编码检测的重复次数，默认为3。
+        --tasks number     线程池任务数，默认为100000。
+        --rows number      写入的页面数，默认为5000。
+'''
+
+def _load(name, path):
+    '''从指定文件加载模块'''
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def _report(name, result):
+    print('[%s]' % name)
+    for key, value in result.items():
+        if type(value) == float:
+            value = '%.4f' % value
+        print('    %-28s %s' % (key, value))
+
+def bench_pool(threads=20, tasks=100000, idle=1.0, module=None):
+    '''线程池基准：空闲时的CPU占用率，以及空任务吞吐量'''
+    if module:
+        Pool = _load('_bench_pool', module).Pool
+    else:
+        from ThreadPool import Pool
+    pool = Pool(threads)
+    time.sleep(0.2) # 等待线程启动
+    cpu, wall = time.process_time(), time.perf_counter()
+    time.sleep(idle)
+    idle_cpu = (time.process_time() - cpu) / (time.perf_counter() - wall)
+    noop = lambda x:x
+    cpu, wall = time.process_time(), time.perf_counter()
+    for i in range(tasks):
+        pool.add(noop, (i,))
+    pool.close()
+    pool.join()
+    elapsed = time.perf_counter() - wall
+    return {
+        'threads': threads,
+        'tasks': tasks,
+        'idle_cpu_percent': idle_cpu * 100,
+        'tasks_per_sec': tasks / elapsed,
+        'cpu_seconds': time.process_time() - cpu,
+    }
+
+class _SiteHandler(BaseHTTPRequestHandler):
+    '''合成站点：/p<i>.html页面链接到确定的fanout个其他页面，
+    variants为真时每个链接以多种等价形式出现（大小写、默认端口、.和..、百分号转义、
+    参数顺序、跟踪参数），size为每个页面填充的html字节数，hosts大于1时页面j位于
+    主机127.0.<(j%hosts)*10>.1（各主机的域名都以0.1结尾，可被同一个爬虫爬取）；
+    charsets为逗号分隔的页面编码，页面i使用第i%n个，有多个编码时依次轮换编码的声明方式
+    （响应头、只有meta、都没有须检测），gzip为真时按请求压缩响应体，errors为返回错误的页面
+    比例（500与404各半，首页除外）；同一配置下每个页面的内容与结果都是确定的
+    '''
+
+    pages = 2000
+    fanout = 10
+    latency = 0.0
+    variants = False
+    size = 0
+    hosts = 1
+    charsets = 'utf-8'
+    gzip = False
+    errors = 0.0
+    _texts = {'utf-8': '合成页面', 'gbk': '合成页面', 'gb2312': '合成页面', 'big5': '合成頁面',
+              'shift_jis': '合成ページ', 'latin-1': 'page synthétique', 'iso-8859-1': 'page synthétique'}
+    _cache = {} # {(页面, 是否压缩): (状态码, 响应头, 响应体)}
+    _filler = '<div class="row"><span>lorem</span> <b>ipsum</b> dolor <i>sit</i> amet</div>\n'
+    _variants = ('{s}://{h}/p{j}.html', '{S}://{H}/x/../p{j}.html', '/./p{j}.html?b=2&a=1',
+                 '/p{j}.html?a=1&b=2', '/%70{j}.html', '/p{j}.html?utm_source=bench#top')
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True # 长连接下避免响应头与响应体分两次发送时的延迟确认等待
+
+    def do_GET(self):
+        path = posixpath.normpath(unquote(self.path.split('?', 1)[0]))
+        m = re.match(r'/p(\d+)\.html$', path)
+        i = int(m.group(1)) if m else (0 if path == '/' else self.pages)
+        if not 0 <= i < self.pages:
+            self.send_error(404)
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        if i and self.errors and zlib.crc32(b'%d' % i) / 2**32 < self.errors:
+            self.send_error(500 if i % 2 else 404)
+            return
+        if self.variants or self.hosts > 1: # 页面内容与请求的Host有关，不缓存
+            status, headers, body = self._page(i)
+        else:
+            key = (i, self.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''))
+            if key not in self._cache:
+                self._cache[key] = self._page(i)
+            status, headers, body = self._cache[key]
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _page(self, i):
+        # 返回页面i的(状态码, 响应头, 响应体)
+        targets = [(i * self.fanout + k + 1) % self.pages for k in range(self.fanout)]
+        if self.variants:
+            host = self.headers.get('Host', '')
+            links = ''.join('<a href="%s">page %d</a>\n' % (v.format(s='http', S='HTTP', h=host, H=host.upper(),
+                            j=j), j) for j in targets for v in self._variants)
+        elif self.hosts > 1:
+            port = self.server.server_address[1]
+            links = ''.join('<a href="http://%s:%d/p%d.html">page %d</a>\n' % (_site_host(j, self.hosts), port, j, j)
+                            for j in targets)
+        else:
+            links = ''.join('<a href="/p%d.html">page %d</a>\n' % (j, j) for j in targets)
+        filler = self._filler * (self.size // len(self._filler))
+        charsets = self.charsets.split(',')
+        charset = charsets[i % len(charsets)]
+        declare = (i // len(charsets)) % 3 if len(charsets) > 1 else 0 # 0响应头与meta，1只有meta，2都没有
+        meta = '<meta charset="%s">' % charset if declare < 2 else ''
+        text = self._texts.get(charset.lower(), 'synthetic page')
+        body = ('<html><head>%s<title>page %d</title></head>'
+                '<body><p>%s %d</p>\n%s%s</body></html>' % (meta, i, text, i, filler, links)).encode(charset)
+        headers = [('Content-Type', 'text/html; charset=%s' % charset if declare == 0 else 'text/html')]
+        if self.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, 6)
+            headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('Content-Length', str(len(body))))
+        return 200, headers, body
+
+    def log_message(self, *args):
+        pass
+
+class _SiteServer(ThreadingHTTPServer):
+    request_queue_size = 1024
+    daemon_threads = True
+
+def _site_host(page, hosts):
+    return '127.0.%d.1' % (page % hosts * 10)
+
+def _serve(port, config):
+    import threading
+    for key, value in config.items():
+        setattr(_SiteHandler, key, value)
+    servers = [_SiteServer((_site_host(k, _SiteHandler.hosts), port), _SiteHandler) for k in range(_SiteHandler.hosts)]
+    for server in servers[1:]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    servers[0].serve_forever()
+
+def start_site(**config):
+    '''在子进程中启动合成站点，返回(进程, 首页url)'''
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    proc = multiprocessing.Process(target=_serve, args=(port, config), daemon=True)
+    proc.start()
+    for i in range(100): # 等待服务器就绪
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return proc, 'http://127.0.0.1:%d/p0.html' % port
+
+def _crawl(cls, url, threads, **kwargs):
+    '''完整爬行一次，返回(页面数, 秒数)'''
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as tmp:
+        spider = cls(url, 1000, threads, os.path.join(tmp, 'bench.db'), **kwargs)
+        start = time.perf_counter()
+        spider.run()
+        return spider.count, time.perf_counter() - start
+
+def bench_engine(pages=2000, fanout=10, latency=0.05, threads=20, concurrency=500):
+    '''比较threads与asyncio引擎在本地合成站点上的爬行速度'''
+    from spider import Spider, AsyncSpider
+    proc, url = start_site(pages=pages, fanout=fanout, latency=latency)
+    try:
+        result = {'pages': pages, 'fanout': fanout, 'latency': latency}
+        for name, cls, n in (('threads', Spider, threads), ('asyncio', AsyncSpider, concurrency)):
+            count, elapsed = _crawl(cls, url, n)
+            result['%s_workers' % name] = n
+            result['%s_pages_per_sec' % name] = count / elapsed
+    finally:
+        proc.terminate()
+    return result
+
+def bench_db(rows=5000, size=20000, threads=10, sync='normal'):
+    '''BatchWriter在不同批量大小下的写入速度，commit_per_row为逐条插入并提交（旧实现）'''
+    import threading
+    from SqliteThreadSafe import BatchWriter, sqlite3
+    html = sqlite3.Binary(os.urandom(size // 2).hex().encode())
+    create = "create table pages (id integer primary key autoincrement, url text, keyword text, html blob)"
+    sql = "insert into pages (url,keyword,html) values(?,?,?)"
+    result = {'rows': rows, 'size': size, 'threads': threads, 'sync': sync}
+
+    def run(name, write, close):
+        per = rows // threads
+        workers = [threading.Thread(target=lambda n: [write('http://h/%d/%d' % (n, i)) for i in range(per)],
+                                    args=(n,)) for n in range(threads)]
+        start = time.perf_counter()
+        for i in workers: i.start()
+        for i in workers: i.join()
+        close()
+        result[name] = per * threads / (time.perf_counter() - start)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'row.db'), check_same_thread=False)
+        conn.execute(create)
+        conn.execute('pragma synchronous=%s' % sync)
+        lock = threading.Lock()
+        def write(url):
+            with lock:
+                conn.execute(sql, (url, '', html))
+                conn.commit()
+        run('commit_per_row_per_sec', write, conn.close)
+        for batch in (1, 10, 100, 500, 2000):
+            dbname = os.path.join(tmp, 'batch%d.db' % batch)
+            sqlite3.connect(dbname).execute(create).connection.close()
+            writer = BatchWriter(dbname, batch, synchronous=sync)
+            run('batch_%d_per_sec' % batch, lambda url: writer.put(sql, (url, '', html)), writer.close)
+    return result
+
+def bench_dbapi(rows=5000, size=10000, batch=500, module=None):
+    '''DbHandler的批量插入速度与读取全部页面时的内存峰值（select与select_iter），
+    --module指定旧版本的SqliteThreadSafe.py用于对比（旧版本没有select_iter）
+    '''
+    import tracemalloc
+    mod = _load('SqliteThreadSafe_under_test', module) if module else importlib.import_module('SqliteThreadSafe')
+    html = os.urandom(size // 2).hex() # 旧版本只能插入字符串
+    result = {'rows': rows, 'size': size, 'module': module or 'SqliteThreadSafe.py'}
+    with tempfile.TemporaryDirectory() as tmp:
+        db = mod.DbHandler(os.path.join(tmp, 'api.db'))
+        db.execute("create table pages (id integer primary key autoincrement, url text, html text)")
+        start = time.perf_counter()
+        for i in range(0, rows, batch):
+            db.insert('pages', 'url,html', [('http://h/%d' % j, html) for j in range(i, min(i + batch, rows))])
+        result['insert_rows_per_sec'] = rows / (time.perf_counter() - start)
+        readers = [('select', lambda:db.select('pages', 'url,html'))]
+        if hasattr(db, 'select_iter'):
+            readers.append(('select_iter', lambda:db.select_iter('pages', ['url', 'html'])))
+        for name, read in readers:
+            tracemalloc.start()
+            start = time.perf_counter()
+            n = sum(len(row[1]) > 0 for row in read())
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            result['%s_rows_per_sec' % name] = n / elapsed
+            result['%s_peak_mb' % name] = peak / 2**20
+        db.close()
+    return result
+
+def _rss():
+    '''当前进程的常驻内存字节数'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _seen_case(mode, urls, fpr):
+    from spider import _seen_modes, BloomFilter
+    url = 'http://www.example%d.com/path/to/page_%d.html?id=%d'
+    rss = _rss()
+    seen = BloomFilter(fpr) if mode == 'bloom' else _seen_modes[mode]()
+    start = time.perf_counter()
+    for i in range(urls):
+        seen.add(url % (i % 1000, i, i))
+    elapsed = time.perf_counter() - start
+    memory = _rss() - rss
+    probes = 100000
+    false = sum((url % (-1, i, i)) in seen for i in range(probes))
+    return {'adds_per_sec': urls / elapsed, 'bytes_per_url': memory / urls,
+            'memory_mb': memory / 2**20, 'false_positive_rate': false / probes}
+
+def bench_seen(urls='1000000,10000000', fpr=0.001):
+    '''ExactSet/FingerprintSet/BloomFilter在不同规模下的内存与速度'''
+    result = {'fpr': fpr}
+    ctx = multiprocessing.get_context('spawn')
+    for n in map(int, urls.split(',')):
+        for mode in ('set', 'hash', 'bloom'):
+            with ctx.Pool(1) as pool:
+                case = pool.apply(_seen_case, (mode, n, fpr))
+            for key, value in case.items():
+                result['%s_%d_%s' % (mode, n, key)] = value
+    return result
+
+def bench_canon(pages=500, fanout=5):
+    '''在链接形式多样的合成站点上比较链接规范化前后的下载次数'''
+    from spider import Spider
+    from UrlCanon import Canonicalizer, TRACKING_PARAMS
+    proc, url = start_site(pages=pages, fanout=fanout, variants=True)
+    try:
+        fetched, elapsed = _crawl(Spider, url, 10, canonicalize=lambda link:link)
+        canonical, elapsed = _crawl(Spider, url, 10, canonicalize=Canonicalizer(True, TRACKING_PARAMS))
+    finally:
+        proc.terminate()
+    return {'pages': pages, 'link_forms': len(_SiteHandler._variants),
+            'fetched_without_canon': fetched, 'fetched_with_canon': canonical,
+            'duplicates_removed': fetched - canonical}
+
+def bench_procs(pages=1000, fanout=10, size=100000, threads=20, processes='0,1,2,4,8', parser='html'):
+    '''解析进程数对爬行速度的影响，speedup为相对于在下载线程中解析（0）的倍数'''
+    from spider import Spider
+    proc, url = start_site(pages=pages, fanout=fanout, size=size)
+    try:
+        result = {'pages': pages, 'page_size': size, 'parser': parser, 'cpus': os.cpu_count()}
+        base = None
+        for n in map(int, processes.split(',')):
+            count, elapsed = _crawl(Spider, url, threads, processes=n, parser=parser)
+            rate = count / elapsed
+            base = base or rate
+            result['processes_%d_pages_per_sec' % n] = rate
+            result['processes_%d_speedup' % n] = rate / base
+    finally:
+        proc.terminate()
+    return result
+
+def _cluster_node(url, threads, dbname, path, node, nodes):
+    logging.disable(logging.CRITICAL)
+    from spider import Spider
+    from Cluster import connect
+    cluster = connect(path, node, nodes)
+    Spider(url, 1000, threads, dbname, cluster=cluster).run()
+    cluster.close()
+
+def bench_cluster(pages=2000, fanout=10, hosts=16, latency=0.02, threads=10, nodes=4, transport='sqlite'):
+    '''多个爬虫进程共同爬行多主机站点，合并分片后检查页面数与单进程爬行一致且无重复，
+    transport为sqlite时通过共享的SQLite文件协调，为tcp时通过本机的CoordinatorServer协调'''
+    import sqlite3
+    import threading
+    from spider import Spider
+    from Cluster import CoordinatorServer, merge, shard_name
+    if transport not in ('sqlite', 'tcp'):
+        raise ValueError('transport must be sqlite or tcp')
+    proc, url = start_site(pages=pages, fanout=fanout, hosts=hosts, latency=latency)
+    server = None
+    try:
+        result = {'pages': pages, 'hosts': hosts, 'nodes': nodes, 'transport': transport}
+        count, elapsed = _crawl(Spider, url, threads)
+        result['single_pages'] = count
+        result['single_pages_per_sec'] = count / elapsed
+        with tempfile.TemporaryDirectory() as tmp:
+            dbname = os.path.join(tmp, 'bench.db')
+            path = os.path.join(tmp, 'cluster.db')
+            if transport == 'tcp':
+                server = CoordinatorServer(('127.0.0.1', 0), nodes)
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                path = 'tcp://127.0.0.1:%d' % server.server_address[1]
+            start = time.perf_counter()
+            procs = [multiprocessing.Process(target=_cluster_node, args=(url, threads, shard_name(dbname, i), path, i, nodes))
+                     for i in range(nodes)]
+            for p in procs:
+                p.start()
+            for p in procs:
+                p.join()
+            elapsed = time.perf_counter() - start
+            shards = [shard_name(dbname, i) for i in range(nodes)]
+            counts = merge(dbname, shards)
+            table = min((name for name in counts if not name.startswith('sqlite_')), key=len) # 页面表'_<主机>'
+            rows = 0
+            for i, shard in enumerate(shards):
+                conn = sqlite3.connect(shard)
+                n = conn.execute("select count(*) from '%s'" % table).fetchone()[0]
+                conn.close()
+                result['node%d_pages' % i] = n
+                rows += n
+            merged = counts[table]
+        result['cluster_pages'] = rows
+        result['cluster_pages_per_sec'] = rows / elapsed
+        result['duplicates'] = rows - merged
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        proc.terminate()
+    return result
+
+def _log_case(url, threads, level, spider, tmp):
+    # 在独立进程中按spider.py的_setlog配置日志（文件+控制台，控制台输出丢弃）后完整爬行一次
+    sys.stderr = open(os.devnull, 'w')
+    module = _load('spider_under_test', spider) if spider else importlib.import_module('spider')
+    logfile = os.path.join(tmp, 'log%d.txt' % level)
+    listener = module._setlog(level, logfile)
+    crawler = module.Spider(url, 1000, threads, os.path.join(tmp, 'log%d.db' % level))
+    start = time.perf_counter()
+    crawler.run()
+    elapsed = time.perf_counter() - start
+    flush = time.perf_counter()
+    if listener: # 队列中剩余的日志写完所需时间
+        listener.stop()
+    flush = time.perf_counter() - flush
+    return {'pages_per_sec': crawler.count / elapsed, 'log_flush_sec': flush,
+            'log_mb': os.path.getsize(logfile) / 2**20}
+
+def bench_log(pages=2000, fanout=10, threads=20, levels='1,2,3,4,5', spider=None):
+    '''各日志级别下的爬行速度（写日志文件并输出到控制台），--spider指定旧版本的spider.py用于对比'''
+    proc, url = start_site(pages=pages, fanout=fanout)
+    result = {'pages': pages, 'spider': spider or 'spider.py'}
+    ctx = multiprocessing.get_context('spawn')
+    try:
+        for level in map(int, levels.split(',')):
+            with tempfile.TemporaryDirectory() as tmp, ctx.Pool(1) as pool:
+                case = pool.apply(_log_case, (url, threads, level, spider, tmp))
+            for key, value in case.items():
+                result['level_%d_%s' % (level, key)] = value
+    finally:
+        proc.terminate()
+    return result
+
+def _corpus(corpus=None, files=500):
+    '''读取页面语料，未指定目录时生成合成页面'''
+    if corpus:
+        import glob
+        paths = sorted(glob.glob(os.path.join(corpus, '**', '*.html'), recursive=True))[:files]
+        pages = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                pages.append(f.read())
+        return pages
+    pages = []
+    for i in range(files):
+        text = ''.join('<p class="c%d">段落 %d 的内容 lorem ipsum dolor sit amet</p>\n' % (k, k) for k in range(i % 50 + 20))
+        links = ''.join('<li><a href="/p%d.html" title="page %d">page %d</a></li>\n' % (k, k, k)
+                        for k in range(i, i + 40))
+        pages.append(('<html><head><meta charset="utf-8"><script>var x = "<a href=/no>";</script>'
+                      '<link rel="stylesheet" href="/s.css"></head><body><div>%s</div><ul>%s</ul>'
+                      '<img src="/i%d.png"></body></html>' % (text, links, i)).encode('utf-8'))
+    return pages
+
+def bench_parse(corpus=None, files=500, repeat=3):
+    '''比较两种链接解析方式在语料上的速度，并检查结果是否一致'''
+    from AnchorParser import parsers
+    pages = _corpus(corpus, files)
+    size = sum(map(len, pages))
+    url = 'http://www.example.com/dir/page.html'
+    result = {'pages': len(pages), 'corpus_mb': size / 2**20}
+    for name, parse in sorted(parsers.items()):
+        start = time.perf_counter()
+        for i in range(repeat):
+            links = [parse(page, url, 'utf-8', False) for page in pages]
+        elapsed = (time.perf_counter() - start) / repeat
+        result['%s_pages_per_sec' % name] = len(pages) / elapsed
+        result['%s_mb_per_sec' % name] = size / 2**20 / elapsed
+        result['%s_links' % name] = sum(map(len, links))
+    result['mismatched_pages'] = sum(parsers['html'](page, url, 'utf-8', static_res) !=
+                                     parsers['fast'](page, url, 'utf-8', static_res)
+                                     for page in pages for static_res in (False, True))
+    return result
+
+def bench_keywords(corpus=None, files=500, terms='1,10,100,1000'):
+    '''比较Keywords选用的匹配器（关键词多时为自动机）与逐个关键词查找的匹配速度'''
+    import random
+    from Keywords import Keywords
+    pages = _corpus(corpus, files)
+    size = sum(map(len, pages)) / 2**20
+    random.seed(0)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    result = {'pages': len(pages), 'corpus_mb': size}
+    for n in map(int, terms.split(',')):
+        words = ['lorem', '段落 7 的', 'page 1'][:n] # 语料中出现的关键词
+        while len(words) < n:
+            words.append(''.join(random.choice(letters) for i in range(random.randint(4, 10))))
+        keywords = Keywords(words)
+        start = time.perf_counter()
+        matcher, index = keywords.compile('utf-8')
+        result['n%s_matcher' % n] = type(matcher).__name__
+        result['n%s_compile_ms' % n] = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        found = [keywords.matched(matcher.findall(page), index) for page in pages]
+        elapsed = time.perf_counter() - start
+        result['n%s_matcher_mb_per_sec' % n] = size / elapsed
+        encoded = [i.encode('utf-8') for i in keywords.terms]
+        start = time.perf_counter()
+        expected = [[t for t, e in zip(keywords.terms, encoded) if e in page] for page in pages]
+        elapsed = time.perf_counter() - start
+        result['n%s_find_mb_per_sec' % n] = size / elapsed
+        result['n%s_mismatched_pages' % n] = sum(a != b for a, b in zip(found, expected))
+    return result
+
+def _peak_rss():
+    '''当前进程的内存峰值字节数，不支持时返回None'''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # macOS单位为字节，Linux为KB
+
+def _crawl_case(url, engine, threads, kwargs):
+    '''在独立进程中完整爬行一次，返回速度、抓取延迟分位数、CPU时间与内存峰值'''
+    from spider import Spider, AsyncSpider
+    logging.disable(logging.CRITICAL)
+    cls = AsyncSpider if engine == 'asyncio' else Spider
+    with tempfile.TemporaryDirectory() as tmp:
+        spider = cls(url, 1000, threads, os.path.join(tmp, 'bench.db'), **kwargs)
+        cpu, start = time.process_time(), time.perf_counter()
+        spider.run()
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+    peak = _peak_rss()
+    return {
+        'pages': spider.count,
+        'seconds': elapsed,
+        'pages_per_sec': spider.count / elapsed,
+        'fetch_p50_ms': 1000 * (spider.m_fetch.quantile(0.5) or 0.0),
+        'fetch_p99_ms': 1000 * (spider.m_fetch.quantile(0.99) or 0.0),
+        'errors': sum(spider._errors().values()),
+        'cpu_seconds': cpu,
+        'cpu_percent': 100 * cpu / elapsed,
+        'peak_rss_mb': peak / 2**20 if peak else None,
+    }
+
+def bench_crawl(pages=2000, fanout=10, size=10000, charsets='utf-8,gbk,latin-1', gzip=1, latency=0.01,
+                errors=0.01, threads=20, engines='threads,asyncio', concurrency=200, store='raw'):
+    '''在本地合成站点上端到端爬行，每个引擎在独立进程中运行，CPU时间与内存峰值只含爬虫进程'''
+    proc, url = start_site(pages=pages, fanout=fanout, size=size, charsets=charsets, gzip=bool(gzip),
+                           latency=latency, errors=errors)
+    result = {'pages': pages, 'fanout': fanout, 'size': size, 'charsets': charsets, 'gzip': bool(gzip),
+              'latency': latency, 'errors': errors}
+    ctx = multiprocessing.get_context('spawn')
+    try:
+        for engine in engines.split(','):
+            n = concurrency if engine == 'asyncio' else threads
+            with ctx.Pool(1) as pool:
+                case = pool.apply(_crawl_case, (url, engine, n, {'store': store}))
+            result['%s_workers' % engine] = n
+            for key, value in case.items():
+                result['%s_%s' % (engine, key)] = value
+    finally:
+        proc.terminate()
+    return result
+
+def bench_micro(files=500, repeat=3, tasks=100000, rows=5000):
+    '''各组件的微基准：链接解析、编码检测、线程池与页面写入（_db.Writer）'''
+    import threading
+    from AnchorParser import parsers, get_charset
+    from ThreadPool import Pool
+    from spider import _db
+    pages = _corpus(None, files)
+    size = sum(map(len, pages)) / 2**20
+    url = 'http://www.example.com/dir/page.html'
+    result = {'pages': len(pages), 'corpus_mb': size}
+
+    def timed(func, n):
+        start = time.perf_counter()
+        for i in range(repeat):
+            func()
+        return n * repeat / (time.perf_counter() - start)
+
+    for name, parse in sorted(parsers.items()):
+        result['parse_%s_pages_per_sec' % name] = timed(lambda:[parse(page, url, 'utf-8', False) for page in pages],
+                                                         len(pages))
+    # 有meta声明的页面只需查找声明，没有声明的中文GBK页面需要chardet检测
+    detect = [page.replace(b'<meta charset="utf-8">', b'').decode('utf-8').encode('gbk') for page in pages[:50]]
+    result['charset_meta_pages_per_sec'] = timed(lambda:[get_charset(page) for page in pages], len(pages))
+    result['charset_detect_pages_per_sec'] = timed(lambda:[get_charset(page) for page in detect], len(detect))
+    pool = Pool(20)
+    noop = lambda x:x
+    start = time.perf_counter()
+    for i in range(tasks):
+        pool.add(noop, (i,))
+    pool.close()
+    pool.join()
+    result['pool_tasks_per_sec'] = tasks / (time.perf_counter() - start)
+    with tempfile.TemporaryDirectory() as tmp:
+        for store in ('raw', 'zlib'):
+            db = _db('bench', os.path.join(tmp, '%s.db' % store), store=store)
+            start = time.perf_counter()
+            for i in range(rows):
+                with db.get_writer('http://bench/p%d.html' % i, '') as f:
+                    f.write(pages[i % len(pages)])
+            db.close()
+            result['writer_%s_rows_per_sec' % store] = rows / (time.perf_counter() - start)
+    return result
+
+_benchmarks = {
+    'pool': (bench_pool, {'--threads': ('threads', int), '--tasks': ('tasks', int),
+                          '--idle': ('idle', float), '--module': ('module', str)}),
+    'engine': (bench_engine, {'--pages': ('pages', int), '--fanout': ('fanout', int),
+                              '--latency': ('latency', float), '--threads': ('threads', int),
+                              '--concurrency': ('concurrency', int)}),
+    'db': (bench_db, {'--rows': ('rows', int), '--size': ('size', int), '--threads': ('threads', int),
+                      '--sync': ('sync', str)}),
+    'dbapi': (bench_dbapi, {'--rows': ('rows', int), '--size': ('size', int), '--batch': ('batch', int),
+                            '--module': ('module', str)}),
+    'seen': (bench_seen, {'--urls': ('urls', str), '--fpr': ('fpr', float)}),
+    'canon': (bench_canon, {'--pages': ('pages', int), '--fanout': ('fanout', int)}),
+    'procs': (bench_procs, {'--pages': ('pages', int), '--fanout': ('fanout', int), '--size': ('size', int),
+                            '--threads': ('threads', int), '--processes': ('processes', str),
+                            '--parser': ('parser', str)}),
+    'cluster': (bench_cluster, {'--pages': ('pages', int), '--fanout': ('fanout', int), '--hosts': ('hosts', int),
+                                '--latency': ('latency', float), '--threads': ('threads', int),
+                                '--nodes': ('nodes', int), '--transport': ('transport', str)}),
+    'log': (bench_log, {'--pages': ('pages', int), '--fanout': ('fanout', int), '--threads': ('threads', int),
+                        '--levels': ('levels', str), '--spider': ('spider', str)}),
+    'parse': (bench_parse, {'--corpus': ('corpus', str), '--files': ('files', int), '--repeat': ('repeat', int)}),
+    'keywords': (bench_keywords, {'--corpus': ('corpus', str), '--files': ('files', int), '--terms': ('terms', str)}),
+    'crawl': (bench_crawl, {'--pages': ('pages', int), '--fanout': ('fanout', int), '--size': ('size', int),
+                            '--charsets': ('charsets', str), '--gzip': ('gzip', int), '--latency': ('latency', float),
+                            '--errors': ('errors', float), '--threads': ('threads', int),
+                            '--engines': ('engines', str), '--concurrency': ('concurrency', int),
+                            '--store': ('store', str)}),
+    'micro': (bench_micro, {'--files': ('files', int), '--repeat': ('repeat', int), '--tasks': ('tasks', int),
+                            '--rows': ('rows', int)}),
+}
+
+def _compare(old, new):
+    '''逐项比较两次结果中的数值，输出旧值、新值与变化百分比'''
+    with open(old, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new, encoding='utf-8') as f:
+        new = json.load(f)
+    if old.get('benchmark') != new.get('benchmark'):
+        print('Warning: comparing %s with %s' % (old.get('benchmark'), new.get('benchmark')))
+    for report in (old, new):
+        print('%-8s %s, python %s, %s cpus, %s' % (report.get('benchmark'), report.get('time'),
+              report.get('python'), report.get('cpus'), report.get('options')))
+    a, b = old.get('result', {}), new.get('result', {})
+    for key in list(a) + [k for k in b if k not in a]:
+        x, y = a.get(key), b.get(key)
+        if type(x) in (int, float) and type(y) in (int, float) and x:
+            print('    %-28s %14.4f %14.4f %+8.1f%%' % (key, x, y, 100.0 * (y - x) / x))
+        elif x != y:
+            print('    %-28s %14s %14s' % (key, x, y))
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == 'compare':
+        _compare(sys.argv[2], sys.argv[3])
+        return
+    if len(sys.argv) < 2 or sys.argv[1] not in _benchmarks:
+        print(_help)
+        exit(1)
+    name = sys.argv[1]
+    func, options = _benchmarks[name]
+    try:
+        opts, args = getopt.getopt(sys.argv[2:], '', [i[2:] + '=' for i in options] + ['json='])
+    except getopt.GetoptError as e:
+        print('Error:', e)
+        exit(1)
+    kwargs = {}
+    output = None
+    for key, value in opts:
+        if key == '--json':
+            output = value
+            continue
+        arg, conv = options[key]
+        kwargs[arg] = conv(value)
+    result = func(**kwargs)
+    if output != '-':
+        _report(name, result)
+    if output:
+        report = json.dumps({'benchmark': name, 'options': kwargs, 'result': result,
+                             'python': sys.version.split()[0], 'platform': sys.platform, 'cpus': os.cpu_count(),
+                             'time': time.strftime('%Y-%m-%dT%H:%M:%S')}, indent=2, ensure_ascii=False)
+        if output == '-':
+            print(report)
+        else:
+            with open(output, 'w', encoding='utf-8') as f:
+                f.write(report + '\n')
+
+if __name__ == '__main__':
+    main()
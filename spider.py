@@ -5,91 +5,368 @@
 import os
 import sys
 import getopt
+import threading
+import queue
+import json
+import pickle
+import atexit
+import itertools
+import asyncio
+import hashlib
+import zlib
+import lzma
+import math
+import time
+from array import array
 import logging as _log
+from logging.handlers import QueueHandler, QueueListener
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from string import printable
 from urllib import request as urllib
-from gzip import GzipFile
-from io import BytesIO
-from SqliteThreadSafe import DbHandler, sqlite3
-from ThreadPool import Pool, Lock
-from AnchorParser import AnchorParser, get_charset
+from collections import deque, OrderedDict
+from functools import lru_cache
+from heapq import heappush, heappop
+from SqliteThreadSafe import DbHandler, BatchWriter, sqlite3
+from ThreadPool import Pool, Lock, Condition
+from AnchorParser import get_charset, parsers
+from http.client import HTTPException
+from HttpPool import HttpPool, HTTPError
+from HostScheduler import HostScheduler
+import AsyncHttp
+from UrlCanon import Canonicalizer, TRACKING_PARAMS
+from Cluster import connect, shard_name
+from Metrics import Registry, serve as serve_metrics
+from Mirror import Mirror
+from FullText import Indexer, search as search_index
+from Keywords import Keywords, load_keywords
+from SimHash import SimHashIndex, fingerprint
 
 _help = '''
 Usage: spider.py [-u url] [-d deep] [-f logfile] [-l loglevel(1-5)]
-                 [--thread number] [--dbfile filepath] [--key="<keyword>"]
-                 [--pridomain/-p] [--download/-D] [--testself]
+                 [--thread number] [--dbfile filepath] [--key="<keyword>[,...]"]
+                 [--keyfile filepath]
+                 [--pridomain/-p] [--download/-D] [--order bfs|dfs|best]
+                 [--engine threads|asyncio] [--hostconns number] [--idle seconds]
+                 [--batch number] [--sync off|normal|full] [--store raw|zlib|lzma]
+                 [--level number] [--resume] [--seen set|hash|bloom] [--fpr rate]
+                 [--sortquery] [--strip params] [--parser html|fast] [--maxsize bytes]
+                 [--hostmax number] [--delay seconds] [--adaptive] [--retries number]
+                 [--incremental] [--processes number]
+                 [--cluster filepath|tcp://host:port --node index --nodes number [--cluster-run id]]
+                 [--metrics port] [--progress seconds] [--logformat text|json]
+                 [--hardlink] [--index] [--query="<terms>" [--limit number]]
+                 [--neardup bits] [--neardup-nofollow]
+                 [--testself]
 Options: 
     -h, --help         查看帮助信息。
-    -u url             指定爬虫开始地址，必选参数。
+    -u url             指定爬虫开始地址，必选参数（使用--query时不需要）。
     -d deep            指定爬虫深度，可选参数，默认为7。
     -f logfile         保存日志到指定文件，可选参数，默认为spider.log。
     -l loglevel(1-5)   日志记录文件记录详细程度，数字越大记录越详细，可选参数，默认为5。
+                       日志由后台线程写入，不阻塞爬行；逐条链接的LINK日志每100条记录1条，
+                       每个页面另有一行汇总。
     --thread number    指定线程池大小，多线程爬取页面，可选参数，默认为10。
     --dbfile filepath  存放结果数据到指定的数据库（sqlite）文件中，可选参数，默认为data.db。
-    --key="<keyword>"  页面内的关键词，获取满足该关键词的网页，可选参数，默认为所有页面。
+    --key="<keyword>"  页面内的关键词，获取满足该关键词的网页，多个关键词以逗号分隔，页面包含
+                       其中任一个即保存，页面表的keyword列记录找到的全部关键词（逗号分隔），
+                       可选参数，默认为所有页面。
+    --keyfile filepath 从文件读取关键词（UTF-8，每行一个，忽略空行与#开头的行），可与--key
+                       同时使用；关键词较多时编译为一个自动机，一次扫描页面即可全部匹配，
+                       可选参数。
     --pridomain/-p     仅爬行主域名，可选参数，默认爬行主域名及所有子域名链接。
-    --download/-D      下载网站所有资源到本地文件夹，可选参数。
+    --download/-D      下载网站所有资源到本地文件夹，可选参数。文件由后台线程写入当前目录下以
+                       主机名命名的目录，链接与文件的对应关系记录在manifest.jsonl中。
+    --order mode       爬行顺序，bfs为广度优先，dfs为深度优先，best为最佳优先（优先爬取
+                       命中关键词的页面中的链接，再按深度由浅到深），可选参数，默认为bfs。
+    --engine name      爬行引擎，threads为线程池，asyncio为单线程事件循环（此时--thread
+                       指定并发连接数，可设为数千），可选参数，默认为threads。
+    --hostconns number 每个主机的最大长连接数，可选参数，默认与线程池大小相同。
+    --idle seconds     空闲长连接的超时秒数，可选参数，默认为30。
+    --batch number     数据库每个事务批量写入的最大记录数，可选参数，默认为500。
+    --sync mode        数据库synchronous模式（off/normal/full），可选参数，默认为normal。
+    --store mode       页面存储方式，raw为原样保存，zlib/lzma为按内容摘要去重并压缩保存，
+                       可选参数，默认为raw。
+    --level number     zlib/lzma压缩级别（0-9），可选参数，默认为6。
+    --resume           从数据库中保存的爬行状态继续上次中断的爬行，已处理的链接不再下载，
+                       可选参数。
+    --seen mode        已发现链接的去重方式，set为保存完整链接，hash为保存64位指纹，
+                       bloom为可扩展布隆过滤器（有少量误判），可选参数，默认为set。
+    --fpr rate         布隆过滤器的误判率上限，可选参数，默认为0.001。
+    --sortquery        规范化链接时按参数名排序查询参数，可选参数。
+    --strip params     规范化链接时去掉的查询参数，逗号分隔，支持通配符，tracking表示常见
+                       跟踪参数（utm_*、gclid等），例：--strip="tracking,sid"，可选参数。
+    --parser name      链接解析方式，html为HTMLParser，fast为字节级正则提取（不解码整个页面），
+                       可选参数，默认为html。
+    --maxsize bytes    响应体（解压后）的大小上限，超过时放弃该链接，0为不限制，可选参数，
+                       默认为16777216（16MB）。
+    --hostmax number   每个主机的最大并发请求数，可选参数，默认与线程池大小相同。
+    --delay seconds    同一主机两次请求之间的最小间隔秒数，可选参数，默认为0。
+    --adaptive         根据每个主机的响应延迟与错误率自动调整其并发数（从1开始逐步增加，
+                       不超过--hostmax），可选参数。
+    --retries number   被限流（429/503）的链接按Retry-After等待后的重试次数，可选参数，
+                       默认为3。
+    --incremental      增量爬行：保存页面的ETag、Last-Modified与解析出的链接，再次爬行时发送
+                       条件请求，未改变的页面（304或内容摘要相同）不重新保存，直接使用上次的
+                       链接，可选参数。
+    --processes number 在指定数量的子进程中检测编码并解析页面链接，下载仍在线程或事件循环中
+                       并发进行，结果汇总到同一个待爬队列与数据库，适用于多核机器上解析
+                       成为瓶颈的情况，可选参数，默认为0（在下载线程中解析）。
+    --cluster filepath|tcp://host:port
+                       分布式爬行的协调器：tcp://host:port为“python Cluster.py serve host:port
+                       节点数 [爬行标识]”启动的协调服务器，各节点可以在不同的机器上；其他值为
+                       协调数据库文件（SQLite，不能放在网络文件系统上），只适用于同一台机器上的
+                       多个进程。按主机的一致性哈希分配链接（同一主机只由一个节点爬取），各节点
+                       写入自己的数据库分片（如data.node0.db），结束后用“python Cluster.py merge
+                       输出文件 分片...”合并，可选参数。
+    --node index       本节点序号（0到节点数-1），与--cluster同时使用。
+    --nodes number     节点总数，与--cluster同时使用。
+    --cluster-run id   爬行标识，同一次爬行的各节点须相同（使用协调服务器时须与服务器相同），
+                       协调数据库中其他标识的记录不影响本次爬行；以前用同一标识爬行过时须换用新
+                       标识，或先用“python Cluster.py reset 协调数据库文件”清除，可选参数，默认为
+                       空串。
+    --metrics port     在本机该端口提供Prometheus格式的指标接口http://127.0.0.1:port/metrics
+                       （抓取延迟、流量、解析与数据库写入耗时、队列长度、进行中的请求、按主机
+                       和状态码分类的请求数），可选参数，默认不启动。
+    --progress seconds 每隔多少秒输出一行进度（页面数与速度、队列长度、错误数、延迟分位数），
+                       可选参数，默认为10，0为不输出；爬行结束时总会输出最终报告（REPORT）。
+    --hardlink         下载模式下内容相同的文件硬链接到第一次保存的文件，节省磁盘空间，可选参数。
+    --logformat fmt    日志文件格式，text或json（每行一条JSON记录，含时间、级别、线程与消息），
+                       可选参数，默认为text。
+    --index            爬行时由后台线程把保存的页面（去掉标签的标题与正文）写入SQLite FTS5
+                       全文索引，可选参数。
+    --query="<terms>"  在--dbfile指定的数据库中全文搜索，按相关度输出链接、标题与摘要后退出，
+                       不爬行；空格分隔的词须同时出现，支持OR、NOT、"短语"与前缀*，中文按
+                       连续的字匹配；数据库尚无索引或有新页面时先补建索引。
+    --limit number     --query输出的最大结果数，可选参数，默认为10。
+    --neardup bits     近似重复页面检测：由页面正文计算64位SimHash指纹，与本次爬行已保存页面的
+                       指纹相差不超过bits位的页面（日历、排序参数、会话ID不同的同一页面等）
+                       不保存，爬行结束时按主机输出近似重复率，可选参数，建议为3（0为只检测
+                       正文相同的页面），默认不检测。
+    --neardup-nofollow 与--neardup同时使用，不解析近似重复页面中的链接，可选参数。
     --testself         程序自测，可选参数。
 '''
 
-class _file(object):
+class _stream(object):
+    # 分块写入非html资源：内容直接写入镜像的临时文件并计算摘要，结束时若保留则交给镜像写入器
+    # 改名，在数据库中只记录摘要
 
-    save_dir = '.'
-
-    def __init__(self, url, keyword):
-        parsed = urllib.urlparse(url)
-        host = parsed.netloc.split('@')[-1].split(':')[0]
-        path = '.' + os.path.sep + parsed.path.replace('/', os.path.sep)
-        path = os.path.join('.', self.save_dir, host, path)
-        path = os.path.realpath(path)
-        path, ext = os.path.splitext(path)
-        query = '_' + parsed.query if parsed.query else ''
-        if not ext:
-            path = os.path.join(path, 'index%s.html' % query)
-        else:
-            path = '%s%s%s' % (path, query, ext)
-        dirname = os.path.dirname(path)
-        if os.path.isfile(dirname):
-            dirname += '_'
-        try:
-            if not os.path.isdir(dirname):
-                os.makedirs(dirname)
-            self.f = open(path, 'wb')
-            with open(path + '.info', 'w') as f:
-                data = 'URL: %s\r\nKEYWORD: %s' % (url, keyword)
-                f.write(data)
-        except Exception as e:
-            raise e
-            pass
+    def __init__(self, writer):
+        self.writer = writer
+        self.path, self.file = writer.mirror.open_part(writer.url)
+        self.sha1 = hashlib.sha1()
+        self.keep = True
 
     def __enter__(self):
         return self
 
-    def __exit__(self, *args):
-        self.f.close()
+    def __exit__(self, exc_type, *args):
+        keep = self.keep and exc_type is None
+        self.file.close()
+        w = self.writer
+        if keep:
+            digest = self.sha1.hexdigest()
+            w.mirror.commit(w.url, w.keyword, self.path, digest)
+            w.db.save_digest(w.url, w.keyword, digest, w.ctype)
+        else:
+            w.mirror.discard(self.path)
 
-    def write(self, html):
-        self.f.write(html)
+    def write(self, data):
+        self.file.write(data)
+        self.sha1.update(data)
 
 class _db(DbHandler):
-    def __init__(self, host, dbname=None):
+
+    codecs = ('raw', 'zlib', 'lzma')
+    recent = 10000 # 内存中保留的最近保存的内容摘要数，覆盖批量写入尚未提交的blobs
+
+    def __init__(self, host, dbname=None, batch=500, synchronous='NORMAL', store='raw', level=6):
         super().__init__(dbname)
+        if store not in self.codecs:
+            raise ValueError('unknown storage mode: %s' % store)
         self.table = '_%s' % host
+        self.blobs = '_%s_blobs' % host
+        self.state = '_%s_state' % host
+        self.links_table = '_%s_links' % host
+        self.store = store
+        self.level = level
         sql = "create table if not exists '%s' (\
         id integer primary key autoincrement, \
         url text key, \
         keyword text, \
-        html blob \
+        html blob, \
+        hash text \
         )" % self.table
         self.execute(sql)
+        self._add_columns(self.table, (('hash', 'text'), ('etag', 'text'), ('modified', 'text'),
+                                       ('charset', 'text'), ('ctype', 'text')))
+        sql = "create table if not exists '%s' (\
+        hash text primary key, \
+        codec text, \
+        size integer, \
+        data blob \
+        )" % self.blobs
+        self.execute(sql)
+        # 同一url只保存一条记录，旧版本数据库中的重复记录只保留最新一条
+        if not self.select_one('sqlite_master', 'count(*)', ['name', '%s_url' % self.table]):
+            self.execute("delete from '%s' where id not in (select max(id) from '%s' group by url)" % (
+                self.table, self.table))
+            self.execute("create unique index '%s_url' on '%s' (url)" % (self.table, self.table))
+        # 爬行状态：已发现的链接及是否已处理，用于断点续爬
+        sql = "create table if not exists '%s' (\
+        url text primary key, \
+        ext text, \
+        deep integer, \
+        hit integer, \
+        done integer default 0 \
+        )" % self.state
+        self.execute(sql)
+        # 增量爬行：页面中解析出的链接，页面未改变时直接使用，不再解析
+        sql = "create table if not exists '%s' (\
+        url text primary key, \
+        links text \
+        )" % self.links_table
+        self.execute(sql)
+        self.writer = BatchWriter(self._dbname, batch, synchronous=synchronous)
+        self.stat_lock = Lock()
+        self.hashes = OrderedDict() # 最近保存的页面内容摘要，更早的摘要到blobs表中查找
+        self.pages = 0      # 保存的页面数
+        self.dups = 0       # 内容重复的页面数
+        self.raw_size = 0   # 不重复页面的原始字节数
+        self.stored_size = 0 # 不重复页面压缩后的字节数
+
+    def _add_columns(self, table, columns):
+        # 为旧版本数据库中已存在的表补充新增的列
+        exists = self.execute("pragma table_info('%s')" % table, lambda c:[i[1] for i in c.fetchall()])
+        for name, decl in columns:
+            if name not in exists:
+                self.execute("alter table '%s' add column %s %s" % (table, name, decl))
+
+    def close(self):
+        self.writer.close()
+        super().close()
+
+    def _compress(self, html):
+        if self.store == 'zlib':
+            return zlib.compress(html, self.level)
+        return lzma.compress(html, preset=self.level)
+
+    def save(self, url, keyword, html, digest=None, charset=None, ctype=None):
+        # 保存页面，非raw模式下页面内容按摘要去重并压缩保存在blobs表中，charset供全文索引解码，
+        # ctype为响应的Content-Type（不含参数），304响应时据此判断是否解析保存的页面
+        digest = digest or hashlib.sha1(html).hexdigest()
+        if self.store == 'raw':
+            self.writer.put("insert or replace into '%s' (url,keyword,html,hash,charset,ctype) values(?,?,?,?,?,?)" % (
+                self.table), (url, keyword, sqlite3.Binary(html), digest, charset, ctype))
+            return
+        with self.stat_lock:
+            self.pages += 1
+            new = digest not in self.hashes
+            if new:
+                self.hashes[digest] = None
+                if len(self.hashes) > self.recent:
+                    self.hashes.popitem(False)
+            else:
+                self.hashes.move_to_end(digest)
+        # 以前的爬行（断点续爬、增量爬行）已保存的内容不再压缩
+        if new and self.select_line(self.blobs, 'hash', ['hash', digest]):
+            new = False
+        if not new:
+            with self.stat_lock:
+                self.dups += 1
+        if new:
+            data = self._compress(html)
+            with self.stat_lock:
+                self.raw_size += len(html)
+                self.stored_size += len(data)
+            self.writer.put("insert or ignore into '%s' (hash,codec,size,data) values(?,?,?,?)" % self.blobs,
+                (digest, self.store, len(html), sqlite3.Binary(data)))
+        self.writer.put("insert or replace into '%s' (url,keyword,hash,charset,ctype) values(?,?,?,?,?)" % (
+            self.table), (url, keyword, digest, charset, ctype))
+
+    def save_digest(self, url, keyword, digest, ctype=None):
+        # 只记录摘要，内容已分块写入本地文件（下载模式的非html资源）
+        self.writer.put("insert or replace into '%s' (url,keyword,html,hash,ctype) values(?,?,NULL,?,?)" % (
+            self.table), (url, keyword, digest, ctype))
+
+    def validators(self, url):
+        # 返回上次保存的(ETag, Last-Modified, 内容摘要, Content-Type)，不存在时返回None；只读，不提交事务
+        return self.select_line(self.table, 'etag,modified,hash,ctype', ['url', url])
+
+    def set_validators(self, url, etag, modified):
+        self.writer.put("update '%s' set etag=?,modified=? where url=?" % self.table, (etag, modified, url))
+
+    def links(self, url):
+        # 返回上次保存的页面链接列表，不存在时返回None
+        row = self.select_line(self.links_table, 'links', ['url', url])
+        if not row:
+            return None
+        return row[0].split('\n') if row[0] else []
+
+    def save_links(self, url, links):
+        self.writer.put("insert or replace into '%s' (url,links) values(?,?)" % self.links_table,
+            (url, '\n'.join(links)))
+
+    @staticmethod
+    def _decompress(codec, data):
+        if codec == 'zlib':
+            return zlib.decompress(data)
+        if codec == 'lzma':
+            return lzma.decompress(data)
+        return bytes(data)
+
+    def read_hash(self, digest):
+        # 按内容摘要读取并解压页面，不存在时返回None
+        row = self.select_line(self.blobs, 'codec,data', ['hash', digest])
+        return self._decompress(*row) if row else None
+
+    def read(self, url):
+        # 读取url最近一次保存的页面内容（自动解压），不存在时返回None
+        row = self.execute("select html,hash from '%s' where url=? order by id desc limit 1" % self.table,
+                           lambda c:c.fetchone(), (url,))
+        if not row:
+            return None
+        if row[0] is not None:
+            return bytes(row[0])
+        return self.read_hash(row[1])
+
+    def checkpoint(self, url, ext, deep, hit=False):
+        # 记录新发现的链接，随批量写入提交
+        self.writer.put("insert or ignore into '%s' (url,ext,deep,hit) values(?,?,?,?)" % self.state,
+            (url, ext, deep, int(hit)))
+
+    def finish(self, url):
+        # 标记链接已处理，须在该页面中的链接都已checkpoint之后调用
+        self.writer.put("update '%s' set done=1 where url=?" % self.state, (url,))
+
+    def reset_state(self):
+        self.execute("delete from '%s'" % self.state)
+
+    def load_state(self):
+        # 返回(已发现的全部链接, 未处理的链接[(url, ext, deep, hit)])
+        seen = [i[0] for i in self.select(self.state, 'url')]
+        pending = self.select(self.state, 'url,ext,deep,hit', 'done=0 order by deep')
+        return seen, pending
+
+    def stats(self):
+        # 返回(页面数, 重复页面数, 原始字节数, 压缩后字节数)
+        with self.stat_lock:
+            return self.pages, self.dups, self.raw_size, self.stored_size
 
     class Writer(object):
-        def __init__(self, db, url, keyword, save_to_file=False):
+        def __init__(self, db, url, keyword, mirror=None, neardup=None):
             self.db = db
             self.table = db.table
             self.url = url
             self.keyword = keyword
-            self.save_to_file = save_to_file
+            self.mirror = mirror   # 下载模式的镜像写入器
+            self.known = None      # 增量爬行时上次保存的(ETag, Last-Modified, 内容摘要, Content-Type)
+            self.charset = None    # 页面编码，随页面保存
+            self.ctype = None      # 响应的Content-Type，随页面保存
+            self.unchanged = False # 内容与上次保存的相同，未重新保存
+            self.neardup = neardup # 近似重复检测的指纹索引
+            self.original = None   # 近似重复时为与之相近的已保存页面的链接，页面未保存
+            self.compared = False  # 是否计算了指纹并在索引中查找过，用于统计近似重复率
 
         def __enter__(self):
             return self
@@ -97,26 +374,175 @@ class _db(DbHandler):
         def __exit__(self, *args):
             pass
 
+        @property
+        def streamable(self):
+            # 下载模式下非html资源可分块直接写入文件
+            return self.mirror is not None
+
+        def stream(self):
+            return _stream(self)
+
         def write(self, html):
-            if self.save_to_file:
-                with _file(self.url,self.keyword) as f:
-                    f.write(html)
-            with self.db.lock:
-                cursor = self.db.conn.cursor()
-                cursor.execute("insert into '%s' (url,keyword,html) values(?,?,?)" % self.table,
-                    (
-                    self.url,
-                    self.keyword,
-                    sqlite3.Binary(html))
-                    )
-                self.db.conn.commit()
-            cursor.close()
-    def get_writer(self, url, keyword, save_to_file=False):
+            digest = hashlib.sha1(html).hexdigest()
+            if self.known and self.known[2] == digest:
+                self.unchanged = True
+                return
+            if self.neardup is not None:
+                value = fingerprint(html, self.charset)
+                if value is not None:
+                    self.compared = True
+                    self.original = self.neardup.check(value, self.url)
+                    if self.original is not None:
+                        _log.debug('NEARDUP: %s is a near-duplicate of %s', self.url, self.original)
+                        return
+            if self.mirror:
+                self.mirror.put(self.url, self.keyword, html, digest)
+            self.db.save(self.url, self.keyword, html, digest, self.charset, self.ctype)
+
+    def get_writer(self, url, keyword, mirror=None, neardup=None):
         if keyword == None:
             keyword = ''
-        return self.Writer(self, url, keyword, save_to_file)
+        return self.Writer(self, url, keyword, mirror, neardup)
+
+_headers = {
+        'Connection': 'keep-alive',
+        'Accept': '*/*',
+        'Accept-Encoding': 'gzip',
+        'User-Agent': 'Mozilla/5.0 (X11; Linux i686)\
+                      AppleWebKit/537.36 (KHTML, like Gecko)\
+                      Chrome/35.0.1916.153 Safari/537.36',
+        'Accept-Language': 'zh-CN,zh;q=0.8,en;q=0.6',
+    }
+
+MAX_SIZE = 16 << 20 # 默认的响应体大小上限（解压后）
+CHUNK_SIZE = 1 << 16
+
+@lru_cache(maxsize=32)
+def _keywords(keyword):
+    # 单个关键词字符串转为Keywords，同一关键词只编译一次
+    return Keywords([keyword])
+
+class _KeywordScanner(object):
+    # 分块查找关键词：各编码的匹配器只编译一次，扫描状态跨块保留，跨越块边界的关键词也能找到；
+    # 命中任一关键词即保留页面，但继续扫描以记录全部出现的关键词，全部找到后不再扫描
+
+    def __init__(self, keywords, charset=None):
+        self.keywords = keywords
+        self.found = not keywords
+        self._found = set()
+        if keywords:
+            self._matcher, self._index = keywords.compile(charset)
+            self._state = self._matcher.start
+
+    def feed(self, chunk):
+        if self.keywords and len(self._found) < len(self._index):
+            self._state = self._matcher.scan(chunk, self._state, self._found)
+            self.found = bool(self._found)
+        return self.found
+
+    def matched(self):
+        # 返回找到的关键词，逗号分隔，保存在页面表的keyword列
+        return ','.join(self.keywords.matched(self._found, self._index)) if self.keywords else ''
+
+def _decoded(chunks, encoding):
+    # 逐块解压gzip/deflate响应体，每次最多输出CHUNK_SIZE字节，压缩炸弹不会一次性展开
+    if encoding not in ('gzip', 'x-gzip', 'deflate'):
+        yield from chunks
+        return
+    d = zlib.decompressobj(zlib.MAX_WBITS | 32) # 自动识别gzip与zlib头
+    for chunk in chunks:
+        while chunk:
+            data = d.decompress(chunk, CHUNK_SIZE)
+            chunk = d.unconsumed_tail
+            if data:
+                yield data
+        if d.eof:
+            for chunk in chunks: # 丢弃压缩流之后的多余字节，响应体读完后连接才能复用
+                pass
+            break
+    data = d.flush()
+    if data:
+        yield data
+
+def _handle_response(headers, chunks, f, keyword, host=None, max_size=MAX_SIZE, detect=True):
+    # chunks为原始响应体的分块，下载模式的非html资源直接分块写入文件，其余内容缓存后处理，
+    # detect为False且无需查找关键词时不检测编码，由解析页面的子进程检测，
+    # 返回(status, ct, data, charset, has_key, detected, headers, 解压后的响应体字节数)
+    length = headers.get('Content-Length')
+    if max_size and length and length.isdigit() and int(length) > max_size:
+        raise ValueError('response body of %s bytes exceeds %s bytes' % (length, max_size))
+    ce = headers.get('Content-Encoding')
+    ct = headers.get('Content-type')
+    charset = None
+    if ct:
+        ct = ct.split(';',1)
+        if len(ct) > 1:
+            charset = ct[1].split('charset=')
+            if len(charset) > 1:
+                charset = charset[1]
+            else:
+                charset = None
+        ct = ct[0]
+    if hasattr(f, 'ctype'):
+        f.ctype = ct
+    if isinstance(keyword, str):
+        keyword = _keywords(keyword) if keyword else None
+    scanner = _KeywordScanner(keyword, charset)
+    size = 0
+    if ct and not ct.startswith('text/html') and getattr(f, 'streamable', False):
+        with f.stream() as out:
+            for chunk in _decoded(chunks, ce):
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise ValueError('response body exceeds %s bytes' % max_size)
+                scanner.feed(chunk)
+                out.write(chunk)
+            out.keep = scanner.found
+            f.keyword = scanner.matched()
+        return ('ok', ct, b'', charset, scanner.found, False, headers, size)
+    parts = []
+    for chunk in _decoded(chunks, ce):
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise ValueError('response body exceeds %s bytes' % max_size)
+        if charset:
+            scanner.feed(chunk)
+        parts.append(chunk)
+    data = b''.join(parts)
+    del parts
+    detected = not charset
+    if detected and (detect or keyword):
+        charset = get_charset(data, host)
+        if keyword: # 编码由内容检测得出，此时才能在完整页面中查找关键词
+            scanner = _KeywordScanner(keyword, charset)
+            scanner.feed(data)
+    has_key = scanner.found
+    if has_key:
+        if hasattr(f, 'charset'):
+            f.charset = charset
+            f.keyword = scanner.matched()
+        with f:
+            f.write(data)
+    if getattr(f, 'unchanged', False):
+        status = 'unchanged'
+    elif getattr(f, 'original', None) is not None:
+        status = 'neardup'
+    else:
+        status = 'ok'
+    return (status, ct, data, charset, has_key, detected, headers, size)
+
+_http = HttpPool()
 
-def request_url(url, fn=None, save_as=None, keyword=''):
+def _request_headers(headers):
+    return dict(_headers, **headers) if headers else _headers
+
+def _not_modified(f, headers):
+    # 304响应的结果，Content-Type取上次保存的值，非html资源因此不会被当作页面解析
+    known = getattr(f, 'known', None)
+    return ('notmodified', known[3] if known else None, b'', None, True, False, headers, 0)
+
+def request_url(url, fn=None, save_as=None, keyword='', http=None, max_size=MAX_SIZE, headers=None,
+                detect=True):
     if not save_as:
         assert fn
         save_as = open
@@ -125,62 +551,295 @@ def request_url(url, fn=None, save_as=None, keyword=''):
     else:
         f = save_as(fn, 'wb')
     try:
-        headers = {
-                'Connection': 'keep-alive',
-                'Accept': '*/*',
-                'Accept-Encoding': 'gzip',
-                'User-Agent': 'Mozilla/5.0 (X11; Linux i686)\
-                      AppleWebKit/537.36 (KHTML, like Gecko)\
-                      Chrome/35.0.1916.153 Safari/537.36',
-                'Accept-Language': 'zh-CN,zh;q=0.8,en;q=0.6',
-            }
         url = urllib.quote(url, safe=printable)
-        req = urllib.Request(url, headers=headers)
-        r = urllib.urlopen(req, timeout=5)
-        data = r.read()
-        ce = r.headers.get('Content-Encoding')
-        if ce == 'gzip':
-            data = GzipFile(fileobj=BytesIO(data)).read()
-        ct = r.headers.get('Content-type')
-        charset = None
-        if ct:
-            ct = ct.split(';',1)
-            if len(ct) > 1:
-                charset = ct[1].split('charset=')
-                if len(charset) > 1:
-                    charset = charset[1]
-                else:
-                    charset = None
-            ct = ct[0]
-        if not charset:
-            charset = get_charset(data)
-        has_key = True
-        if keyword:
-            if charset:
-                keyword = keyword.encode(charset)
+        with (http or _http).open(url, _request_headers(headers)) as r:
+            if r.status == 304: # 条件请求：页面未改变，没有响应体
+                retval = _not_modified(f, r.headers)
             else:
-                keyword = keyword.encode('utf-8')
-            if data.find(keyword) == -1:
-                has_key = False
-        if has_key:
-            with f:
-                f.write(data)
-        retval = ('ok', ct, data, charset)
+                retval = _handle_response(r.headers, r.iter_chunks(CHUNK_SIZE), f, keyword,
+                                          urllib.urlparse(url).hostname, max_size, detect)
     except Exception as e:
         # raise e
-        retval = (('*** ERROR: bad URL "%s": %s' % (url, e)), None)
+        retval = (('*** ERROR: bad URL "%s": %s' % (url, e)), e)
+    return retval
+
+async def async_request_url(url, save_as, keyword='', max_size=MAX_SIZE, headers=None, detect=True):
+    try:
+        url = urllib.quote(url, safe=printable)
+        status, headers, data = await AsyncHttp.fetch(url, _request_headers(headers), timeout=5,
+                                                      max_size=max_size)
+        if status == 304:
+            retval = _not_modified(save_as, headers)
+        else:
+            retval = _handle_response(headers, (data,), save_as, keyword, urllib.urlparse(url).hostname,
+                                      max_size, detect)
+    except Exception as e:
+        retval = (('*** ERROR: bad URL "%s": %s' % (url, e or type(e).__name__)), e)
     return retval
 
+LINK_LOG_SAMPLE = 100 # 逐条链接的日志每N条只记录1条，每个页面另有一行汇总
+_link_counter = itertools.count()
+
+def _sampled():
+    return next(_link_counter) % LINK_LOG_SAMPLE == 0
+
+def _filter_links(links, host, dom, pridomain, log=True):
+    # 按域名过滤链接，返回[(link, ext)]
+    result = []
+    log = log and _log.root.isEnabledFor(_log.DEBUG)
+    for link in links:
+        parsed = urllib.urlparse(link)
+        ext = os.path.splitext(parsed.path)[1]
+        if not ext:
+            ext = '.html'
+        if link.startswith('http'):
+            _host = parsed.netloc.split('@')[-1].split(':')[0]
+            if (_host != host) if pridomain else (not _host.endswith(dom)):
+                if log and _sampled():
+                    _log.debug('LINK: discarded link %s (sampled 1/%s)', link, LINK_LOG_SAMPLE)
+                continue
+        result.append((link, ext))
+    return result
+
+_extractor = None # 子进程中的链接提取参数，由_init_extractor设置
+
+def _init_extractor(parser, canonicalize, static_res, host, dom, pridomain):
+    global _extractor
+    _extractor = (parsers[parser], canonicalize, static_res, host, dom, pridomain)
+
+def _extract_links(data, url, charset, detect):
+    # 在子进程中执行：检测编码（charset为None时）、解析页面链接并规范化、过滤，返回[(link, ext)]
+    parse, canonicalize, static_res, host, dom, pridomain = _extractor
+    if charset is None:
+        charset = get_charset(data, urllib.urlparse(url).hostname)
+        detect = False
+    links = set(map(canonicalize, parse(data, url, charset, static_res, detect)))
+    return _filter_links(links, host, dom, pridomain, False)
+
+class Frontier(object):
+    '''待爬链接队列，入队出队均为O(1)（最佳优先模式为O(log n)），非线程安全
+    对象属性说明：
+    mode  str       出队顺序：bfs广度优先，dfs深度优先，best最佳优先
+    score function  最佳优先模式的评分函数，传入(url, deep, hit)，hit为来源页面是否
+                    命中关键词，返回值越小越先出队
+    '''
+
+    modes = ('bfs', 'dfs', 'best')
+
+    def __init__(self, mode='bfs', score=None):
+        '''参数说明：
+        mode  str       出队顺序，可选，默认为bfs
+        score function  最佳优先模式的评分函数，可选，默认先出队命中关键词的页面中的
+                        链接，再按深度由浅到深
+        '''
+        if mode not in self.modes:
+            raise ValueError('unknown frontier mode: %s' % mode)
+        self.mode = mode
+        self.score = score or self._score
+        self._seq = 0 # 同分链接按入队顺序出队
+        self._items = [] if mode == 'best' else deque()
+
+    @staticmethod
+    def _score(url, deep, hit):
+        return (not hit, deep)
+
+    def push(self, item, hit=False):
+        '''链接入队
+        参数说明：
+        item tuple    (url, ext, deep)
+        hit  bool     来源页面是否命中关键词
+        '''
+        if self.mode == 'best':
+            self._seq += 1
+            heappush(self._items, (self.score(item[0], item[2], hit), self._seq, item))
+        else:
+            self._items.append(item)
+
+    def pop(self):
+        '''链接出队'''
+        if self.mode == 'bfs':
+            return self._items.popleft()
+        if self.mode == 'dfs':
+            return self._items.pop()
+        return heappop(self._items)[2]
+
+    def clear(self):
+        self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+class _Shards(object):
+    '''已发现链接集合的基类，按链接指纹分片加锁，各线程操作不同分片时互不阻塞
+    子类实现_new_shard、_add_fp与_has_fp，分别创建分片、向分片加入指纹、查询指纹
+    '''
+
+    def __init__(self, shards=16):
+        self._shards = [self._new_shard() for i in range(shards)]
+        self._locks = [Lock() for i in range(shards)]
+        self._counts = [0] * shards
+
+    @staticmethod
+    def _fp(url):
+        # 链接的128位指纹，低64位用于定位分片与槽位
+        return int.from_bytes(hashlib.blake2b(url.encode('utf-8', 'surrogatepass'), digest_size=16).digest(),
+                              'little')
+
+    def add(self, url):
+        '''加入链接，返回链接此前是否不在集合中（检查与加入为原子操作）'''
+        fp = self._fp(url)
+        i = fp % len(self._shards)
+        with self._locks[i]:
+            if not self._add_fp(self._shards[i], fp):
+                return False
+            self._counts[i] += 1
+        return True
+
+    def update(self, urls):
+        for url in urls:
+            self.add(url)
+
+    def __contains__(self, url):
+        fp = self._fp(url)
+        i = fp % len(self._shards)
+        with self._locks[i]:
+            return self._has_fp(self._shards[i], fp)
+
+    def __len__(self):
+        return sum(self._counts)
+
+class ExactSet(_Shards):
+    '''保存完整链接字符串的集合，结果精确，内存占用最大'''
+
+    def _new_shard(self):
+        return set()
+
+    def add(self, url):
+        shard = hash(url) % len(self._shards)
+        with self._locks[shard]:
+            if url in self._shards[shard]:
+                return False
+            self._shards[shard].add(url)
+            self._counts[shard] += 1
+        return True
+
+    def __contains__(self, url):
+        return url in self._shards[hash(url) % len(self._shards)]
+
+class FingerprintSet(_Shards):
+    '''保存64位链接指纹的开放寻址哈希集合，每个链接约占16字节，
+    不同链接指纹相同的概率约为n²/2⁶⁵，可忽略
+    '''
+
+    _mask = (1 << 64) - 1
+
+    def _new_shard(self):
+        return [array('Q', bytes(8 * 1024)), 0] # [槽位数组, 已用槽位数]，0表示空槽
+
+    def _probe(self, table, fp):
+        # 线性探测，返回指纹所在或应放入的槽位
+        size = len(table)
+        i = (fp >> 8) % size
+        while table[i] and table[i] != fp:
+            i = (i + 1) % size
+        return i
+
+    def _add_fp(self, shard, fp):
+        fp = (fp & self._mask) or 1
+        table = shard[0]
+        i = self._probe(table, fp)
+        if table[i]:
+            return False
+        table[i] = fp
+        shard[1] += 1
+        if shard[1] * 2 > len(table): # 装载因子超过0.5时扩容
+            new = array('Q', bytes(16 * len(table)))
+            for old in table:
+                if old:
+                    new[self._probe(new, old)] = old
+            shard[0] = new
+        return True
+
+    def _has_fp(self, shard, fp):
+        fp = (fp & self._mask) or 1
+        return bool(shard[0][self._probe(shard[0], fp)])
+
+class BloomFilter(_Shards):
+    '''可扩展布隆过滤器：每个分片由若干位数组组成，当前位数组装满后追加一个容量翻倍、
+    误判率减半的新位数组，总误判率不超过error；误判时新链接会被当作已发现而跳过
+    '''
+
+    def __init__(self, error=0.001, capacity=1 << 16, shards=16):
+        '''参数说明：
+        error    float    误判率上限，可选，默认为0.001
+        capacity int      每个分片第一个位数组的容量，可选，默认为65536
+        shards   int      分片数，可选，默认为16
+        '''
+        self.error = error
+        self.capacity = capacity
+        super().__init__(shards)
+
+    def _filter(self, capacity, error):
+        # [位数组, 位数, 哈希函数个数, 容量, 已加入数]
+        bits = int(math.ceil(-capacity * math.log(error) / math.log(2) ** 2))
+        hashes = max(1, int(round(bits / capacity * math.log(2))))
+        return [bytearray((bits + 7) // 8), bits, hashes, capacity, 0]
+
+    def _new_shard(self):
+        # 各层误判率依次为error/2, error/4, ...，总和不超过error
+        return [self._filter(self.capacity, self.error / 2)]
+
+    @staticmethod
+    def _positions(f, fp):
+        # 双重哈希：由128位指纹的高低两半生成k个位置
+        h1, h2 = fp & 0xffffffffffffffff, (fp >> 64) | 1
+        return [(h1 + i * h2) % f[1] for i in range(f[2])]
+
+    def _test(self, f, fp):
+        bits = f[0]
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(f, fp))
+
+    def _has_fp(self, shard, fp):
+        return any(self._test(f, fp) for f in shard)
+
+    def _add_fp(self, shard, fp):
+        if self._has_fp(shard, fp):
+            return False
+        f = shard[-1]
+        if f[4] >= f[3]:
+            f = self._filter(f[3] * 2, self.error / 2 ** (len(shard) + 1))
+            shard.append(f)
+        bits = f[0]
+        for p in self._positions(f, fp):
+            bits[p >> 3] |= 1 << (p & 7)
+        f[4] += 1
+        return True
+
+_seen_modes = {'set': ExactSet, 'hash': FingerprintSet, 'bloom': BloomFilter}
+
+HOST_PARK_LIMIT = 10 # 每个主机最多暂存的链接数，达到时停止从待爬队列取链接，保持队列的出队顺序
+CLUSTER_POLL = 0.2 # 多进程爬行时接收其他节点发来的链接的间隔秒数
+
 class Spider(object):
 
     _filter = {'.css', '.js', '.jpg', '.jpeg', '.jpe', '.gif', '.bmp',
                '.exe', '.avi', '.rmvb', '.mp4', '.mp3', '.wav'}
 
-    def __init__(self, url, deep=7, threads=20, dbname='data.db', keyword=None, pridomain=False, download=False):
+    def __init__(self, url, deep=7, threads=20, dbname='data.db', keyword=None, pridomain=False, download=False,
+                 order='bfs', score=None, hostconns=None, idle=30, batch=500, synchronous='NORMAL',
+                 store='raw', level=6, resume=False, seen='set', fpr=0.001, canonicalize=None,
+                 parser='html', max_size=MAX_SIZE, hostmax=None, delay=0.0, adaptive=False,
+                 retries=3, incremental=False, processes=0, cluster=None, metrics=None, progress=0,
+                 hardlink=False, index=False, neardup=None, neardup_nofollow=False):
         if not url.startswith('http://') and not url.startswith('https://'):
             url = 'http://%s' % url
-        while url.endswith('/'):
-            url = url[:-1]
+        self.canonicalize = canonicalize or Canonicalizer()
+        if processes: # 子进程以spawn方式启动，规范化函数须能pickle（模块级函数或Canonicalizer，不能是lambda）
+            try:
+                pickle.dumps(self.canonicalize)
+            except (pickle.PicklingError, AttributeError, TypeError) as e:
+                raise ValueError('canonicalize must be picklable when processes > 0: %s' % e)
+        url = self.canonicalize(url)
         parsed = urllib.urlparse(url)
         self.host = parsed.netloc.split('@')[-1].split(':')[0]
         ext = os.path.splitext(parsed.path)[1]
@@ -188,112 +847,669 @@ class Spider(object):
             ext = '.html'
         self.dom = '.'.join(self.host.split('.')[-2:])
         self.deep = deep
-        self.pool = Pool(threads)
-        self.db = _db(parsed.netloc, dbname)
-        self.keyword = keyword
+        self.threads = max(threads, 1) # 最大并发数
+        self.pool = None
+        self.http = HttpPool(hostconns or self.threads, idle)
+        self.sched = HostScheduler(hostmax or self.threads, delay, adaptive=adaptive)
+        self.retries = retries
+        self.tries = {} # 被限流的链接：{url: (已重试的次数, 第一次处理时的序号)}
+        self.db = _db(parsed.netloc, dbname, batch, synchronous, store, level)
+        if isinstance(keyword, str):
+            keyword = [keyword]
+        self.keyword = Keywords(keyword) if keyword else None # 关键词，各编码的匹配自动机只编译一次
         self.pridomain = pridomain
         self.download = download
+        self.mirror = Mirror(hardlink=hardlink) if download else None # 下载模式的镜像写入器
+        self.indexer = Indexer(self.db._dbname, self.db.table) if index else None # 后台全文索引线程
+        self.indexed = 0
+        self.parser = parser
+        self.parse = parsers[parser]
+        self.processes = processes # 解析页面的进程数，0为在下载线程中解析
+        self.cluster = cluster     # 多进程爬行的协调器，链接按主机分配给各节点
+        self.sent = 0
+        self.received = 0
+        self._next_poll = 0.0      # 下次接收其他节点发来的链接的时间
+        self.procs = None
+        self.max_size = max_size
+        self.incremental = incremental
+        self.neardup = SimHashIndex(neardup) if neardup is not None else None # 近似重复页面的指纹索引
+        self.neardup_nofollow = neardup_nofollow # 不解析近似重复页面中的链接
+        self.neardups = {} # {主机: [比较过的页面数, 近似重复的页面数]}
+        self.unchanged = 0   # 增量爬行时内容未改变的页面数
+        self.notmodified = 0 # 其中服务器返回304的页面数
         self.lock = Lock()
-        self.queue = [(url, ext, 0)]
-        self.seen = set()
-        self.seen.add(url)
+        self.cond = Condition(self.lock)
+        self.queue = Frontier(order, score)
+        self.seen = BloomFilter(fpr) if seen == 'bloom' else _seen_modes[seen]()
+        seen, pending = self.db.load_state() if resume else ((), ())
+        if seen:
+            self.seen.update(seen)
+            for link, _ext, _deep, hit in pending:
+                self.queue.push((link, _ext, _deep), hit)
+            _log.info('RESUME: %s links seen, %s links pending' % (len(seen), len(pending)))
+        else:
+            self.db.reset_state()
+            self.seen.add(url)
+            if not cluster or cluster.owner(self.host) == cluster.node: # 起始链接由其主机所属的节点爬取
+                self.queue.push((url, ext, 0))
+                self.db.checkpoint(url, ext, 0)
         self.count = 0
-        
-    def get_page(self, url, _filter):
+        self.active = 0 # 已交给线程池但尚未处理完毕的链接数
+        self.skip_ext = True
+        self.stopped = False # 中断后不再派发新链接
+        self.metrics_port = metrics # /metrics接口的端口，None为不启动
+        self.progress = progress    # 输出进度行的间隔秒数，0为不输出
+        self.started = None
+        self._monitor = None
+        self._init_metrics()
+
+    def _init_metrics(self):
+        # 爬行指标，由进度行、最终报告与/metrics接口共用
+        r = self.registry = Registry()
+        self.m_pages = r.counter('spider_pages_total', 'Pages handled, by result.', ('result',))
+        self.m_requests = r.counter('spider_requests_total',
+            'HTTP requests by host and status (exception name for failed requests).', ('host', 'status'))
+        self.m_bytes = r.counter('spider_body_bytes_total', 'Response body bytes received (decoded).')
+        self.m_fetch = r.histogram('spider_fetch_seconds', 'Time from sending a request to the end of the body.')
+        self.m_parse = r.histogram('spider_parse_seconds', 'Link extraction time per page.')
+        self.m_db = r.histogram('spider_db_write_seconds', 'Database batch commit time.')
+        self.m_rows = r.counter('spider_db_rows_total', 'Rows committed to the database.')
+        r.gauge('spider_queue_depth', 'Links waiting in the frontier and the host scheduler.',
+                func=lambda:len(self.queue) + self.sched.pending)
+        r.gauge('spider_inflight_requests', 'Links being fetched or handled.', func=lambda:self.active)
+        self.db.writer.on_commit = self._on_commit
+
+    def _on_commit(self, rows, seconds):
+        self.m_rows.inc(amount=rows)
+        self.m_db.observe(seconds)
+
+    def _errors(self):
+        # 返回{(host, status): 次数}，不含成功与304的请求
+        return {k: v for k, v in self.m_requests.items() if k[1] not in ('2xx', '304')}
+
+    def _progress_line(self, pages, elapsed):
+        fetch = self.m_fetch.quantile(0.5), self.m_fetch.quantile(0.99)
+        return 'PROGRESS: %s pages (%.1f/s), queue %s, in-flight %s, %s errors, %.1f MB in, fetch p50 %s p99 %s' % (
+            self.count, pages / elapsed if elapsed else 0.0, len(self.queue) + self.sched.pending,
+            self.active, sum(self._errors().values()), self.m_bytes.total() / 2**20,
+            *('%.0fms' % (i * 1000) if i is not None else '-' for i in fetch))
+
+    def _monitor_loop(self, stop):
+        # 每隔progress秒输出一行进度，速度按最近一个间隔计算
+        last, stamp = self.count, time.monotonic()
+        while not stop.wait(self.progress):
+            count, now = self.count, time.monotonic()
+            _log.info(self._progress_line(count - last, now - stamp))
+            last, stamp = count, now
+
+    def _start_monitor(self):
+        self.started = time.monotonic()
+        stop = threading.Event()
+        server = None
+        if self.metrics_port is not None:
+            server = serve_metrics(self.registry, self.metrics_port)
+            _log.info('METRICS: serving http://%s:%s/metrics' % server.server_address[:2])
+        if self.progress:
+            threading.Thread(target=self._monitor_loop, args=(stop,), daemon=True).start()
+        self._monitor = (stop, server)
+
+    def _stop_monitor(self):
+        if self._monitor:
+            stop, server = self._monitor
+            stop.set()
+            if server:
+                server.shutdown()
+                server.server_close()
+            self._monitor = None
+
+    def _start(self, url, _filter):
+        # 链接处理前的计数与过滤，返回序号，需要跳过时返回None
         url, ext, deep = url
         with self.lock:
-            self.count += 1
-            count = self.count
-        _log.info('No.%s URL: %s starting to handle' % (count, url))
+            if url in self.tries: # 被限流后重试的链接沿用原来的序号，不重复计数
+                count = self.tries[url][1]
+            else:
+                self.count += 1
+                count = self.count
+        _log.info('No.%s URL: %s starting to handle', count, url)
         if _filter:
             if _filter == True:
                 _filter = self._filter
             if ext in _filter:
-                _log.debug('No.%s URL: %s skipping download' % (count, url))
-                exit()
-                return
-        keyword = self.keyword if deep > 0 else None
-        result = request_url(url, save_as=self.db.get_writer(url,keyword,self.download), keyword=keyword)
+                _log.debug('No.%s URL: %s skipping download', count, url)
+                return None
+        return count
+
+    def _check(self, url, count, result, writer=None):
+        # 记录下载结果，返回是否需要解析页面中的链接，writer为下载时使用的写入器
+        url, ext, deep = url
         if result[0][0] == '*':
+            self.m_pages.inc('error')
             _log.warning(result[0])
-            return
+            return False
         else:
-            _log.debug('No.%s URL: %s has been downloaded' % (count, url))
+            _log.debug('No.%s URL: %s has been downloaded', count, url)
+        self.m_pages.inc(result[0])
+        self.m_bytes.inc(amount=result[7])
+        if self.neardup and writer is not None and writer.compared: # 未命中关键词等未计算指纹的页面不计入
+            host = self._hostkey(url)
+            with self.lock:
+                stats = self.neardups.setdefault(host, [0, 0])
+                stats[0] += 1
+                stats[1] += result[0] == 'neardup'
+        if result[0] in ('unchanged', 'notmodified'):
+            _log.debug('No.%s URL: %s unchanged since last crawl', count, url)
+            with self.lock:
+                self.unchanged += 1
+                self.notmodified += result[0] == 'notmodified'
+        if self.incremental and result[0] != 'notmodified':
+            etag, modified = result[6].get('ETag'), result[6].get('Last-Modified')
+            if etag or modified:
+                self.db.set_validators(url, etag, modified)
         if deep == self.deep:
-            _log.debug('No.%s URL: %s skipping parse' % (count, url))
-            return
+            _log.debug('No.%s URL: %s skipping parse', count, url)
+            return False
+        if result[0] == 'neardup' and self.neardup_nofollow:
+            _log.debug('No.%s URL: %s near-duplicate, skipping parse', count, url)
+            return False
         mime = result[1]
         if mime and not mime.startswith('text/html'):
-            _log.debug('No.%s URL: %s skipping parse' % (count, url))
-            return
-        links = set(AnchorParser(result[2], url, result[3], self.download)())
-        for link in links:
-            parsed = urllib.urlparse(link)
-            _ext = os.path.splitext(parsed.path)[1]
-            if not _ext:
-                _ext = '.html'
-            if link.startswith('http'):
-                host = parsed.netloc.split('@')[-1].split(':')[0]
-                if self.pridomain:
-                    if host != self.host:
-                        _log.debug('LINK: discarded link %s' % link)
-                        continue
-                else:
-                    if not host.endswith(self.dom):
-                        _log.debug('LINK: discarded link %s' % link)
+            _log.debug('No.%s URL: %s skipping parse', count, url)
+            return False
+        return True
+
+    def _handle(self, url, count, result, writer=None):
+        # 处理下载结果，解析页面中的链接并加入待爬队列
+        if self._check(url, count, result, writer):
+            with self.m_parse.time():
+                links = self._links(url, result)
+            self._enqueue(url, result, links)
+
+    def _extract(self, url, result):
+        # 交给进程池解析页面，页面以字节串传递，返回Future
+        return self.procs.submit(_extract_links, result[2], url[0], result[3], not result[5])
+
+    def _links(self, url, result):
+        # 返回页面中规范化并过滤后的链接[(link, ext)]，未改变的页面使用上次保存的链接
+        if result[0] in ('unchanged', 'notmodified'):
+            return _filter_links(self._stored_links(url[0], result[2], result[1]), self.host, self.dom,
+                                 self.pridomain)
+        if self.procs:
+            return self._save_links(url, self._extract(url, result).result())
+        links = set(map(self.canonicalize, self.parse(result[2], url[0], result[3], self.download, not result[5])))
+        return self._save_links(url, _filter_links(links, self.host, self.dom, self.pridomain))
+
+    def _save_links(self, url, links):
+        if self.incremental:
+            self.db.save_links(url[0], [i[0] for i in links])
+        return links
+
+    def _enqueue(self, url, result, links):
+        # 新发现的链接加入待爬队列
+        url, ext, deep = url
+        hit = bool(self.keyword) and result[4]
+        outbox = [] # 属于其他节点的链接
+        debug = _log.root.isEnabledFor(_log.DEBUG)
+        new = 0
+        for link, _ext in links:
+            if self.seen.add(link):
+                new += 1
+                if debug and _sampled():
+                    _log.debug('LINK: found link %s (sampled 1/%s)', link, LINK_LOG_SAMPLE)
+                if self.cluster:
+                    node = self.cluster.owner(urllib.urlparse(link).hostname or '')
+                    if node != self.cluster.node:
+                        outbox.append((node, link, _ext, deep+1, hit))
                         continue
-            if link not in self.seen:
                 with self.lock:
-                    if link not in self.seen:
-                        self.seen.add(link)
-                        _log.debug('LINK: found link %s' % link)
-                        self.queue.append((link, _ext, deep+1))
+                    self.queue.push((link, _ext, deep+1), hit)
+                    self.db.checkpoint(link, _ext, deep+1, hit)
+                    self._dispatch()
+        if debug:
+            _log.debug('LINK: %s links on %s, %s new', len(links), url, new)
+        if outbox:
+            self.cluster.send(outbox)
+            with self.lock:
+                self.sent += len(outbox)
+
+    def _poll(self):
+        # 每隔CLUSTER_POLL秒取走其他节点发来的链接，不持有self.lock调用：协调数据库的事务
+        # 可能等待其他进程的文件锁，网络协调器可能等待网络，期间下载线程不被阻塞
+        if not self.cluster or time.monotonic() < self._next_poll:
+            return ()
+        self._next_poll = time.monotonic() + CLUSTER_POLL
+        return self.cluster.receive()
+
+    def _step(self, received=()):
+        # 主循环的一步，调用时须持有self.lock：把_poll收到的链接加入待爬队列并派发，
+        # 返回(本节点是否已无待处理链接, 下次检查前的最长等待秒数)
+        for link, ext, deep, hit in received:
+            self.received += 1
+            if self.seen.add(link):
+                self.queue.push((link, ext, deep), hit)
+                self.db.checkpoint(link, ext, deep, hit)
+        self._dispatch()
+        timeout = self.sched.next_ready()
+        if self.cluster:
+            poll = max(self._next_poll - time.monotonic(), 0.0)
+            timeout = poll if timeout is None else min(timeout, poll)
+        return not (self.active or self.sched.pending), timeout
+
+    def _stored_links(self, url, html, mime=None):
+        # 页面未改变时使用上次保存的链接，没有保存链接时解析页面（304响应时为上次保存的页面），
+        # 只解析已知为html的页面，旧版本数据库没有保存Content-Type时不解析
+        links = self.db.links(url)
+        if links is None:
+            if not (mime and mime.startswith('text/html')):
+                return ()
+            html = html or self.db.read(url)
+            links = set(map(self.canonicalize, self.parse(html, url, None, self.download, True))) if html else ()
+        return links
+
+    def _target(self, url):
+        # 返回下载参数(url, writer, keyword, headers)，起始页面不检查关键词，
+        # 增量爬行时headers为按上次保存的ETag/Last-Modified生成的条件请求头
+        url, ext, deep = url
+        keyword = self.keyword if deep > 0 else None
+        writer = self.db.get_writer(url, '', self.mirror, self.neardup) # 页面中找到的关键词在下载时记入writer.keyword
+        headers = None
+        if self.incremental:
+            writer.known = self.db.validators(url)
+            if writer.known:
+                etag, modified = writer.known[:2]
+                headers = {}
+                if etag:
+                    headers['If-None-Match'] = etag
+                if modified:
+                    headers['If-Modified-Since'] = modified
+        return url, writer, keyword, headers
+
+    def _request(self, url):
+        # 下载链接，返回(写入器, request_url的结果)
+        url, writer, keyword, headers = self._target(url)
+        return writer, request_url(url, save_as=writer, keyword=keyword, http=self.http, max_size=self.max_size,
+                                   headers=headers, detect=not self.processes)
+
+    @staticmethod
+    def _hostkey(url):
+        return urllib.urlparse(url).netloc.split('@')[-1].lower()
+
+    def _report(self, url, host, result, latency, count=None):
+        # 向调度器报告请求结果，被限流（429/503）且未超过重试次数时将链接重新暂存，返回是否重试
+        e = result[1] if result and result[0][0] == '*' else None
+        status = e.status if isinstance(e, HTTPError) else None
+        retry_after = e.headers.get('Retry-After') if status else None
+        error = result is None or (status or 0) >= 500 or \
+            isinstance(e, (OSError, asyncio.TimeoutError, HTTPException))
+        if result is None:
+            code = 'exception'
+        elif e is not None:
+            code = status or type(e).__name__
+        else:
+            code = '304' if result[0] == 'notmodified' else '2xx'
+        self.m_requests.inc(host, code)
+        self.m_fetch.observe(latency)
+        with self.lock:
+            if not self.sched.release(host, latency, status, error, retry_after) or self.stopped:
+                if self.tries:
+                    self.tries.pop(url[0], None)
+                return False
+            tries = self.tries.get(url[0], (0, count))[0] + 1
+            if tries > self.retries:
+                del self.tries[url[0]]
+                return False
+            self.tries[url[0]] = (tries, count)
+            self.sched.park(host, url, front=True)
+        _log.info('THROTTLED: URL %s returned %s, retry %s/%s', url[0], status, tries, self.retries)
+        return True
+
+    def get_page(self, url, _filter):
+        # 返回True表示链接被限流，已重新排队
+        host = self._hostkey(url[0])
+        count = self._start(url, _filter)
+        if count is None:
+            with self.lock:
+                self.sched.cancel(host)
+            return False
+        start = time.monotonic()
+        writer = result = None
+        try:
+            writer, result = self._request(url)
+        finally:
+            retry = self._report(url, host, result, time.monotonic() - start, count)
+        if not retry:
+            self._handle(url, count, result, writer)
+        return retry
+
+    def _dispatch(self):
+        # 将待爬链接交给空闲线程，所在主机未就绪的链接暂存在调度器中，调用时须持有self.lock
+        now = time.monotonic()
+        while self.active < self.threads and not self.stopped:
+            url = self.sched.pop_ready(now)
+            if url is None:
+                if not self.queue:
+                    break
+                url = self.queue.pop()
+                host = self._hostkey(url[0])
+                if not self.sched.acquire(host, now):
+                    # 暂存的链接按先进先出出队，不再遵循待爬队列的顺序（dfs/best），每个主机只暂存少量链接
+                    self.sched.park(host, url)
+                    if self.sched.parked(host) >= HOST_PARK_LIMIT:
+                        break
+                    continue
+            self.active += 1
+            self._submit(url)
+
+    def _submit(self, url):
+        self.pool.add(self._work, (url,))
+
+    def _done(self):
+        # 一个链接处理完毕，补充新任务并唤醒主线程（爬行可能已结束，或需重新计算暂存链接的等待时间）
+        with self.cond:
+            self.active -= 1
+            self._dispatch()
+            self.cond.notify_all()
+
+    def _work(self, url):
+        retry = False
+        try:
+            retry = self.get_page(url, self.skip_ext)
+        except Exception as e:
+            _log.exception('*** ERROR: failed to handle URL "%s": %s', url[0], e)
+        finally:
+            if not retry:
+                self.db.finish(url[0])
+            self._done()
+
+    def _start_procs(self):
+        # 创建解析页面的进程池，子进程以spawn方式启动，不继承写入线程等正在使用的锁
+        if self.processes:
+            self.procs = ProcessPoolExecutor(self.processes, multiprocessing.get_context('spawn'),
+                _init_extractor, (self.parser, self.canonicalize, self.download, self.host, self.dom,
+                                  self.pridomain))
+
+    def _stop_procs(self):
+        if self.procs:
+            self.procs.shutdown(cancel_futures=True)
+            self.procs = None
 
     def run(self, _filter=True):
+        self.skip_ext = _filter
+        self.pool = Pool(self.threads)
+        self._start_procs()
+        if self.indexer:
+            self.indexer.start()
+        self._start_monitor()
         try:
             while True:
-                if len(self.queue):
-                    with self.lock:
-                        url = self.queue[0]
-                        del self.queue[0]
-                    self.pool.add(self.get_page,(url, _filter))
-                elif not self.pool.running():
-                    with self.lock, self.pool._lock:
-                        flag = False
-                        if not (len(self.pool.tasks) or len(self.queue) or self.pool.running()):
-                            flag = True
-                    if flag:
-                        self.pool.close()
-                        break
+                received = self._poll()
+                with self.cond:
+                    idle, timeout = self._step(received)
+                    if not idle:
+                        self.cond.wait(timeout)
+                        continue
+                if not self.cluster or self.cluster.idle(): # 本节点空闲时才检查其他节点
+                    break
+                with self.cond:
+                    self.cond.wait(timeout)
+            self.pool.close()
+            self.pool.join()
         except KeyboardInterrupt as e:
-            with self.lock, self.pool._lock:
-                self.pool.close()
-                self.pool.tasks.clear()
-                for i in self.pool.workers: i.kill()
+            with self.lock:
+                self.stopped = True
                 self.queue.clear()
-            while not all(map(lambda x:x.done, self.pool.workers)):
-                pass
-            self.db.close()
+                self.sched.clear()
+            self.pool.terminate()
+            self.pool.join()
+            self._stop_procs()
+            self._stop_monitor()
+            self.http.close()
+            self._close_store()
             _log.warning('*** ERROR: KeyboardInterrupt')
             exit(1)
+        self._stop_procs()
+        self._stop_monitor()
+        self.http.close()
+        self._close_store()
+        self._summary()
+
+    def _close_store(self):
+        # 写完镜像队列中剩余的文件并关闭数据库
+        if self.mirror:
+            self.mirror.close()
         self.db.close()
+        if self.indexer and self.indexer.is_alive(): # 数据库写完后索引剩余的页面
+            try:
+                self.indexed = self.indexer.stop()
+            except sqlite3.Error as e:
+                _log.warning('*** ERROR: full-text index failed: %s', e)
+
+    def _summary(self):
+        # 记录最终报告、各主机的长连接复用率及页面存储的压缩率、去重率
+        self._final_report()
+        for (scheme, host, port), (requests, created) in sorted(self.http.stats().items()):
+            if requests:
+                _log.info('POOL: %s://%s:%s %s requests over %s connections, reuse ratio %.1f%%' % (
+                    scheme, host, port, requests, created, 100.0 * (requests - created) / requests))
+        for host, (requests, errors, throttled, limit) in sorted(self.sched.stats().items()):
+            if requests:
+                _log.info('HOST: %s %s requests, %s errors, %s throttled, concurrency %s' % (
+                    host, requests, errors, throttled, limit))
+        if self.cluster:
+            _log.info('CLUSTER: node %s of %s, %s links sent to other nodes, %s links received' % (
+                self.cluster.node, self.cluster.nodes, self.sent, self.received))
+        if self.neardup:
+            pages = dups = 0
+            for host, (n, d) in sorted(self.neardups.items()):
+                pages += n
+                dups += d
+                _log.info('NEARDUP: %s %s of %s pages near-duplicates (%.1f%%)', host, d, n, 100.0 * d / n)
+            _log.info('NEARDUP: %s of %s pages not saved as near-duplicates within %s bits, links %s', dups, pages,
+                      self.neardup.threshold, 'not followed' if self.neardup_nofollow else 'followed')
+        if self.indexer:
+            _log.info('INDEX: %s pages indexed, search with --query', self.indexed)
+        if self.mirror:
+            _log.info('MIRROR: %s files saved under %s, %s hard links, %s errors, manifest %s' % (
+                self.mirror.files, self.mirror.root, self.mirror.linked, self.mirror.errors, self.mirror.manifest))
+        if self.incremental:
+            _log.info('INCREMENTAL: %s of %s pages unchanged, %s answered 304 Not Modified' % (
+                self.unchanged, self.count, self.notmodified))
+        pages, dups, raw_size, stored_size = self.db.stats()
+        if pages:
+            _log.info('STORE: %s pages, %s duplicates, dedup hit rate %.1f%%, compression ratio %.2f' % (
+                pages, dups, 100.0 * dups / pages, raw_size / max(stored_size, 1)))
+
+    def _final_report(self):
+        # 爬行结束时的汇总：速度、流量、各阶段耗时分布与按主机、状态码分类的错误
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        errors = self._errors()
+        _log.info('REPORT: %s pages in %.1f seconds (%.1f pages/s), %.1f MB in, %s requests, %s errors' % (
+            self.count, elapsed, self.count / elapsed if elapsed else 0.0, self.m_bytes.total() / 2**20,
+            self.m_requests.total(), sum(errors.values())))
+        pages = ', '.join('%s %s' % (k[0], v) for k, v in self.m_pages.items())
+        if pages:
+            _log.info('REPORT: pages by result: %s' % pages)
+        for name, h in (('fetch', self.m_fetch), ('parse', self.m_parse), ('db write', self.m_db)):
+            if h.count():
+                _log.info('REPORT: %s %s samples, avg %.1fms, p50 %.1fms, p90 %.1fms, p99 %.1fms' % (
+                    name, h.count(), 1000 * h.sum() / h.count(), *(1000 * h.quantile(q) for q in (0.5, 0.9, 0.99))))
+        for (host, status), n in sorted(errors.items(), key=lambda i:-i[1]):
+            _log.info('REPORT: errors %s %s: %s' % (host, status, n))
+
+class AsyncSpider(Spider):
+    '''asyncio爬行引擎，在单个事件循环中并发下载，threads参数为最大并发连接数，
+    页面解析与数据库写入仍在事件循环线程中执行
+    '''
+
+    def _submit(self, url):
+        # 事件循环只保存任务的弱引用，进行中的任务须保存在self.tasks中，否则可能被回收
+        task = self.loop.create_task(self._work_async(url))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _work_async(self, url):
+        retry = False
+        try:
+            host = self._hostkey(url[0])
+            count = self._start(url, self.skip_ext)
+            if count is None:
+                with self.lock:
+                    self.sched.cancel(host)
+                return
+            start = time.monotonic()
+            result = None
+            try:
+                link, writer, keyword, headers = self._target(url)
+                result = await async_request_url(link, writer, keyword, self.max_size, headers,
+                                                 not self.processes)
+            finally:
+                retry = self._report(url, host, result, time.monotonic() - start, count)
+            if retry or not self._check(url, count, result, writer):
+                return
+            with self.m_parse.time():
+                if self.procs and result[0] in ('ok', 'neardup'): # 等待子进程解析时事件循环继续处理其他下载
+                    links = self._save_links(url, await asyncio.wrap_future(self._extract(url, result)))
+                else:
+                    links = self._links(url, result)
+            self._enqueue(url, result, links)
+        except Exception as e:
+            _log.exception('*** ERROR: failed to handle URL "%s": %s', url[0], e)
+        finally:
+            if not retry:
+                self.db.finish(url[0])
+            self._done()
+
+    def _done(self):
+        with self.lock:
+            self.active -= 1
+            self._dispatch()
+        self.wakeup.set()
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.tasks = set()
+        while True:
+            # 与协调器的通信会阻塞，放到线程池中执行，期间事件循环继续处理下载
+            received = await self.loop.run_in_executor(None, self._poll) if self.cluster else ()
+            with self.lock:
+                idle, timeout = self._step(received)
+            if idle and (not self.cluster or await self.loop.run_in_executor(None, self.cluster.idle)):
+                return
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def run(self, _filter=True):
+        self.skip_ext = _filter
+        self._start_procs()
+        if self.indexer:
+            self.indexer.start()
+        self._start_monitor()
+        try:
+            asyncio.run(self._main())
+        except KeyboardInterrupt as e:
+            self._stop_procs()
+            self._stop_monitor()
+            self._close_store()
+            _log.warning('*** ERROR: KeyboardInterrupt')
+            exit(1)
+        self._stop_procs()
+        self._stop_monitor()
+        self._close_store()
+        self._summary()
+
+_engines = ('threads', 'asyncio')
+
+LOG_QUEUE_SIZE = 10000 # 日志队列长度，队列满时丢弃WARNING以下的记录
+
+class _JsonFormatter(_log.Formatter):
+    # 每条记录输出为一行JSON
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'), 'level': record.levelname,
+                 'thread': record.threadName, 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
 
-def _setlog(loglevel=5, filename='spider.log'):
+class _QueueHandler(QueueHandler):
+    # 工作线程只把记录放入队列，格式化与写文件、控制台都在监听线程中进行；
+    # 队列满时丢弃WARNING以下的记录并计数，不阻塞爬行
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record # 同一进程内传递，不需要提前格式化
+
+    def enqueue(self, record):
+        if record.levelno >= _log.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def _stop_log(handler, listener):
+    if listener._thread is not None: # 调用者可能已自行停止监听线程，再次stop会出错
+        listener.stop()
+    if handler.dropped:
+        for h in listener.handlers:
+            h.handle(_log.makeLogRecord({'msg': 'LOG: %s records dropped (queue full)' % handler.dropped,
+                                         'levelno': _log.WARNING, 'levelname': 'WARNING'}))
+        handler.dropped = 0
+    for h in listener.handlers:
+        h.close()
+
+def _setlog(loglevel=5, filename='spider.log', fmt='text'):
+    # 日志经队列由后台监听线程写入文件与控制台，fmt为json时文件日志（没有文件时为控制台）
+    # 每行一条JSON记录，返回QueueListener，程序退出时自动停止并写完剩余记录
     loglevels = [_log.CRITICAL, _log.ERROR, _log.WARNING, _log.INFO, _log.DEBUG, _log.NOTSET]
-    _log.basicConfig(level=loglevels[loglevel],
-                     format='%(asctime)s %(message)s',
-                     datefmt='%Y-%m-%d %H:%M:%S',
-                     filename=filename,
-                     filemode='a')
     if filename:
+        handler = _log.FileHandler(filename, 'a')
+        handler.setFormatter(_log.Formatter('%(asctime)s %(message)s', '%Y-%m-%d %H:%M:%S'))
         console = _log.StreamHandler()
-        console.setLevel(loglevels[loglevel])
-        formatter = _log.Formatter('%(asctime)s %(message)s')
-        console.setFormatter(formatter)
-        _log.getLogger('').addHandler(console)
-    # _log.debug('This is debug message')
-    # _log.info('This is info message')
-    # _log.warning('This is warning message')
+        console.setFormatter(_log.Formatter('%(asctime)s %(message)s'))
+        handlers = [handler, console]
+    else:
+        handler = _log.StreamHandler()
+        handler.setFormatter(_log.Formatter('%(asctime)s %(message)s', '%Y-%m-%d %H:%M:%S'))
+        handlers = [handler]
+    if fmt == 'json':
+        handler.setFormatter(_JsonFormatter())
+    root = _log.getLogger('')
+    root.setLevel(loglevels[loglevel])
+    for h in root.handlers[:]:
+        if isinstance(h, _QueueHandler): # 重复配置时停用以前的队列，否则每条记录会写多次
+            root.removeHandler(h)
+            _stop_log(h, h.listener)
+    qh = _QueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    root.addHandler(qh)
+    listener = QueueListener(qh.queue, *handlers)
+    listener.start()
+    qh.listener = listener
+    atexit.register(_stop_log, qh, listener)
+    return listener
+
+def _query(dbfile, terms, limit):
+    # 全文搜索已有的数据库并输出结果
+    if not os.path.exists(dbfile):
+        print('Error: database %s does not exist' % dbfile)
+        exit(1)
+    start = time.perf_counter()
+    try:
+        results = search_index(dbfile, terms, limit)
+    except sqlite3.Error as e:
+        print('Error: %s' % e)
+        exit(1)
+    for rank, (table, url, title, snippet, score) in enumerate(results, 1):
+        print('%2d. %s\n    %s\n    %s' % (rank, url, title or '(no title)', snippet))
+    print('%s results in %.1f ms' % (len(results), (time.perf_counter() - start) * 1000))
 
 def _getopt(opts, key, func, default):
     try:
@@ -308,7 +1524,13 @@ def main():
         exit()
     try:
         opts, args = getopt.getopt(sys.argv[1:],
-            'hDpu:d:f:l:', ['help', 'download', 'pridomain', 'testself', 'thread=', 'dbfile=', 'key='])
+            'hDpu:d:f:l:', ['help', 'download', 'pridomain', 'testself', 'thread=', 'dbfile=', 'key=',
+                            'order=', 'engine=', 'hostconns=', 'idle=', 'batch=', 'sync=', 'store=',
+                            'level=', 'resume', 'seen=', 'fpr=', 'sortquery', 'strip=', 'parser=',
+                            'maxsize=', 'hostmax=', 'delay=', 'adaptive', 'retries=',
+                            'incremental', 'processes=', 'cluster=', 'node=', 'nodes=', 'cluster-run=', 'metrics=',
+                            'progress=', 'logformat=', 'hardlink', 'index', 'query=', 'limit=',
+                            'keyfile=', 'neardup=', 'neardup-nofollow'])
     except getopt.GetoptError as e:
         print('Error:', e)
         print('Use -h or --help for more information.')
@@ -318,6 +1540,9 @@ def main():
         print(_help)
         exit()
     testself = '--testself' in opts
+    if '--query' in opts:
+        _query(_getopt(opts, '--dbfile', str, 'data.db'), opts['--query'], _getopt(opts, '--limit', int, 10))
+        exit()
     if '-u' in opts:
         start_url = opts['-u']
         if start_url[0:7].lower() != 'http://':
@@ -329,19 +1554,102 @@ def main():
     deep = _getopt(opts, '-d', int, 7)
     logfile = _getopt(opts, '-f', str, 'spider.log')
     loglevel = _getopt(opts, '-l', int, 5)
+    logformat = _getopt(opts, '--logformat', str, 'text')
+    if logformat not in ('text', 'json'):
+        print('Error: option --logformat must be text or json')
+        exit(1)
     thread = _getopt(opts, '--thread', int, 10)
     dbfile = _getopt(opts, '--dbfile', str, 'data.db')
-    keyword = _getopt(opts, '--key', str, None)
+    keyword = [i.strip() for i in _getopt(opts, '--key', str, '').split(',') if i.strip()]
+    if '--keyfile' in opts:
+        try:
+            keyword.extend(load_keywords(opts['--keyfile']))
+        except (OSError, UnicodeError) as e:
+            print('Error: cannot read keyword file: %s' % e)
+            exit(1)
     pridomain = ('-p' in opts or '--pridomain' in opts)
     download = ('-D' in opts or '--download' in opts)
+    order = _getopt(opts, '--order', str, 'bfs')
+    if order not in Frontier.modes:
+        print('Error: option --order must be one of %s' % ', '.join(Frontier.modes))
+        exit(1)
+    engine = _getopt(opts, '--engine', str, 'threads')
+    if engine not in _engines:
+        print('Error: option --engine must be one of %s' % ', '.join(_engines))
+        exit(1)
+    hostconns = _getopt(opts, '--hostconns', int, None)
+    idle = _getopt(opts, '--idle', float, 30)
+    batch = _getopt(opts, '--batch', int, 500)
+    synchronous = _getopt(opts, '--sync', str, 'normal').upper()
+    if synchronous not in BatchWriter._sync_modes:
+        print('Error: option --sync must be one of off, normal, full')
+        exit(1)
+    store = _getopt(opts, '--store', str, 'raw')
+    if store not in _db.codecs:
+        print('Error: option --store must be one of %s' % ', '.join(_db.codecs))
+        exit(1)
+    level = _getopt(opts, '--level', int, 6)
+    resume = '--resume' in opts
+    seen = _getopt(opts, '--seen', str, 'set')
+    if seen not in _seen_modes:
+        print('Error: option --seen must be one of %s' % ', '.join(_seen_modes))
+        exit(1)
+    fpr = _getopt(opts, '--fpr', float, 0.001)
+    strip = []
+    for param in _getopt(opts, '--strip', str, '').split(','):
+        if param == 'tracking':
+            strip.extend(TRACKING_PARAMS)
+        elif param:
+            strip.append(param)
+    canonicalize = Canonicalizer('--sortquery' in opts, strip)
+    parser = _getopt(opts, '--parser', str, 'html')
+    if parser not in parsers:
+        print('Error: option --parser must be one of %s' % ', '.join(parsers))
+        exit(1)
+    max_size = _getopt(opts, '--maxsize', int, MAX_SIZE)
+    hostmax = _getopt(opts, '--hostmax', int, None)
+    delay = _getopt(opts, '--delay', float, 0.0)
+    adaptive = '--adaptive' in opts
+    retries = _getopt(opts, '--retries', int, 3)
+    incremental = '--incremental' in opts
+    processes = _getopt(opts, '--processes', int, 0)
+    metrics = _getopt(opts, '--metrics', int, None)
+    neardup = _getopt(opts, '--neardup', int, None)
+    if neardup is not None and not 0 <= neardup < 32:
+        print('Error: option --neardup must be in range 0-31')
+        exit(1)
+    progress = _getopt(opts, '--progress', float, 10.0)
+    cluster = None
+    if '--cluster' in opts:
+        node = _getopt(opts, '--node', int, -1)
+        nodes = _getopt(opts, '--nodes', int, 0)
+        if not 0 <= node < nodes:
+            print('Error: options --node and --nodes must satisfy 0 <= node < nodes')
+            exit(1)
+        try:
+            cluster = connect(opts['--cluster'], node, nodes, opts.get('--cluster-run', ''), resume)
+        except (ValueError, OSError) as e:
+            print('Error: %s' % e)
+            exit(1)
+        dbfile = shard_name(dbfile, node)
     if testself:
         _setlog(5, '')
         spider = Spider('www.baidu.com', 0, 1, 'testself.db', '', True, False)
         spider.run()
         _log.info('!!!ok!!!')
         exit()
-    _setlog(loglevel, logfile)
-    spider = Spider(start_url, deep, thread, dbfile, keyword, pridomain, download)
+    _setlog(loglevel, logfile, logformat)
+    cls = AsyncSpider if engine == 'asyncio' else Spider
+    spider = cls(start_url, deep, thread, dbfile, keyword, pridomain, download, order,
+                 hostconns=hostconns, idle=idle, batch=batch, synchronous=synchronous,
+                 store=store, level=level, resume=resume, seen=seen, fpr=fpr,
+                 canonicalize=canonicalize, parser=parser, max_size=max_size, hostmax=hostmax,
+                 delay=delay, adaptive=adaptive, retries=retries, incremental=incremental,
+                 processes=processes, cluster=cluster, metrics=metrics, progress=progress,
+                 hardlink='--hardlink' in opts, index='--index' in opts, neardup=neardup,
+                 neardup_nofollow='--neardup-nofollow' in opts)
     spider.run(not download)
+    if cluster:
+        cluster.close()
 if __name__ == '__main__':
     main()
\ No newline at end of file